@@ -1,11 +1,16 @@
-import os
+import atexit
 import json
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import repeat
 
 import client.data as data
 import client.log as log
-import client.cloud.utils as utils
 import client.config as config
-from client.cloud.exceptions import ErrorInCloudMap
+import client.cloud.utils as utils
+from client.storage.bucket import serialize_bucket
+from client.cloud.exceptions import ErrorInCloudMap, ServerConnectionError
+from client.cloud.treetop_cache import TreetopCache
 import client.cloud.server_connection as server_connection
 
 logger = log.get_logger(__name__)
@@ -16,13 +21,31 @@ class Cloud:
     An entity connecting the client to the server. It is NOT the cloud of the server, but instead
     how to client represents it
     """
-    def __init__(self, aes_crypto):
+    # server tree name -> the treetop cache of the tree, shared by every Cloud of the tree
+    _treetop_caches = dict()
+
+    def __init__(self, aes_crypto, tree_name=None):
         if not data.data_file_exists(utils.CLOUD_MAP_FILE_NAME):
             logger.info("CREATE CLOUD MAP")
             self.create_cloud_map()
+        # Trees other than the main PathORAM Tree (e.g. of the position map) are told apart by
+        # their name, both in the cloud map and in the names of their files on the server
+        self.tree_name = tree_name
+        if tree_name is None:
+            self.init_key = utils.JSON_INIT
+            self.server_tree_name = ''
+        else:
+            self.init_key = utils.TREE_JSON_INIT % tree_name
+            self.server_tree_name = tree_name
+        self.init_progress_key = utils.JSON_INIT_PROGRESS % self.init_key
+        self.cipher_suite_key = utils.JSON_CIPHER_SUITE % self.init_key
+        self.engine_state_key = utils.JSON_ENGINE_STATE % self.init_key
+        self.grow_progress_key = utils.JSON_GROW_PROGRESS % self.init_key
         cloud_init = self.load_cloup_map()
         self.aes_crypto = aes_crypto
         self.cloud_init = cloud_init
+        self.cipher_suite = self.load_cipher_suite()
+        self.treetop = self._treetop_caches.get(self.server_tree_name)
 
     def create_cloud_map(self):
         """
@@ -40,91 +63,404 @@ class Cloud:
         with data.open_data_file(utils.CLOUD_MAP_FILE_NAME, utils.READ_MODE) as cloud_map:
             try:
                 cloud_data = json.load(cloud_map)
+                if self.tree_name is not None:
+                    return cloud_data.get(self.init_key, False)
                 return cloud_data[utils.JSON_INIT]
             except (ValueError, KeyError):
                 logger.warning("ERROR IN CLOUD MAP")
                 raise ErrorInCloudMap("Error in cloud map.")
 
-    def update_cloud_map(self):
+    def load_setup_progress(self):
+        """
+        Loads the amount of nodes whose buckets were uploaded by an interrupted setup of the cloud
+        :return: the amount of nodes, 0 if no setup was interrupted
+        """
+        with data.open_data_file(utils.CLOUD_MAP_FILE_NAME, utils.READ_MODE) as cloud_map:
+            try:
+                return json.load(cloud_map).get(self.init_progress_key, 0)
+            except ValueError:
+                logger.warning("ERROR IN CLOUD MAP")
+                raise ErrorInCloudMap("Error in cloud map.")
+
+    def load_cipher_suite(self):
+        """
+        Loads the cipher suite the buckets of the tree are encrypted with. The buckets of a tree
+        must all be of the same size, so a tree keeps the suite it was set up with
+        :return: the name of the cipher suite
+        """
+        with data.open_data_file(utils.CLOUD_MAP_FILE_NAME, utils.READ_MODE) as cloud_map:
+            try:
+                cloud_data = json.load(cloud_map)
+            except ValueError:
+                logger.warning("ERROR IN CLOUD MAP")
+                raise ErrorInCloudMap("Error in cloud map.")
+        if self.cipher_suite_key in cloud_data:
+            return cloud_data[self.cipher_suite_key]
+        if self.cloud_init or self.init_progress_key in cloud_data:
+            return utils.LEGACY_CIPHER_SUITE
+        return config.CIPHER_SUITE
+
+    def load_engine_state(self):
+        """
+        Loads the state the ORAM engine of the tree keeps between runs of the client
+        :return: the state, None if none was saved
+        """
+        return self._load_cloud_map_entry(self.engine_state_key)
+
+    def update_engine_state(self, engine_state):
+        """
+        Saves the state the ORAM engine of the tree keeps between runs of the client
+        :param engine_state: the state, serializable to JSON
+        :return:
+        """
+        self._update_cloud_map_entry(self.engine_state_key, engine_state)
+
+    def _load_cloud_map_entry(self, key):
+        """
+        Loads an entry of the cloud map
+        :param key: the key of the entry
+        :return: the value of the entry, None if there is none
+        """
+        with data.open_data_file(utils.CLOUD_MAP_FILE_NAME, utils.READ_MODE) as cloud_map:
+            try:
+                return json.load(cloud_map).get(key)
+            except ValueError:
+                logger.warning("ERROR IN CLOUD MAP")
+                raise ErrorInCloudMap("Error in cloud map.")
+
+    def _update_cloud_map_entry(self, key, value):
+        """
+        Updates an entry of the cloud map
+        :param key: the key of the entry
+        :param value: the value of the entry, serializable to JSON, or None for removing the entry
+        :return:
+        """
+        with data.open_data_file(utils.CLOUD_MAP_FILE_NAME, utils.READ_WRITE_MODE) as cloud_map:
+            cloud_data = json.load(cloud_map)
+            if value is None:
+                cloud_data.pop(key, None)
+            else:
+                cloud_data[key] = value
+            cloud_map.seek(utils.FILE_BEGIN)
+            json.dump(cloud_data, cloud_map, indent=utils.JSON_INDENT)
+            cloud_map.truncate()
+
+    def update_cloud_map(self, setup_progress=None):
         """
         Updates the cloud map
+        :param setup_progress: the amount of nodes whose buckets were uploaded so far, while the
+        cloud is being set up
         :return:
         """
         with data.open_data_file(utils.CLOUD_MAP_FILE_NAME, utils.READ_WRITE_MODE) as cloud_map:
             cloud_data = json.load(cloud_map)
-            cloud_data[utils.JSON_INIT] = self.cloud_init
+            cloud_data[self.init_key] = self.cloud_init
+            cloud_data[self.cipher_suite_key] = self.cipher_suite
+            if setup_progress is None:
+                cloud_data.pop(self.init_progress_key, None)
+            else:
+                cloud_data[self.init_progress_key] = setup_progress
             cloud_map.seek(utils.FILE_BEGIN)
             json.dump(cloud_data, cloud_map, indent=utils.JSON_INDENT)
             cloud_map.truncate()
 
-    def setup_cloud(self, max_block_size):
+    def setup_cloud(self, max_node_size, dummy_bucket=None):
         """
-        Sets up the server's cloud with dummy files, a required initialization for further
-        attempts using it
-        :param max_block_size: the maximal amount of blocks we can upload to the server's cloud,
-        that is, to the PathORAM Tree
+        Sets up the server's cloud with dummy buckets, a required initialization for further
+        attempts using it. The buckets are encrypted in parallel and streamed to the server in
+        batches over the same connection, while the next batches are encrypted. The uploaded
+        batches are recorded in the cloud map, so an interrupted setup resumes where it stopped
+        :param max_node_size: the amount of nodes (buckets) of the PathORAM Tree
+        :param dummy_bucket: the plaintext every node is set up with, a bucket of dummies by default
         :return:
         """
-        if not self.cloud_init:
-            logger.info(f"START SETUP OF THE CLOUD WITH A TOTAL OF {max_block_size} BLOCKS")
-            server_connection.socket_connect()
-            for block in range(max_block_size):
-                logger.info(f"UPLOAD FILE {block + 1}")
-                self.file_upload(self.create_dummy_data(), block)
-            logger.info("END SETUP OF THE CLOUD")
-            self.cloud_init = True
-            self.update_cloud_map()
+        if self.cloud_init:
+            return
+        first_node = self.load_setup_progress()
+        logger.info(f"START SETUP OF THE CLOUD WITH A TOTAL OF {max_node_size} BUCKETS")
+        if first_node:
+            logger.info(f"RESUME SETUP OF THE CLOUD FROM BUCKET {first_node + 1}")
+        logger.info(f"THE BUCKETS ARE ENCRYPTED WITH {self.cipher_suite}")
+        if dummy_bucket is None:
+            dummy_bucket = serialize_bucket(list())
+        # Every bucket is encrypted to the same size as a bucket of dummies. A tree of the same
+        # geometry is kept by the server, which is what resuming relies on
+        token_size = self.aes_crypto.token_size(len(dummy_bucket), self.cipher_suite)
+        server_connection.create_tree(self.server_tree_name, max_node_size, token_size)
+        self.update_cloud_map(first_node)
+        self._upload_dummy_buckets(first_node, max_node_size, dummy_bucket, self.update_cloud_map)
 
-    def create_dummy_data(self):
+        logger.info("END SETUP OF THE CLOUD")
+        self.cloud_init = True
+        self.update_cloud_map()
+
+    def grow_cloud(self, first_node, max_node_size, dummy_bucket=None):
         """
-        Creates dummy data block
+        Grows the server's cloud to more nodes, keeping the buckets of the existing nodes, and sets
+        up the new nodes with dummy buckets the same way the cloud is set up. An interrupted growth
+        resumes where it stopped
+        :param first_node: the amount of nodes (buckets) of the PathORAM Tree before it grew
+        :param max_node_size: the amount of nodes (buckets) of the grown PathORAM Tree
+        :param dummy_bucket: the plaintext every new node is set up with, a bucket of dummies by
+        default
         :return:
         """
-        dummy_id = config.DUMMY_ID
-        dummy_data = os.urandom(config.BLOCK_SIZE)
-        return self.aes_crypto.encrypt(dummy_id,dummy_data)
+        first_node = self._load_cloud_map_entry(self.grow_progress_key) or first_node
+        logger.info(f"START GROWTH OF THE CLOUD TO A TOTAL OF {max_node_size} BUCKETS")
+        if dummy_bucket is None:
+            dummy_bucket = serialize_bucket(list())
+        token_size = self.aes_crypto.token_size(len(dummy_bucket), self.cipher_suite)
+        server_connection.grow_tree(self.server_tree_name, max_node_size, token_size)
+        self._upload_dummy_buckets(
+            first_node, max_node_size, dummy_bucket,
+            lambda next_node: self._update_cloud_map_entry(self.grow_progress_key, next_node))
+        self._update_cloud_map_entry(self.grow_progress_key, None)
+        logger.info("END GROWTH OF THE CLOUD")
 
-    def get_path_to_file(self, node):
+    def _upload_dummy_buckets(self, first_node, max_node_size, dummy_bucket, record_progress):
         """
-        Returns a path to a file representing a node in the PathORAM Tree
-        :param node: a node in the PathORAM Tree
-        :return: a path to a file representing a node in the PathORAM Tree
+        Uploads dummy buckets to a range of nodes. The buckets are encrypted in parallel and
+        streamed to the server in batches over the same connection, while the next batches are
+        encrypted
+        :param first_node: the first node of the range
+        :param max_node_size: the node following the range
+        :param dummy_bucket: the plaintext of every bucket
+        :param record_progress: a function called with the node following every uploaded batch,
+        in order
+        :return:
         """
-        return utils.FILE_NAME % node
+        token_size = self.aes_crypto.token_size(len(dummy_bucket), self.cipher_suite)
+        # The batches in flight - tuples (the node following the batch, the future of the batch)
+        in_flight = deque()
+        with ThreadPoolExecutor(utils.SETUP_WORKERS) as executor:
+            for batch_node in range(first_node, max_node_size, utils.SETUP_BATCH_SIZE):
+                nodes = range(batch_node, min(batch_node + utils.SETUP_BATCH_SIZE, max_node_size))
+                # The buckets of a batch are encrypted straight into a single buffer
+                batch = memoryview(bytearray(len(nodes) * token_size))
+                buckets = [batch[offset:offset + token_size]
+                           for offset in range(0, len(batch), token_size)]
+                list(executor.map(self.aes_crypto.encrypt_bucket_into, repeat(dummy_bucket),
+                                  buckets, repeat(self.cipher_suite)))
+                # The buckets are uploaded past the treetop cache, as the progress recorded must
+                # be of buckets the server keeps
+                in_flight.append((nodes.stop, server_connection.write_path_async(
+                    self.server_tree_name, list(nodes), buckets)))
+                while in_flight and in_flight[0][1].done():
+                    self._commit_setup_batch(in_flight.popleft(), max_node_size, record_progress)
+        while in_flight:
+            self._commit_setup_batch(in_flight.popleft(), max_node_size, record_progress)
 
-    def node_download(self, node):
+    def _commit_setup_batch(self, batch, max_node_size, record_progress):
         """
-        Download a PathORAM Tree node from the server's cloud
-        :param node: a node in the PathORAM Tree
+        Waits for a batch of buckets uploaded while setting up the cloud, and records the progress
+        :param batch: tuple (the node following the batch, the future of the batch)
+        :param max_node_size: the amount of nodes (buckets) of the PathORAM Tree
+        :param record_progress: a function called with the node following the batch
         :return:
         """
-        return self.file_download(node)
+        next_node, future = batch
+        future.result()
+        record_progress(next_node)
+        logger.info(f"SETUP OF THE CLOUD - UPLOADED {next_node} OF {max_node_size} BUCKETS "
+                    f"({next_node * 100 // max_node_size}%)")
 
-    def file_download(self, block):
+    def create_dummy_data(self):
+        """
+        Creates a bucket of dummy data blocks only
+        :return:
         """
-        Downloads a file from the server
-        :param block: a data block
-        :return: the file
+        return self.aes_crypto.encrypt_bucket(serialize_bucket(list()), self.cipher_suite)
+
+    def node_download(self, node):
+        """
+        Download a PathORAM Tree node from the server's cloud
+        :param node: a node in the PathORAM Tree
+        :return: the encrypted bucket of the node
         """
-        return server_connection.file_download(self.get_path_to_file(block))
+        return self.read_path([node])[0]
 
     def node_upload(self, node, content=None):
         """
         Uploads a PathORAM Tree node to the server's cloud
         :param node: a node in the PathORAM Tree
-        :param content: the content of the node if exists at all
+        :param content: the encrypted bucket of the node, or None for a bucket of dummies
+        :return:
+        """
+        self.write_path([node], [content])
+
+    def read_path(self, nodes):
+        """
+        Downloads many PathORAM Tree nodes from the server's cloud in a single round trip
+        :param nodes: nodes in the PathORAM Tree
+        :return: the encrypted buckets of the nodes, in the same order
+        """
+        if self.treetop is None:
+            return server_connection.read_path(self.server_tree_name, list(nodes))
+        return self.read_path_async(nodes).result()
+
+    def read_path_async(self, nodes, callback=None):
+        """
+        Downloads many PathORAM Tree nodes from the server's cloud in a single round trip, without
+        waiting for them
+        :param nodes: nodes in the PathORAM Tree
+        :param callback: a function called with the future once it is resolved
+        :return: a future of the encrypted buckets of the nodes, in the same order
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return self._resolved_future(list(), callback)
+        if self.treetop is None:
+            return server_connection.read_path_async(self.server_tree_name, nodes, callback)
+        treetop = self.treetop
+        # The nodes of the treetop cache are downloaded only if they were not downloaded yet
+        server_nodes = [node for node in nodes if treetop.get(node) is None]
+        if not server_nodes:
+            return self._resolved_future([treetop.get(node) for node in nodes], callback)
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        def resolve(read):
+            try:
+                buckets = dict(zip(server_nodes, read.result()))
+            except Exception as e:
+                future.set_exception(e)
+                return
+            for node in server_nodes:
+                if node in treetop:
+                    treetop.load(node, buckets[node])
+            future.set_result([buckets[node] if node in buckets else treetop.get(node)
+                               for node in nodes])
+
+        server_connection.read_path_async(self.server_tree_name, server_nodes, resolve)
+        return future
+
+    def write_path(self, nodes, buckets=None):
+        """
+        Uploads many PathORAM Tree nodes to the server's cloud in a single round trip
+        :param nodes: nodes in the PathORAM Tree
+        :param buckets: the encrypted buckets of the nodes in the same order, where None (or no
+        buckets at all) stands for a bucket of dummies
+        :return:
+        """
+        self.write_path_async(nodes, buckets).result()
+
+    def write_path_async(self, nodes, buckets=None, callback=None):
+        """
+        Uploads many PathORAM Tree nodes to the server's cloud in a single round trip, without
+        waiting for the server to acknowledge them
+        :param nodes: nodes in the PathORAM Tree
+        :param buckets: the encrypted buckets of the nodes in the same order, where None (or no
+        buckets at all) stands for a bucket of dummies
+        :param callback: a function called with the future once it is resolved
+        :return: a future which is resolved once the buckets are written
+        """
+        if buckets is None:
+            buckets = [None] * len(nodes)
+        buckets = [self.create_dummy_data() if bucket is None else bucket for bucket in buckets]
+        nodes = list(nodes)
+        if self.treetop is not None:
+            # The buckets of the treetop cache are kept by the client until it is flushed
+            server_buckets = [(node, bucket) for node, bucket in zip(nodes, buckets)
+                              if node not in self.treetop]
+            for node, bucket in zip(nodes, buckets):
+                if node in self.treetop:
+                    self.treetop.write(node, bucket)
+            if not server_buckets:
+                return self._resolved_future(None, callback)
+            nodes, buckets = map(list, zip(*server_buckets))
+        return server_connection.write_path_async(self.server_tree_name, nodes, buckets, callback)
+
+    def access_path(self, nodes, write_back):
+        """
+        Downloads PathORAM Tree nodes from the server's cloud and uploads them back over the same
+        connection, without waiting for the server to acknowledge the upload
+        :param nodes: nodes in the PathORAM Tree
+        :param write_back: a function from the encrypted buckets of the nodes to their new
+        encrypted buckets, in the same order
+        :return: a future which is resolved once the buckets are written
+        """
+        if self.treetop is None:
+            return server_connection.access_path(self.server_tree_name, list(nodes), write_back)
+        buckets = write_back(self.read_path(nodes))
+        if len(buckets) != len(nodes):
+            raise ServerConnectionError("Amount of buckets does not match the amount of nodes.")
+        return self.write_path_async(nodes, buckets)
+
+    @classmethod
+    def _resolved_future(cls, result, callback=None):
+        """
+        Returns a future which is already resolved, of a request the server is not involved in
+        :param result: the result of the future
+        :param callback: a function called with the future
+        :return: the future
+        """
+        future = Future()
+        future.set_result(result)
+        if callback is not None:
+            callback(future)
+        return future
+
+    def cache_treetop(self, node_count):
+        """
+        Keeps the buckets of the top nodes of the tree in the client's memory, so they are not
+        transferred on every access. The cache is shared by every Cloud of the tree, and the
+        buckets written to it are uploaded to the server once it is flushed, at the end of every
+        command and on exit at the latest
+        :param node_count: the amount of top nodes to cache, 0 for none
         :return:
         """
-        if content is None:
-            content = self.create_dummy_data()
-        self.file_upload(content, node)
+        treetop = self._treetop_caches.get(self.server_tree_name)
+        if treetop is not None and treetop.node_count == node_count:
+            self.treetop = treetop
+            return
+        if treetop is not None:
+            # The cache is replaced by a cache of other nodes, hence its buckets reach the server
+            self._flush_treetop(self.server_tree_name, treetop)
+            del self._treetop_caches[self.server_tree_name]
+        self.treetop = None
+        if node_count:
+            if not self._treetop_caches:
+                atexit.register(Cloud.flush_treetop)
+            logger.info(f"CACHE THE TOP {node_count} NODES OF THE TREE {self.server_tree_name!r}")
+            self.treetop = TreetopCache(node_count)
+            self._treetop_caches[self.server_tree_name] = self.treetop
 
-    def file_upload(self, content, block):
+    @classmethod
+    def _flush_treetop(cls, server_tree_name, treetop):
         """
-        Uploads a data block to the server
-        :param content: the content we want in the data block
-        :param block: a string representing the data block
+        Uploads the buckets written to a treetop cache since it was last flushed
+        :param server_tree_name: the name of the tree on the server
+        :param treetop: the treetop cache of the tree
         :return:
         """
-        server_connection.file_upload(content, self.get_path_to_file(block))
+        nodes, buckets = treetop.get_dirty()
+        if not nodes:
+            return
+        logger.info(f"FLUSH {len(nodes)} CACHED NODES OF THE TREE {server_tree_name!r}")
+        futures = list()
+        for position in range(0, len(nodes), utils.SETUP_BATCH_SIZE):
+            batch = slice(position, position + utils.SETUP_BATCH_SIZE)
+            futures.append(server_connection.write_path_async(server_tree_name, nodes[batch],
+                                                              buckets[batch]))
+        for future in futures:
+            future.result()
+        treetop.mark_clean(nodes)
 
+    @classmethod
+    def flush_treetop(cls):
+        """
+        Uploads the buckets written to the treetop caches of every tree since they were last
+        flushed, so the server keeps the whole tree
+        :return:
+        """
+        for server_tree_name, treetop in cls._treetop_caches.items():
+            cls._flush_treetop(server_tree_name, treetop)
+
+    @classmethod
+    def flush(cls):
+        """
+        Waits for every request in flight to the server's cloud, raising the error of a failed one
+        :return:
+        """
+        server_connection.flush()
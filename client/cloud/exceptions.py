@@ -2,3 +2,9 @@ class ErrorInCloudMap(Exception):
     def __init__(self, message, cause=None):
         super(ErrorInCloudMap, self).__init__(message)
         self._cause = cause
+
+
+class ServerConnectionError(Exception):
+    def __init__(self, message, cause=None):
+        super(ServerConnectionError, self).__init__(message)
+        self._cause = cause
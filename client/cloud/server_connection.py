@@ -1,70 +1,386 @@
+import collections
 import socket
-import tqdm
-import os
+import struct
+import threading
 import time
+from concurrent.futures import Future
 
-import client.data as data
+import client.log as log
+import client.config as config
 import client.cloud.utils as utils
+from client.cloud.exceptions import ServerConnectionError
 
-CLIENT_DIR = data.BASE_DIR
-SEPARATOR = "<THIS_TEXT_JUST_DISTINGUISH_TEXTS>"
-
-
-def socket_connect():
-    global s
-    ip = "127.0.0.1"
-    port = 1234
-    s = socket.socket()
-    s.connect((ip, port))
-
-
-def file_upload(content, filename):
-    filename = os.path.join(CLIENT_DIR, filename)
-    with open(filename, 'wb') as f:
-        f.write(content)
-    size = os.path.getsize(filename)
-    s.send(bytes("upload", "utf-8"))
-    s.send(f"{filename}{SEPARATOR}{size}".encode())
-    upload_bar = tqdm.tqdm(range(int(size)), f"Sending {filename}", unit="B", unit_scale=True,
-                           unit_divisor=1024)
-    f = open(filename, 'rb')
-    f.seek(utils.FILE_BEGIN)
-    terminated = False
-    while not terminated:
-        data = f.read(4096)
-        if not data:
+logger = log.get_logger(__name__)
+
+FRAME_HEADER_SIZE = struct.calcsize(utils.FRAME_HEADER_FORMAT)
+NODE_ID_SIZE = struct.calcsize(utils.NODE_ID_FORMAT)
+BUCKET_LENGTH_SIZE = struct.calcsize(utils.BUCKET_LENGTH_FORMAT)
+
+
+def unpack_buckets(payload):
+    """
+    Unpacks the buckets of the payload of a frame, without copying them
+    :param payload: the payload
+    :return: the buckets, as views of the payload
+    """
+    payload = memoryview(payload)
+    buckets = list()
+    offset = 0
+    while offset < len(payload):
+        length, = struct.unpack_from(utils.BUCKET_LENGTH_FORMAT, payload, offset)
+        offset += BUCKET_LENGTH_SIZE
+        buckets.append(payload[offset:offset + length])
+        offset += length
+    return buckets
+
+
+class ServerConnection:
+    """
+    A persistent connection to the server, over which many requests may be in flight at once.
+    Every request is a single frame answered by a single frame tagged with the same request ID,
+    where the responses may arrive out of order. The responses are read by a background thread
+    which resolves the future of each request. Once the connection fails, it is reopened with an
+    exponential backoff and the unanswered requests are sent again, in their original order
+    """
+    def __init__(self, address=(config.SERVER_IP, config.SERVER_PORT),
+                 timeout=utils.CONNECTION_TIMEOUT, window=config.PIPELINE_WINDOW):
+        self.address = address
+        self.timeout = timeout
+        self.socket = None
+        self.request_id = 0
+        # request ID -> (frame, parse, future) of the unanswered requests, in the order sent
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.window = threading.BoundedSemaphore(window)
+
+    def _connect(self):
+        """
+        Connects to the server and sends the unanswered requests again. Must be called while
+        holding the lock
+        :return:
+        """
+        s = socket.create_connection(self.address, self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for frame, _, _ in self.pending.values():
+            s.sendall(frame)
+        self.socket = s
+        threading.Thread(target=self._read_responses, args=(s,), daemon=True).start()
+
+    def close(self):
+        """
+        Closes the connection to the server
+        :return:
+        """
+        with self.lock:
+            s, self.socket = self.socket, None
+        if s is not None:
             s.close()
-            time.sleep(0.5)
-            socket_connect()
-            terminated = True
-        s.sendall(data)
-        upload_bar.update(len(data))
-    f.close()
-    os.remove(filename)
-
-
-def file_download(filename):
-    s.send(bytes("download", "utf-8"))
-    s.send(bytes(filename, "utf-8"))
-    data = s.recv(4096).decode()
-    filename, size = data.split(SEPARATOR)
-    filename = os.path.basename(filename)
-    upload_bar = tqdm.tqdm(range(int(size)), f"Receiving {filename}", unit="B", unit_scale=True,
-                           unit_divisor=1024)
-    tmp_filename = os.path.join(CLIENT_DIR, 'tmp')
-    f = open(tmp_filename, 'wb')
-    while True:
-        data = s.recv(4096)
-        if not data:
-            time.sleep(0.1)
-            socket_connect()
-            break
-        f.write(data)
-        upload_bar.update(len(data))
-    f.close()
-    f = open(tmp_filename, 'rb')
-    f.seek(utils.FILE_BEGIN)
-    data = f.read()
-    f.close()
-    os.remove(tmp_filename)
-    return data
+
+    def _recover(self, failed_socket, error):
+        """
+        Reopens a failed connection with an exponential backoff, failing every unanswered request
+        if the server cannot be reached
+        :param failed_socket: the socket of the failed connection
+        :param error: the error the connection failed with
+        :return:
+        """
+        with self.lock:
+            if self.socket is not failed_socket:
+                # The connection was already reopened or closed
+                return
+            self.socket = None
+        if failed_socket is not None:
+            failed_socket.close()
+
+        backoff = utils.RETRY_BACKOFF
+        for _ in range(utils.MAX_RETRIES):
+            logger.warning(f"CONNECTION FAILED ({error}) - RETRYING IN {backoff} SECONDS")
+            time.sleep(backoff)
+            backoff *= 2
+            with self.lock:
+                if self.socket is not None or not self.pending:
+                    return
+                try:
+                    self._connect()
+                    return
+                except OSError as e:
+                    error = e
+
+        with self.lock:
+            failed = list(self.pending.values())
+            self.pending.clear()
+        for _, _, future in failed:
+            self.window.release()
+            future.set_exception(ServerConnectionError("Could not reach the server.", error))
+
+    @classmethod
+    def _recv_into(cls, s, buffer):
+        """
+        Fills a buffer with bytes received from the server
+        :param s: the socket of the connection
+        :param buffer: a preallocated buffer
+        :return: the buffer
+        """
+        view = memoryview(buffer)
+        while view:
+            received = s.recv_into(view)
+            if not received:
+                raise ConnectionError("Server closed the connection.")
+            view = view[received:]
+        return buffer
+
+    def _recv_frame(self, s):
+        """
+        Receives a frame from the server. Waiting for a frame times out only if some request is
+        unanswered, and no request creating or growing a tree is, as the server may take far
+        longer to answer it and every following request
+        :param s: the socket of the connection
+        :return: tuple (opcode, request_id, payload)
+        """
+        header = bytearray(FRAME_HEADER_SIZE)
+        while True:
+            try:
+                received = s.recv_into(header)
+                break
+            except socket.timeout:
+                with self.lock:
+                    # The opcode of a request is the second byte of its frame
+                    if self.pending and all(frame[1] not in utils.LONG_OPCODES
+                                            for frame, _, _ in self.pending.values()):
+                        raise
+        if not received:
+            raise ConnectionError("Server closed the connection.")
+        self._recv_into(s, memoryview(header)[received:])
+        version, opcode, request_id, tree_name_length, node_count, payload_length = \
+            struct.unpack(utils.FRAME_HEADER_FORMAT, header)
+        if version != utils.PROTOCOL_VERSION:
+            raise ConnectionError(f"Server speaks protocol version {version}.")
+        # The tree name and the node IDs of a response are not needed
+        self._recv_into(s, bytearray(tree_name_length + node_count * NODE_ID_SIZE))
+        return opcode, request_id, self._recv_into(s, bytearray(payload_length))
+
+    def _read_responses(self, s):
+        """
+        Reads the responses of a connection and resolves the futures of their requests, until the
+        connection fails or is closed
+        :param s: the socket of the connection
+        :return:
+        """
+        while True:
+            try:
+                opcode, request_id, payload = self._recv_frame(s)
+            except OSError as e:
+                self._recover(s, e)
+                return
+            with self.lock:
+                request = self.pending.pop(request_id, None)
+            if request is None:
+                # A response to a request which was already answered before the connection failed
+                continue
+            self.window.release()
+            _, parse, future = request
+            if opcode == utils.ERROR_OPCODE:
+                future.set_exception(ServerConnectionError(
+                    f"Server failed the request: {bytes(payload).decode()}"))
+                continue
+            try:
+                future.set_result(parse(payload) if parse is not None else payload)
+            except Exception as e:
+                future.set_exception(e)
+
+    @classmethod
+    def _pack_frame(cls, opcode, request_id, tree_name, nodes, buckets):
+        """
+        Packs a request into a frame, copying every bucket once into a preallocated buffer which
+        is sent as a whole
+        :param opcode: the opcode of the request
+        :param request_id: the ID of the request
+        :param tree_name: the name of the tree the nodes belong to
+        :param nodes: node IDs
+        :param buckets: the buckets of the payload
+        :return: the frame
+        """
+        tree_name = tree_name.encode()
+        payload_length = sum(BUCKET_LENGTH_SIZE + len(bucket) for bucket in buckets)
+        frame = bytearray(FRAME_HEADER_SIZE + len(tree_name) + len(nodes) * NODE_ID_SIZE +
+                          payload_length)
+        struct.pack_into(utils.FRAME_HEADER_FORMAT, frame, 0, utils.PROTOCOL_VERSION, opcode,
+                         request_id, len(tree_name), len(nodes), payload_length)
+        offset = FRAME_HEADER_SIZE
+        frame[offset:offset + len(tree_name)] = tree_name
+        offset += len(tree_name)
+        for node in nodes:
+            struct.pack_into(utils.NODE_ID_FORMAT, frame, offset, node)
+            offset += NODE_ID_SIZE
+        for bucket in buckets:
+            struct.pack_into(utils.BUCKET_LENGTH_FORMAT, frame, offset, len(bucket))
+            offset += BUCKET_LENGTH_SIZE
+            frame[offset:offset + len(bucket)] = bucket
+            offset += len(bucket)
+        return frame
+
+    def submit(self, opcode, tree_name, nodes, buckets=(), parse=None, callback=None):
+        """
+        Sends a request without waiting for its response. Once the window of requests in flight is
+        full, waits for a response first
+        :param opcode: the opcode of the request
+        :param tree_name: the name of the tree the nodes belong to
+        :param nodes: node IDs
+        :param buckets: the buckets of the payload of the request
+        :param parse: a function from the payload of the response to the result of the future
+        :param callback: a function called with the future once it is resolved, from the thread
+        reading the responses, hence it must not wait for other requests
+        :return: a future of the result
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        self.window.acquire()
+        with self.lock:
+            self.request_id = (self.request_id + 1) % (1 << 32)
+            frame = self._pack_frame(opcode, self.request_id, tree_name, nodes, buckets)
+            self.pending[self.request_id] = frame, parse, future
+            s = self.socket
+            try:
+                if s is None:
+                    self._connect()
+                else:
+                    s.sendall(frame)
+                return future
+            except OSError as e:
+                error = e
+        self._recover(s, error)
+        return future
+
+    def request(self, opcode, tree_name, nodes, buckets=(), parse=None):
+        """
+        Sends a request and waits for its response
+        :param opcode: the opcode of the request
+        :param tree_name: the name of the tree the nodes belong to
+        :param nodes: node IDs
+        :param buckets: the buckets of the payload of the request
+        :param parse: a function from the payload of the response to the result
+        :return: the result
+        """
+        return self.submit(opcode, tree_name, nodes, buckets, parse).result()
+
+    def flush(self):
+        """
+        Waits for the responses of every request in flight
+        :return:
+        """
+        with self.lock:
+            futures = [future for _, _, future in self.pending.values()]
+        for future in futures:
+            future.result()
+
+
+_connection = ServerConnection()
+
+
+def _parse_buckets(nodes):
+    """
+    Returns a function from the payload of a response to the buckets of the given nodes
+    :param nodes: node IDs
+    :return: the function
+    """
+    def parse(payload):
+        buckets = unpack_buckets(payload)
+        if len(buckets) != len(nodes):
+            raise ServerConnectionError("Amount of buckets does not match the amount of nodes.")
+        return buckets
+    return parse
+
+
+def read_path_async(tree_name, nodes, callback=None):
+    """
+    Downloads the buckets of many nodes in a single round trip, without waiting for them
+    :param tree_name: the name of the tree the nodes belong to
+    :param nodes: node IDs
+    :param callback: a function called with the future once it is resolved
+    :return: a future of the buckets of the nodes, in the same order
+    """
+    return _connection.submit(utils.READ_PATH_OPCODE, tree_name, nodes,
+                              parse=_parse_buckets(nodes), callback=callback)
+
+
+def write_path_async(tree_name, nodes, buckets, callback=None):
+    """
+    Uploads the buckets of many nodes in a single round trip, without waiting for the server to
+    acknowledge them. The server applies requests on the same nodes in the order they were sent
+    :param tree_name: the name of the tree the nodes belong to
+    :param nodes: node IDs
+    :param buckets: the buckets of the nodes, in the same order
+    :param callback: a function called with the future once it is resolved
+    :return: a future which is resolved once the buckets are written
+    """
+    return _connection.submit(utils.WRITE_PATH_OPCODE, tree_name, nodes, buckets,
+                              callback=callback)
+
+
+def read_path(tree_name, nodes):
+    """
+    Downloads the buckets of many nodes in a single round trip
+    :param tree_name: the name of the tree the nodes belong to
+    :param nodes: node IDs
+    :return: the buckets of the nodes, in the same order
+    """
+    return read_path_async(tree_name, nodes).result()
+
+
+def write_path(tree_name, nodes, buckets):
+    """
+    Uploads the buckets of many nodes in a single round trip
+    :param tree_name: the name of the tree the nodes belong to
+    :param nodes: node IDs
+    :param buckets: the buckets of the nodes, in the same order
+    :return:
+    """
+    write_path_async(tree_name, nodes, buckets).result()
+
+
+def create_tree(tree_name, node_count, bucket_size):
+    """
+    Creates the storage of a tree on the server, in which every bucket has the same size
+    :param tree_name: the name of the tree
+    :param node_count: the amount of nodes of the tree
+    :param bucket_size: the size of a bucket
+    :return:
+    """
+    _connection.request(utils.CREATE_TREE_OPCODE, tree_name, list(),
+                        [struct.pack(utils.CREATE_TREE_FORMAT, node_count, bucket_size)])
+
+
+def grow_tree(tree_name, node_count, bucket_size):
+    """
+    Grows the storage of a tree on the server, keeping the buckets of the existing nodes
+    :param tree_name: the name of the tree
+    :param node_count: the amount of nodes of the grown tree
+    :param bucket_size: the size of a bucket
+    :return:
+    """
+    _connection.request(utils.GROW_TREE_OPCODE, tree_name, list(),
+                        [struct.pack(utils.CREATE_TREE_FORMAT, node_count, bucket_size)])
+
+
+def access_path(tree_name, nodes, write_back):
+    """
+    Downloads the buckets of many nodes and uploads them back. The client does not wait for the
+    buckets to be written, as following reads of the same nodes are answered only after it
+    :param tree_name: the name of the tree the nodes belong to
+    :param nodes: node IDs
+    :param write_back: a function from the downloaded buckets to their new buckets
+    :return: a future which is resolved once the buckets are written
+    """
+    buckets = write_back(read_path(tree_name, nodes))
+    if len(buckets) != len(nodes):
+        raise ServerConnectionError("Amount of buckets does not match the amount of nodes.")
+    return write_path_async(tree_name, nodes, buckets)
+
+
+def flush():
+    """
+    Waits for every request in flight, raising the error of a failed one
+    :return:
+    """
+    _connection.flush()
@@ -0,0 +1,68 @@
+class TreetopCache:
+    """
+    The encrypted buckets of the top levels of a tree, kept by the client instead of being
+    transferred on every access. A bucket is downloaded once, the first time it is read, and the
+    buckets written since are uploaded to the server only once the cache is flushed
+    """
+    def __init__(self, node_count):
+        # The nodes below node_count are cached
+        self.node_count = node_count
+        # node -> the encrypted bucket of the node, of the nodes downloaded or written so far
+        self.buckets = dict()
+        # The nodes whose buckets were written since the last flush
+        self.dirty_nodes = set()
+
+    def __contains__(self, node):
+        return node < self.node_count
+
+    @property
+    def size(self):
+        """
+        Returns the memory the buckets of the cache take in terms of bytes
+        :return: the memory the buckets of the cache take in terms of bytes
+        """
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def get(self, node):
+        """
+        Returns the encrypted bucket of a cached node
+        :param node: a cached node
+        :return: the encrypted bucket of the node, None if it was not downloaded yet
+        """
+        return self.buckets.get(node)
+
+    def load(self, node, bucket):
+        """
+        Keeps the bucket of a cached node as downloaded from the server
+        :param node: a cached node
+        :param bucket: the encrypted bucket of the node
+        :return:
+        """
+        # The bucket is copied, as a view would keep the whole response it is part of alive
+        self.buckets[node] = bytes(bucket)
+
+    def write(self, node, bucket):
+        """
+        Writes the bucket of a cached node, which reaches the server once the cache is flushed
+        :param node: a cached node
+        :param bucket: the encrypted bucket of the node
+        :return:
+        """
+        self.buckets[node] = bytes(bucket)
+        self.dirty_nodes.add(node)
+
+    def get_dirty(self):
+        """
+        Returns the buckets written since the last flush
+        :return: tuple (the nodes, the encrypted buckets of the nodes in the same order)
+        """
+        nodes = sorted(self.dirty_nodes)
+        return nodes, [self.buckets[node] for node in nodes]
+
+    def mark_clean(self, nodes):
+        """
+        Marks the buckets of nodes as uploaded to the server
+        :param nodes: cached nodes
+        :return:
+        """
+        self.dirty_nodes.difference_update(nodes)
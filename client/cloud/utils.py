@@ -1,3 +1,5 @@
+import os
+
 WRITE_MODE = 'w'
 READ_MODE = 'r'
 READ_WRITE_MODE = 'r+'
@@ -7,8 +9,47 @@ CLOUD_MAP_FILE_NAME = 'cloud.map'
 JSON_TOKEN = 'token'
 JSON_INIT = 'init'
 TOKEN_PLACEHOLDER = 'My token'
-FILE_NAME = 'block%d.oram'
+TREE_JSON_INIT = '%s_init'
+JSON_INIT_PROGRESS = '%s_progress'
+JSON_CIPHER_SUITE = '%s_cipher_suite'
+JSON_ENGINE_STATE = '%s_engine_state'
+JSON_GROW_PROGRESS = '%s_grow_progress'
+# The cipher suite of trees which were set up before the cipher suites were recorded
+LEGACY_CIPHER_SUITE = 'aes-cbc-hmac'
 
 FILE_BEGIN = 0
 
 JSON_INDENT = 4
+
+# The seconds to wait for the server before the request is retried. Creating or growing a tree
+# may take far longer, hence the connection does not time out while such a request is unanswered
+CONNECTION_TIMEOUT = 10
+# The amount of times a failed request is retried, waiting twice as long before each retry
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.1
+
+# Every message is a frame - a header, followed by the tree name, the node IDs and the payload. The
+# header is (protocol version, opcode, request ID, tree name length, node count, payload length)
+PROTOCOL_VERSION = 1
+FRAME_HEADER_FORMAT = '>BBIBIQ'
+NODE_ID_FORMAT = '>Q'
+# The payload of buckets is the buckets, each prefixed by its length
+BUCKET_LENGTH_FORMAT = '>I'
+
+# Opcodes of requests
+READ_PATH_OPCODE = 1
+WRITE_PATH_OPCODE = 2
+CREATE_TREE_OPCODE = 3
+GROW_TREE_OPCODE = 4
+# Opcodes of requests which may take longer than CONNECTION_TIMEOUT
+LONG_OPCODES = (CREATE_TREE_OPCODE, GROW_TREE_OPCODE)
+# The payload of creating or growing a tree - (node count, bucket size)
+CREATE_TREE_FORMAT = '>QI'
+# Opcodes of responses
+OK_OPCODE = 128
+ERROR_OPCODE = 129
+
+# The amount of buckets uploaded in a single message while setting up the cloud
+SETUP_BATCH_SIZE = 64
+# The amount of threads encrypting the buckets while setting up the cloud
+SETUP_WORKERS = os.cpu_count() or 1
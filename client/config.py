@@ -1,26 +1,182 @@
 import math
+import os
 import random
 
+import client.deployment as deployment
+
+# The per-deployment configuration, which overrides the defaults of the geometry of the tree and
+# of the server address once the cloud is set up
+_deployment = deployment.load_deployment()
+
 # Block size of the chunk files in terms of bytes
-BLOCK_SIZE = 32768
+BLOCK_SIZE = _deployment.get(deployment.JSON_BLOCK_SIZE, 32768)
+
+# The amount of data blocks each node (bucket) of the tree contains, known as Z
+BUCKET_CAPACITY = _deployment.get(deployment.JSON_BUCKET_CAPACITY, 4)
+
+# The storage a new deployment is set up for in terms of bytes, and the fraction of the slots of
+# the tree which may hold data blocks, as the stash overflows in a tree which is too full
+TARGET_CAPACITY = 512 * 1024
+LOAD_FACTOR = 0.5
+
+
+# Whether the tree grows by a level once a file does not fit in config.LOAD_FACTOR of its capacity,
+# instead of the upload failing
+AUTO_GROW = True
+
+
+def get_height_for_capacity(capacity, load_factor=LOAD_FACTOR):
+    """
+    Returns the height of the smallest tree which stores a given capacity
+    :param capacity: the capacity in terms of bytes
+    :param load_factor: the fraction of the slots of the tree which may hold data blocks
+    :return: the height of the tree
+    """
+    height = 0
+    while (math.pow(2, height + 1) - 1) * BUCKET_CAPACITY * BLOCK_SIZE * load_factor < capacity:
+        height += 1
+    return height
+
 
-# The height of the binary tree (as integer)
-ORAM_HEIGHT = 3
+# The height of the binary tree (as integer). A deployment may grow its tree online, which updates
+# the height at runtime
+ORAM_HEIGHT = _deployment.get(deployment.JSON_HEIGHT, get_height_for_capacity(TARGET_CAPACITY))
 
-# Numbering the leaves of the tree
+# Numbering the leaves of the tree, as it was set up
 MIN_LEAF = int(math.pow(2, ORAM_HEIGHT) - 1)
 MAX_LEAF = int(math.pow(2, ORAM_HEIGHT + 1) - 2)
 
 # for packing the data id
 FORMAT_CHAR = '>Q'
 
+# for packing the data id together with the leaf the data block is mapped unto
+HEADER_FORMAT_CHAR = '>Qi'
+
 # dummy data id
 DUMMY_ID = 999999999999999
 
+# The ORAM protocol of the tree - 'path' for Path ORAM, or 'ring' for Ring ORAM, which reads a
+# single data block of every bucket on an access. The trees of the engines are kept apart on the
+# server, so a deployment keeps the engine it was set up with
+ORAM_ENGINE = _deployment.get(deployment.JSON_ORAM_ENGINE, 'path')
+
+# The amount of dummy slots of a bucket of Ring ORAM, known as S. A bucket is reshuffled once it
+# was read S times since it was written
+RING_ORAM_DUMMY_SLOTS = 5
+
+# The amount of accesses to Ring ORAM between evictions, known as A
+RING_ORAM_EVICTION_RATE = 3
+
+# The cipher suite new data blocks and new PathORAM Trees are encrypted with - 'aes-gcm',
+# 'chacha20-poly1305' or 'aes-cbc-hmac'. A tree keeps the suite it was set up with
+CIPHER_SUITE = 'aes-gcm'
+
+# The maximal size of the data blocks the stash keeps in memory in terms of bytes, beyond which
+# data blocks are spilled to disk
+STASH_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# Whether the position map is stored recursively in smaller PathORAM Trees on the server,
+# instead of entirely on the client
+POSITION_MAP_RECURSION = False
+
+# The maximal amount of position map entries kept on the client - a larger position map is
+# packed into blocks and stored in a smaller PathORAM Tree
+POSITION_MAP_RECURSION_CUTOFF = 4096
+
+# The amount of data IDs the recursive position map addresses - twice the capacity of the tree the
+# deployment was set up with. It doubles once a data ID exceeds it, and it grows with the tree
+POSITION_MAP_ADDRESS_SPACE = _deployment.get(deployment.JSON_POSITION_MAP_ADDRESS_SPACE,
+                                             2 * BUCKET_CAPACITY *
+                                             int(math.pow(2, ORAM_HEIGHT + 1) - 1))
+
+# The amount of levels of trees whose position map is stored recursively. It is fixed once the
+# deployment is set up, None until then
+POSITION_MAP_LEVELS = _deployment.get(deployment.JSON_POSITION_MAP_LEVELS)
+
+# The amount of top levels of every tree whose buckets the client keeps in memory instead of
+# transferring them on every access, 0 for none. The buckets written to them reach the server at the
+# end of every command, before the stash is saved
+TREETOP_CACHE_LEVELS = 0
+
+# The maximal memory the cached buckets of a tree take in terms of bytes, within which as many of
+# config.TREETOP_CACHE_LEVELS levels as fit are cached
+TREETOP_CACHE_MEMORY_LIMIT = 64 * 1024 * 1024
+
+# The amount of data blocks whose paths are accessed together, reading and writing back the
+# buckets the paths share once
+ACCESS_BATCH_SIZE = 8
+
+# Whether uploading and downloading many data blocks pipelines their accesses, downloading the
+# nodes of an access while the previous access evicts the stash and writes its nodes back
+PIPELINED_ACCESS = True
+
+# The amount of threads encrypting and decrypting the buckets of a path in parallel
+CRYPTO_WORKERS = os.cpu_count() or 1
+
+# Whether files are uploaded as they are read, a window of data blocks at a time, instead of
+# being split entirely into the stash first (in parallel, for large files) and uploaded afterwards
+STREAMING_UPLOAD = True
+
+# The amount of data blocks read into the stash before their paths are accessed, while streaming
+UPLOAD_WINDOW = 16
+
+# Whether downloaded data blocks are written straight to the file on the disk, instead of being
+# joined in memory first
+STREAMING_DOWNLOAD = True
+
+# Whether a chunk of a file whose content is already stored (by any file) references the stored
+# data block instead of being stored again. Chunks are matched by a keyed fingerprint which never
+# leaves the client, but the server may tell a file shares content by the fewer accesses of its
+# upload
+DEDUPLICATION = False
+
+# The codec files are compressed with before they are split into data blocks - 'zlib', 'lzma',
+# 'bz2' or 'none'. A file may be uploaded with a codec of its own
+COMPRESSION = 'none'
+
+# The maximal ratio of the compressed size of a file to its size, beyond which the file is stored
+# uncompressed, as estimated by compressing config.COMPRESSION_SAMPLE_SIZE bytes of its beginning
+COMPRESSION_MAX_RATIO = 0.9
+COMPRESSION_SAMPLE_SIZE = 1024 * 1024
+
+# The amount of processes splitting and encrypting a large file in parallel
+SPLIT_WORKERS = os.cpu_count() or 1
+
+# The minimal size of a file in terms of bytes, from which it is split in parallel
+PARALLEL_SPLIT_MIN_SIZE = 64 * 1024 * 1024
+
+# The amount of data blocks a process encrypts at a time while splitting in parallel
+SPLIT_BATCH_SIZE = 64
+
+# The maximal amount of requests in flight over the connection to the server
+PIPELINE_WINDOW = 16
+
+# The address of the server
+SERVER_IP = _deployment.get(deployment.JSON_SERVER_IP, '127.0.0.1')
+SERVER_PORT = _deployment.get(deployment.JSON_SERVER_PORT, 1234)
+
+
+def get_deployment():
+    """
+    Returns the per-deployment configuration of the running client
+    :return: the configuration
+    """
+    return {deployment.JSON_HEIGHT: ORAM_HEIGHT,
+            deployment.JSON_BLOCK_SIZE: BLOCK_SIZE,
+            deployment.JSON_BUCKET_CAPACITY: BUCKET_CAPACITY,
+            deployment.JSON_ORAM_ENGINE: ORAM_ENGINE,
+            deployment.JSON_POSITION_MAP_ADDRESS_SPACE: POSITION_MAP_ADDRESS_SPACE,
+            deployment.JSON_POSITION_MAP_LEVELS: POSITION_MAP_LEVELS,
+            deployment.JSON_SERVER_IP: SERVER_IP,
+            deployment.JSON_SERVER_PORT: SERVER_PORT}
+
 
-def get_random_leaf_id():
+def get_random_leaf_id(height=None):
     """
     Generates random leaf ID
+    :param height: the height of the tree, the height of the main tree by default
     :return:
     """
-    return random.randrange(MIN_LEAF, MAX_LEAF + 1)
+    if height is None:
+        height = ORAM_HEIGHT
+    return random.randrange(int(math.pow(2, height) - 1), int(math.pow(2, height + 1) - 1))
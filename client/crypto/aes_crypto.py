@@ -3,23 +3,24 @@ import os
 import struct
 
 import six
-from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.hmac import HMAC
+from cryptography.hazmat.primitives import hashes, hmac
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap, InvalidUnwrap
 
 import client.config as config
 import client.crypto.utils as utils
 from client.crypto.key_map import KeyMap
+from client.crypto.cipher_suite import CIPHER_SUITES, get_cipher_suite_class
 from client.crypto.exceptions import WrongPassword, DummyFileFound, InvalidToken
 
+BLOCK_HEADER_SIZE = struct.calcsize(config.HEADER_FORMAT_CHAR)
+
 
 class AESCryptography():
     """
-    A cryptographic object for encrypting and decrypting data blocks
+    A cryptographic object for encrypting and decrypting data blocks. Tokens carry the cipher suite
+    they were encrypted with in their header, so tokens of every suite can be decrypted
     """
     def __init__(self, key_file, password, backend=None):
         if backend is None:
@@ -33,9 +34,23 @@ class AESCryptography():
             raise ValueError(utils.LENGTH_ERR_MSG % ("Salt", utils.SALT_LENGTH))
 
         master_key = self._generate_key(password, salt)
-        self.aes_key = self._unwrap_key(master_key, wrapped_aes_key)
-        self.mac_key = self._unwrap_key(master_key, wrapped_mac_key)
+        self._set_keys(self._unwrap_key(master_key, wrapped_aes_key),
+                       self._unwrap_key(master_key, wrapped_mac_key), backend)
+
+    def _set_keys(self, aes_key, mac_key, backend):
+        """
+        Sets the unwrapped keys and the cipher suites using them
+        :param aes_key: the AES key
+        :param mac_key: the MAC key
+        :param backend: the backend of the cryptography package
+        :return:
+        """
+        self.aes_key = aes_key
+        self.mac_key = mac_key
         self.backend = backend
+        # The key of the fingerprints of data blocks, which is derived from the MAC key so the
+        # fingerprints are not MACs the cipher suites produce
+        self.fingerprint_key = self._hmac(self.mac_key, utils.FINGERPRINT_KEY_LABEL)
 
         if len(self.aes_key) != utils.AES_LENGTH:
             raise ValueError(utils.LENGTH_ERR_MSG % ("AES", utils.AES_LENGTH))
@@ -43,32 +58,52 @@ class AESCryptography():
         if len(self.aes_key) != utils.MAC_LENGTH:
             raise ValueError(utils.LENGTH_ERR_MSG % ("MAC", utils.MAC_LENGTH))
 
+        # suite name -> cipher suite
+        self.cipher_suites = {suite_class.NAME: suite_class(self.aes_key, self.mac_key, backend)
+                              for suite_class in CIPHER_SUITES}
+        # suite ID -> cipher suite, for the suites whose tokens carry their ID
+        self.aead_suites = {suite.SUITE_ID: suite for suite in self.cipher_suites.values()
+                            if suite.SUITE_ID is not None}
+        self.cipher_suite = get_cipher_suite_class(config.CIPHER_SUITE).NAME
+
     @classmethod
-    def _add_padding(cls, plaintext, block_size):
+    def from_keys(cls, aes_key, mac_key, backend=None):
         """
-        Added padding to a plaintext
-        :param plaintext: a plaintext
-        :param block_size: AES block size
-        :return:
+        Creates a cryptographic object from keys which were already unwrapped
+        :param aes_key: the AES key
+        :param mac_key: the MAC key
+        :param backend: the backend of the cryptography package
+        :return: the cryptographic object
         """
-        padder = padding.PKCS7(block_size).padder()
-        return padder.update(plaintext) + padder.finalize()
+        aes_crypto = cls.__new__(cls)
+        aes_crypto._set_keys(aes_key, mac_key, backend if backend is not None else
+                             default_backend())
+        return aes_crypto
 
-    @classmethod
-    def _remove_padding(cls, padded_plaintext, block_size):
+    def _hmac(self, key, data):
         """
-        Removes padding from a padded plaintext
-        :param padded_plaintext: a padded plaintext
-        :param block_size: AES block size
-        :return:
+        Computes HMAC-SHA256 of data
+        :param key: the key
+        :param data: the data
+        :return: the MAC
         """
-        unpadder = padding.PKCS7(block_size).unpadder()
-        plaintext = unpadder.update(padded_plaintext)
-        try:
-            plaintext += unpadder.finalize()
-        except ValueError:
-            raise InvalidToken
-        return plaintext
+        mac = hmac.HMAC(key, hashes.SHA256(), backend=self.backend)
+        mac.update(data)
+        return mac.finalize()
+
+    def fingerprint(self, data):
+        """
+        Computes the fingerprint of data - a keyed hash, by which data blocks of equal content are
+        found by the client only
+        :param data: the data
+        :return: the fingerprint, as a hexadecimal string
+        """
+        return self._hmac(self.fingerprint_key, data).hex()
+
+    def __reduce__(self):
+        # Pickled with the unwrapped keys only (e.g. for worker processes), as the cipher suites
+        # cannot be pickled
+        return self.from_keys, (self.aes_key, self.mac_key)
 
     @classmethod
     def _to_base64(cls, att):
@@ -149,34 +184,134 @@ class AESCryptography():
         except InvalidUnwrap:
             raise WrongPassword("Password is incorrect.")
 
-    def encrypt(self, data_id, data):
+    def _get_cipher_suite(self, cipher_suite=None):
+        """
+        Returns a cipher suite together with the header of its tokens, without the kind
+        :param cipher_suite: the name of the cipher suite, config.CIPHER_SUITE by default
+        :return: tuple (suite, header)
+        """
+        suite = self.cipher_suites[cipher_suite or self.cipher_suite]
+        if suite.SUITE_ID is None:
+            # Tokens of AES-CBC with HMAC keep the header they had before the cipher suites
+            return suite, b''
+        return suite, bytes((utils.AEAD_TOKEN_VERSION, suite.SUITE_ID))
+
+    def token_size(self, plaintext_size, cipher_suite=None):
+        """
+        Returns the size of the token of a plaintext
+        :param plaintext_size: the size of the plaintext
+        :param cipher_suite: the name of the cipher suite, config.CIPHER_SUITE by default
+        :return: the size of the token
+        """
+        suite, header = self._get_cipher_suite(cipher_suite)
+        return suite.token_size(len(header) + 1, plaintext_size)
+
+    def max_block_token_size(self):
+        """
+        Returns the size of the largest token of a data block among the cipher suites, which a
+        buffer decrypted into must have room for
+        :return: the size of the token
+        """
+        return max(self.token_size(BLOCK_HEADER_SIZE + config.BLOCK_SIZE, suite_class.NAME)
+                   for suite_class in CIPHER_SUITES)
+
+    def _encrypt_into(self, kind, plaintext, buffer, cipher_suite=None):
+        """
+        Encrypts a plaintext into a token of the given kind, written to the beginning of a buffer
+        :param kind: the kind of the token - TOKEN_VERSION or BUCKET_TOKEN_VERSION
+        :param plaintext: the plaintext, bytes or a view of a buffer
+        :param buffer: a writable buffer of at least the size of the token
+        :param cipher_suite: the name of the cipher suite, config.CIPHER_SUITE by default
+        :return: the size of the token
+        """
+        suite, header = self._get_cipher_suite(cipher_suite)
+        return suite.encrypt_into(header + bytes((kind,)), plaintext, buffer)
+
+    def _encrypt(self, kind, plaintext, cipher_suite=None):
+        """
+        Encrypts a plaintext into a token of the given kind
+        :param kind: the kind of the token - TOKEN_VERSION or BUCKET_TOKEN_VERSION
+        :param plaintext: the plaintext
+        :param cipher_suite: the name of the cipher suite, config.CIPHER_SUITE by default
+        :return: the token
+        """
+        token = bytearray(self.token_size(len(plaintext), cipher_suite))
+        self._encrypt_into(kind, plaintext, token, cipher_suite)
+        return token
+
+    def _decrypt_into(self, token, kinds, buffer):
+        """
+        Decrypts a token of one of the given kinds with the cipher suite in its header, writing
+        its plaintext to the beginning of a buffer
+        :param token: the token, bytes or a view of a received buffer
+        :param kinds: the accepted kinds of the token
+        :param buffer: a writable buffer of at least the size of the token
+        :return: tuple (kind, the size of the plaintext)
+        """
+        if not isinstance(token, (bytes, bytearray, memoryview)):
+            raise TypeError("Ciphertext must be bytes.")
+
+        if not token:
+            raise InvalidToken
+        version = six.indexbytes(token, 0)
+        if version == utils.AEAD_TOKEN_VERSION:
+            if len(token) < 3:
+                raise InvalidToken
+            suite = self.aead_suites.get(six.indexbytes(token, 1))
+            kind = six.indexbytes(token, 2)
+            header_size = 3
+        else:
+            suite = self.cipher_suites[utils.CBC_HMAC_SUITE]
+            kind = version
+            header_size = 1
+        if suite is None or kind not in kinds:
+            raise InvalidToken
+        if len(buffer) < len(token):
+            raise ValueError("Buffer must be at least as large as the token.")
+
+        return kind, suite.decrypt_into(token, header_size, buffer)
+
+    def _decrypt(self, token, kinds):
+        """
+        Decrypts a token of one of the given kinds, with the cipher suite in its header
+        :param token: the token, bytes or a view of a received buffer
+        :param kinds: the accepted kinds of the token
+        :return: tuple (kind, plaintext)
+        """
+        plaintext = bytearray(len(token))
+        kind, size = self._decrypt_into(token, kinds, plaintext)
+        del plaintext[size:]
+        return kind, plaintext
+
+    def encrypt(self, data_id, data, leaf_id=0):
         """
         Encrypts data block
         :param data_id: the data ID labeling the data block
         :param data: the data itself
+        :param leaf_id: the leaf the data block is mapped unto
         :return:
         """
-        iv = os.urandom(16)
-
         if not isinstance(data_id, int):
             raise TypeError("Data ID must be integer.")
 
-        if not isinstance(data, bytes):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
             raise TypeError("Data must be bytes.")
 
-        # Note that we pack with the plaintext a prefix which includes the data ID
-        main_parts = (struct.pack(config.FORMAT_CHAR, data_id) + data)
-        padded_data = self._add_padding(main_parts, algorithms.AES.block_size)
-        encryptor = Cipher(algorithms.AES(self.aes_key), modes.CBC(iv),
-                           backend=self.backend).encryptor()
-        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-
-        basic_parts = (b"\x80" + iv + ciphertext)
+        # Note that we pack with the plaintext a prefix which includes the data ID and its leaf
+        block = bytearray(BLOCK_HEADER_SIZE + len(data))
+        struct.pack_into(config.HEADER_FORMAT_CHAR, block, 0, data_id, leaf_id)
+        block[BLOCK_HEADER_SIZE:] = data
+        return self._encrypt(utils.TOKEN_VERSION, block)
 
-        h = HMAC(self.mac_key, hashes.SHA256(), backend=self.backend)
-        h.update(basic_parts)
-        hmac = h.finalize()
-        return basic_parts + hmac
+    def encrypt_block_into(self, block, buffer):
+        """
+        Encrypts a serialized data block - the data ID and the leaf packed with
+        config.HEADER_FORMAT_CHAR, followed by the data - as a slot of a bucket is laid out
+        :param block: the serialized data block, bytes or a view of a buffer
+        :param buffer: a writable buffer of at least the size of the token
+        :return: the size of the token
+        """
+        return self._encrypt_into(utils.TOKEN_VERSION, block, buffer)
 
     def decrypt(self, token):
         """
@@ -184,38 +319,101 @@ class AESCryptography():
         :param token: data
         :return: decrypted token
         """
-        if not isinstance(token, bytes):
-            raise TypeError("Ciphertext must be bytes.")
+        data_id, _, data = self.decrypt_block(token)
+        return data_id, data
 
-        if not token or six.indexbytes(token, 0) != 0x80:
+    def _decrypt_block_into(self, token, buffer):
+        """
+        Decrypts a token - data - straight into a buffer
+        :param token: data
+        :param buffer: a writable buffer of at least the size of the token
+        :return: tuple (data_id, leaf_id, the offset of the data, the end of the data), where
+        leaf_id is None for tokens of the legacy version
+        """
+        version, size = self._decrypt_into(token, (utils.LEGACY_TOKEN_VERSION,
+                                                   utils.TOKEN_VERSION), buffer)
+
+        if version == utils.LEGACY_TOKEN_VERSION:
+            header_format = config.FORMAT_CHAR
+        else:
+            header_format = config.HEADER_FORMAT_CHAR
+        header_size = struct.calcsize(header_format)
+        if size < header_size:
             raise InvalidToken
+        header = struct.unpack_from(header_format, buffer)
 
-        hmac = token[-32:]
-        h = HMAC(self.mac_key, hashes.SHA256(), backend=self.backend)
-        h.update(token[:-32])
-        try:
-            h.verify(hmac)
-        except InvalidSignature:
-            raise InvalidToken
+        data_id = header[0]
+        leaf_id = header[1] if len(header) > 1 else None
+        if data_id == config.DUMMY_ID:
+            raise DummyFileFound
 
-        iv = token[1:17]
-        ciphertext = token[17:-32]
-        decryptor = Cipher(algorithms.AES(self.aes_key), modes.CBC(iv), self.backend).decryptor()
-        padded_plaintext = decryptor.update(ciphertext)
-        try:
-            padded_plaintext += decryptor.finalize()
-        except ValueError:
-            raise InvalidToken
+        return data_id, leaf_id, header_size, size
 
-        plaintext = self._remove_padding(padded_plaintext, algorithms.AES.block_size)
+    def decrypt_block_into(self, token, buffer):
+        """
+        Decrypts a token - data - straight into a buffer. Unless the token is of the legacy
+        version, the buffer holds the data block serialized as a slot of a bucket is laid out
+        :param token: data
+        :param buffer: a writable buffer of at least the size of the token
+        :return: tuple (data_id, leaf_id, data), where data is a view of the buffer and leaf_id is
+        None for tokens of the legacy version
+        """
+        data_id, leaf_id, offset, size = self._decrypt_block_into(token, buffer)
+        return data_id, leaf_id, memoryview(buffer)[offset:size]
 
-        try:
-            data_id = struct.unpack(config.FORMAT_CHAR, plaintext[:8])
-        except struct.error:
-            raise InvalidToken
+    def decrypt_block(self, token):
+        """
+        Decrypts a token - data, together with the leaf its data block is mapped unto
+        :param token: data
+        :return: tuple (data_id, leaf_id, data), where leaf_id is None for tokens of the legacy
+        version
+        """
+        plaintext = bytearray(len(token))
+        data_id, leaf_id, offset, size = self._decrypt_block_into(token, plaintext)
+        # Trimming a bytearray does not copy the data
+        del plaintext[size:]
+        del plaintext[:offset]
+        return data_id, leaf_id, plaintext
+
+    def encrypt_bucket(self, bucket, cipher_suite=None):
+        """
+        Encrypts a serialized bucket - a node of the PathORAM tree - as a single token
+        :param bucket: the serialized bucket
+        :param cipher_suite: the name of the cipher suite of the tree, config.CIPHER_SUITE by
+        default
+        :return: the token
+        """
+        token = bytearray(self.token_size(len(bucket), cipher_suite))
+        self.encrypt_bucket_into(bucket, token, cipher_suite)
+        return token
 
-        if data_id == config.DUMMY_ID:
-            raise DummyFileFound
+    def encrypt_bucket_into(self, bucket, buffer, cipher_suite=None):
+        """
+        Encrypts a serialized bucket straight into a buffer
+        :param bucket: the serialized bucket, bytes or a view of a buffer
+        :param buffer: a writable buffer of at least the size of the token
+        :param cipher_suite: the name of the cipher suite of the tree, config.CIPHER_SUITE by
+        default
+        :return: the size of the token
+        """
+        if not isinstance(bucket, (bytes, bytearray, memoryview)):
+            raise TypeError("Bucket must be bytes.")
 
-        data = plaintext[8:]
-        return data_id[0], data
\ No newline at end of file
+        return self._encrypt_into(utils.BUCKET_TOKEN_VERSION, bucket, buffer, cipher_suite)
+
+    def decrypt_bucket(self, token):
+        """
+        Decrypts the token of a bucket
+        :param token: the token, bytes or a view of a received buffer
+        :return: the serialized bucket
+        """
+        return self._decrypt(token, (utils.BUCKET_TOKEN_VERSION,))[1]
+
+    def decrypt_bucket_into(self, token, buffer):
+        """
+        Decrypts the token of a bucket straight into a buffer
+        :param token: the token, bytes or a view of a received buffer
+        :param buffer: a writable buffer of at least the size of the token
+        :return: the size of the serialized bucket
+        """
+        return self._decrypt_into(token, (utils.BUCKET_TOKEN_VERSION,), buffer)[1]
@@ -0,0 +1,74 @@
+"""
+Compares the throughput of the cipher suites on data blocks and on whole buckets. Run with:
+
+    python3 -m client.crypto.benchmark
+"""
+import os
+import sys
+import time
+
+from cryptography.hazmat.backends import default_backend
+
+import client.config as config
+import client.crypto.utils as utils
+from client.crypto.cipher_suite import CIPHER_SUITES
+from client.storage.bucket import BUCKET_SIZE
+
+# The minimal time each measurement runs for in terms of seconds
+MEASURE_TIME = 1.0
+
+
+def measure(function, size):
+    """
+    Measures the throughput of a function
+    :param function: a function without arguments, processing size bytes
+    :param size: the amount of bytes processed by a call
+    :return: the throughput in terms of MB per second
+    """
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < MEASURE_TIME:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls * size / elapsed / (1024 * 1024)
+
+
+def benchmark_suite(suite, kind, size):
+    """
+    Measures the throughput of a cipher suite
+    :param suite: the cipher suite
+    :param kind: the kind of the tokens - TOKEN_VERSION or BUCKET_TOKEN_VERSION
+    :param size: the size of a plaintext
+    :return: tuple (encryption throughput, decryption throughput) in terms of MB per second
+    """
+    if suite.SUITE_ID is None:
+        header = bytes((kind,))
+    else:
+        header = bytes((utils.AEAD_TOKEN_VERSION, suite.SUITE_ID, kind))
+    plaintext = os.urandom(size)
+    # The tokens are encrypted and decrypted into preallocated buffers, as on an access
+    token = suite.encrypt(header, plaintext)
+    buffer = bytearray(len(token))
+    return (measure(lambda: suite.encrypt_into(header, plaintext, buffer), size),
+            measure(lambda: suite.decrypt_into(token, len(header), buffer), size))
+
+
+def main():
+    backend = default_backend()
+    aes_key = os.urandom(utils.AES_LENGTH)
+    mac_key = os.urandom(utils.MAC_LENGTH)
+    print(f"{'SUITE':<20}{'PLAINTEXT':<20}{'ENCRYPT MB/s':>15}{'DECRYPT MB/s':>15}")
+    for suite_class in CIPHER_SUITES:
+        suite = suite_class(aes_key, mac_key, backend)
+        for name, kind, size in (('block', utils.TOKEN_VERSION, config.BLOCK_SIZE),
+                                 ('bucket', utils.BUCKET_TOKEN_VERSION, BUCKET_SIZE)):
+            encrypt_rate, decrypt_rate = benchmark_suite(suite, kind, size)
+            print(f"{suite.NAME:<20}{f'{name} ({size} B)':<20}{encrypt_rate:>15.1f}"
+                  f"{decrypt_rate:>15.1f}")
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
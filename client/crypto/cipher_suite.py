@@ -0,0 +1,276 @@
+import os
+
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.hmac import HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import client.crypto.utils as utils
+from client.crypto.exceptions import InvalidToken
+
+
+class CipherSuite:
+    """
+    A scheme for encrypting a plaintext into a token, which begins with a header authenticated
+    together with the plaintext. Tokens are encrypted and decrypted straight into buffers of the
+    caller, where a buffer decrypted into must be at least as large as the token
+    """
+    # The name of the suite in the configuration
+    NAME = None
+    # The ID of the suite in the header of a token
+    SUITE_ID = None
+
+    def token_size(self, header_size, plaintext_size):
+        """
+        Returns the size of a token
+        :param header_size: the size of the header the token begins with
+        :param plaintext_size: the size of the plaintext
+        :return: the size of the token
+        """
+        raise NotImplementedError
+
+    def encrypt_into(self, header, plaintext, buffer):
+        """
+        Encrypts a plaintext into a token, written to the beginning of a buffer
+        :param header: the header the token begins with
+        :param plaintext: the plaintext, bytes or a view of a buffer
+        :param buffer: a writable buffer of at least the size of the token
+        :return: the size of the token
+        """
+        raise NotImplementedError
+
+    def decrypt_into(self, token, header_size, buffer):
+        """
+        Decrypts a token, writing its plaintext to the beginning of a buffer
+        :param token: the token, bytes or a view of a received buffer
+        :param header_size: the size of the header the token begins with
+        :param buffer: a writable buffer of at least the size of the token
+        :return: the size of the plaintext
+        """
+        raise NotImplementedError
+
+    def encrypt(self, header, plaintext):
+        """
+        Encrypts a plaintext into a token
+        :param header: the header the token begins with
+        :param plaintext: the plaintext
+        :return: the token
+        """
+        token = bytearray(self.token_size(len(header), len(plaintext)))
+        self.encrypt_into(header, plaintext, token)
+        return token
+
+    def decrypt(self, token, header_size):
+        """
+        Decrypts a token
+        :param token: the token, bytes or a view of a received buffer
+        :param header_size: the size of the header the token begins with
+        :return: the plaintext
+        """
+        plaintext = bytearray(len(token))
+        del plaintext[self.decrypt_into(token, header_size, plaintext):]
+        return plaintext
+
+
+class CBCHMACSuite(CipherSuite):
+    """
+    AES-CBC with PKCS7 padding, followed by HMAC-SHA256 over the whole token (encrypt-then-MAC).
+    Tokens of this suite have no suite ID, as they predate the suites. The keyed HMAC is copied
+    for every token instead of keyed again
+    """
+    NAME = utils.CBC_HMAC_SUITE
+
+    def __init__(self, aes_key, mac_key, backend):
+        self.backend = backend
+        self.algorithm = algorithms.AES(aes_key)
+        self.hmac = HMAC(mac_key, hashes.SHA256(), backend=backend)
+
+    @classmethod
+    def _padded_size(cls, plaintext_size):
+        return (plaintext_size // utils.AES_BLOCK_LENGTH + 1) * utils.AES_BLOCK_LENGTH
+
+    def token_size(self, header_size, plaintext_size):
+        return header_size + utils.IV_LENGTH + self._padded_size(plaintext_size) + \
+            utils.HMAC_LENGTH
+
+    def encrypt_into(self, header, plaintext, buffer):
+        size = self.token_size(len(header), len(plaintext))
+        view = memoryview(buffer)[:size]
+        offset = len(header)
+        view[:offset] = header
+        iv = os.urandom(utils.IV_LENGTH)
+        view[offset:offset + utils.IV_LENGTH] = iv
+        offset += utils.IV_LENGTH
+
+        # The whole blocks of the plaintext are encrypted in place, and only the last block is
+        # padded
+        plaintext = memoryview(plaintext)
+        aligned_size = len(plaintext) - len(plaintext) % utils.AES_BLOCK_LENGTH
+        padding_length = utils.AES_BLOCK_LENGTH - len(plaintext) % utils.AES_BLOCK_LENGTH
+        last_block = bytes(plaintext[aligned_size:]) + bytes((padding_length,)) * padding_length
+        encryptor = Cipher(self.algorithm, modes.CBC(iv), backend=self.backend).encryptor()
+        offset += encryptor.update_into(plaintext[:aligned_size], view[offset:])
+        offset += encryptor.update_into(last_block, view[offset:])
+        encryptor.finalize()
+
+        h = self.hmac.copy()
+        h.update(view[:offset])
+        view[offset:] = h.finalize()
+        return size
+
+    def decrypt_into(self, token, header_size, buffer):
+        token = memoryview(token)
+        if len(token) < header_size + utils.IV_LENGTH + utils.AES_BLOCK_LENGTH + \
+                utils.HMAC_LENGTH:
+            raise InvalidToken
+        h = self.hmac.copy()
+        h.update(token[:-utils.HMAC_LENGTH])
+        try:
+            h.verify(bytes(token[-utils.HMAC_LENGTH:]))
+        except InvalidSignature:
+            raise InvalidToken
+
+        iv = bytes(token[header_size:header_size + utils.IV_LENGTH])
+        ciphertext = token[header_size + utils.IV_LENGTH:-utils.HMAC_LENGTH]
+        if len(ciphertext) % utils.AES_BLOCK_LENGTH:
+            raise InvalidToken
+        decryptor = Cipher(self.algorithm, modes.CBC(iv), backend=self.backend).decryptor()
+        size = decryptor.update_into(ciphertext, buffer)
+        decryptor.finalize()
+
+        padding_length = buffer[size - 1]
+        if not 0 < padding_length <= utils.AES_BLOCK_LENGTH or \
+                bytes(memoryview(buffer)[size - padding_length:size]) != \
+                bytes((padding_length,)) * padding_length:
+            raise InvalidToken
+        return size - padding_length
+
+
+class AEADSuite(CipherSuite):
+    """
+    A single-pass authenticated encryption, with a random nonce for every token. The key of the
+    suite is derived from the AES key, so each suite has a key of its own. Tokens are encrypted
+    straight into the buffer where the installed cryptography supports it
+    """
+    AEAD = None
+
+    def __init__(self, aes_key, mac_key, backend):
+        self.backend = backend
+        self.key = HKDF(algorithm=hashes.SHA256(), length=utils.AES_LENGTH, salt=None,
+                        info=self.NAME.encode(), backend=backend).derive(aes_key)
+        self.aead = self.AEAD(self.key)
+        self.native_into = hasattr(self.aead, 'encrypt_into')
+
+    def token_size(self, header_size, plaintext_size):
+        return header_size + utils.NONCE_LENGTH + plaintext_size + utils.TAG_LENGTH
+
+    def encrypt_into(self, header, plaintext, buffer):
+        size = self.token_size(len(header), len(plaintext))
+        view = memoryview(buffer)[:size]
+        offset = len(header)
+        view[:offset] = header
+        nonce = os.urandom(utils.NONCE_LENGTH)
+        view[offset:offset + utils.NONCE_LENGTH] = nonce
+        self._seal_into(nonce, header, plaintext, view[offset + utils.NONCE_LENGTH:])
+        return size
+
+    def decrypt_into(self, token, header_size, buffer):
+        token = memoryview(token)
+        if len(token) < header_size + utils.NONCE_LENGTH + utils.TAG_LENGTH:
+            raise InvalidToken
+        nonce = bytes(token[header_size:header_size + utils.NONCE_LENGTH])
+        ciphertext = token[header_size + utils.NONCE_LENGTH:]
+        try:
+            self._open_into(nonce, token[:header_size], ciphertext, buffer)
+        except InvalidTag:
+            raise InvalidToken
+        return len(ciphertext) - utils.TAG_LENGTH
+
+    def _seal_into(self, nonce, header, plaintext, view):
+        """
+        Encrypts a plaintext, writing the ciphertext followed by the tag to a view
+        :param nonce: the nonce
+        :param header: the associated data
+        :param plaintext: the plaintext
+        :param view: a view of exactly the size of the ciphertext and the tag
+        :return:
+        """
+        if self.native_into:
+            self.aead.encrypt_into(nonce, plaintext, header, view)
+        else:
+            view[:] = self.aead.encrypt(nonce, plaintext, header)
+
+    def _open_into(self, nonce, header, ciphertext, buffer):
+        """
+        Decrypts a ciphertext followed by its tag, writing the plaintext to a buffer
+        :param nonce: the nonce
+        :param header: the associated data
+        :param ciphertext: the ciphertext followed by the tag
+        :param buffer: a writable buffer of at least the size of the ciphertext
+        :return:
+        """
+        plaintext_size = len(ciphertext) - utils.TAG_LENGTH
+        if self.native_into:
+            self.aead.decrypt_into(nonce, ciphertext, header, memoryview(buffer)[:plaintext_size])
+        else:
+            memoryview(buffer)[:plaintext_size] = self.aead.decrypt(nonce, ciphertext, header)
+
+
+class AESGCMSuite(AEADSuite):
+    """
+    AES-256-GCM. Where the installed cryptography cannot encrypt straight into a buffer, the
+    streaming GCM mode is used instead, which writes into the buffer with update_into
+    """
+    NAME = utils.AES_GCM_SUITE
+    SUITE_ID = 1
+    AEAD = AESGCM
+
+    def __init__(self, aes_key, mac_key, backend):
+        super(AESGCMSuite, self).__init__(aes_key, mac_key, backend)
+        self.algorithm = algorithms.AES(self.key)
+
+    def _seal_into(self, nonce, header, plaintext, view):
+        if self.native_into:
+            return super(AESGCMSuite, self)._seal_into(nonce, header, plaintext, view)
+        encryptor = Cipher(self.algorithm, modes.GCM(nonce), backend=self.backend).encryptor()
+        encryptor.authenticate_additional_data(header)
+        # update_into needs room for a whole block beyond the plaintext, which the tag provides
+        size = encryptor.update_into(plaintext, view)
+        encryptor.finalize()
+        view[size:] = encryptor.tag
+
+    def _open_into(self, nonce, header, ciphertext, buffer):
+        if self.native_into:
+            return super(AESGCMSuite, self)._open_into(nonce, header, ciphertext, buffer)
+        tag = bytes(ciphertext[-utils.TAG_LENGTH:])
+        decryptor = Cipher(self.algorithm, modes.GCM(nonce, tag),
+                           backend=self.backend).decryptor()
+        decryptor.authenticate_additional_data(bytes(header))
+        decryptor.update_into(ciphertext[:-utils.TAG_LENGTH], buffer)
+        decryptor.finalize()
+
+
+class ChaCha20Poly1305Suite(AEADSuite):
+    """
+    ChaCha20-Poly1305, which is faster than AES-GCM on hosts without AES instructions
+    """
+    NAME = utils.CHACHA20_POLY1305_SUITE
+    SUITE_ID = 2
+    AEAD = ChaCha20Poly1305
+
+
+CIPHER_SUITES = (CBCHMACSuite, AESGCMSuite, ChaCha20Poly1305Suite)
+
+
+def get_cipher_suite_class(name):
+    """
+    Returns the class of a cipher suite by its name
+    :param name: the name of the suite
+    :return: the class of the suite
+    """
+    for suite_class in CIPHER_SUITES:
+        if suite_class.NAME == name:
+            return suite_class
+    raise ValueError(f"Unknown cipher suite {name}.")
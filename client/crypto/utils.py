@@ -6,6 +6,29 @@ SALT_LENGTH = 16
 AES_LENGTH = 32
 MAC_LENGTH = 32
 
+# The first byte of a token - tokens of the legacy version do not carry the leaf of the data block
+LEGACY_TOKEN_VERSION = 0x80
+TOKEN_VERSION = 0x81
+# The first byte of the token of a whole bucket
+BUCKET_TOKEN_VERSION = 0x82
+# The first byte of a token of an AEAD cipher suite, followed by the ID of the suite and the kind
+# of the token - TOKEN_VERSION for a data block or BUCKET_TOKEN_VERSION for a bucket
+AEAD_TOKEN_VERSION = 0x90
+
+# The label the key of the fingerprints of data blocks is derived from the MAC key with
+FINGERPRINT_KEY_LABEL = b'fingerprint'
+
+AES_BLOCK_LENGTH = 16
+IV_LENGTH = 16
+HMAC_LENGTH = 32
+NONCE_LENGTH = 12
+TAG_LENGTH = 16
+
+# The names of the cipher suites
+CBC_HMAC_SUITE = 'aes-cbc-hmac'
+AES_GCM_SUITE = 'aes-gcm'
+CHACHA20_POLY1305_SUITE = 'chacha20-poly1305'
+
 LENGTH_ERR_MSG = "Master-Key %s must be %d URL-safe base64-encoded bytes."
 
 KEY_MAP_FILE_NAME = 'key.map'
@@ -36,50 +36,32 @@ def open_data_file(filename, mode):
     return open(os.path.join(BASE_DIR, filename), mode)
 
 
-def get_stash_size():
+def get_stash_dir(folder_name=utils.STASH_FOLDER_NAME):
     """
-    Returns the stash's size
-    :return: the stash's size
+    Returns the path of a stash directory
+    :param folder_name: the folder name of the stash
+    :return: the path of the stash directory
     """
-    return len([name for name in os.listdir(STASH_DIR) if
-                os.path.isfile(os.path.join(STASH_DIR, name))])
+    return os.path.join(BASE_DIR, folder_name)
 
 
-def open_data_file_in_stash(filename, mode):
+def get_data_file_path(filename):
     """
-    Opens a data file in the stash
+    Returns the path of a data file
     :param filename: a data file name
-    :param mode: the mode with which we read the data file
-    :return:
+    :return: the path of the data file
     """
-    return open(os.path.join(STASH_DIR, filename), mode)
+    return os.path.join(BASE_DIR, filename)
 
 
-def is_data_file_in_stash(filename):
+def replace_data_file(src_filename, dst_filename):
     """
-    Checks if a data file is in the stash
-    :param filename: a data file name
-    :return: True/False
-    """
-    return os.path.isfile(os.path.join(STASH_DIR, filename))
-
-
-def delete_data_file_in_stash(filename):
-    """
-    Deletes a data file in the stash
-    :param filename: a data file name
+    Atomically replaces a data file with another data file
+    :param src_filename: the data file name which replaces
+    :param dst_filename: the data file name which is replaced
     :return:
     """
-    if os.path.isfile(os.path.join(STASH_DIR, filename)):
-        os.remove(os.path.join(STASH_DIR, filename))
-
-
-def get_stash_data_file_names():
-    """
-    Returns the names of all the data files in the stash
-    :return: the names of all the data files in the stash
-    """
-    return os.listdir(STASH_DIR)
+    os.replace(get_data_file_path(src_filename), get_data_file_path(dst_filename))
 
 
 def data_file_exists(filename):
@@ -0,0 +1,55 @@
+import json
+import os
+
+# The per-deployment configuration is kept next to the cloud map. It is written once the cloud is
+# set up, and it fixes the geometry of the tree from then on
+DEPLOYMENT_FILE_NAME = 'deployment.map'
+DEPLOYMENT_FILE_PATH = os.path.join(os.path.dirname(__file__), DEPLOYMENT_FILE_NAME)
+TMP_SUFFIX = '.tmp'
+
+JSON_HEIGHT = 'height'
+JSON_BLOCK_SIZE = 'block_size'
+JSON_BUCKET_CAPACITY = 'bucket_capacity'
+JSON_ORAM_ENGINE = 'oram_engine'
+JSON_POSITION_MAP_ADDRESS_SPACE = 'position_map_address_space'
+JSON_POSITION_MAP_LEVELS = 'position_map_levels'
+JSON_SERVER_IP = 'server_ip'
+JSON_SERVER_PORT = 'server_port'
+
+JSON_INDENT = 4
+
+
+def deployment_exists():
+    """
+    Checks if the per-deployment configuration exists
+    :return: True/False
+    """
+    return os.path.isfile(DEPLOYMENT_FILE_PATH)
+
+
+def load_deployment():
+    """
+    Loads the per-deployment configuration
+    :return: the configuration, empty if there is none yet
+    """
+    if not deployment_exists():
+        return dict()
+    with open(DEPLOYMENT_FILE_PATH, 'r') as deployment_map:
+        try:
+            return json.load(deployment_map)
+        except ValueError:
+            raise ValueError("Error in deployment map.")
+
+
+def save_deployment(deployment):
+    """
+    Atomically saves the per-deployment configuration
+    :param deployment: the configuration
+    :return:
+    """
+    tmp_path = DEPLOYMENT_FILE_PATH + TMP_SUFFIX
+    with open(tmp_path, 'w') as deployment_map:
+        json.dump(deployment, deployment_map, indent=JSON_INDENT)
+        deployment_map.flush()
+        os.fsync(deployment_map.fileno())
+    os.replace(tmp_path, DEPLOYMENT_FILE_PATH)
@@ -0,0 +1,53 @@
+import struct
+
+import client.config as config
+
+# Every slot of a bucket is a data block - (data ID, leaf) followed by the data itself
+SLOT_HEADER_SIZE = struct.calcsize(config.HEADER_FORMAT_CHAR)
+SLOT_SIZE = SLOT_HEADER_SIZE + config.BLOCK_SIZE
+
+# The size of a serialized bucket in terms of bytes
+BUCKET_SIZE = config.BUCKET_CAPACITY * SLOT_SIZE
+
+# A slot holding a dummy data block
+DUMMY_SLOT = struct.pack(config.HEADER_FORMAT_CHAR, config.DUMMY_ID, 0) + bytes(config.BLOCK_SIZE)
+
+
+def serialize_bucket(data_blocks):
+    """
+    Serializes the data blocks of a node in the PathORAM tree into a bucket of
+    config.BUCKET_CAPACITY slots, where the unused slots hold dummy data blocks
+    :param data_blocks: tuples (data_id, leaf_id, data) - at most config.BUCKET_CAPACITY
+    :return: the serialized bucket
+    """
+    if len(data_blocks) > config.BUCKET_CAPACITY:
+        raise ValueError(f"Bucket can contain at most {config.BUCKET_CAPACITY} data blocks.")
+
+    bucket = bytearray(BUCKET_SIZE)
+    for slot in range(config.BUCKET_CAPACITY):
+        offset = slot * SLOT_SIZE
+        if slot < len(data_blocks):
+            data_id, leaf_id, data = data_blocks[slot]
+            if len(data) != config.BLOCK_SIZE:
+                raise ValueError(f"Data block must be {config.BLOCK_SIZE} bytes.")
+            struct.pack_into(config.HEADER_FORMAT_CHAR, bucket, offset, data_id, leaf_id)
+            bucket[offset + SLOT_HEADER_SIZE:offset + SLOT_SIZE] = data
+        else:
+            struct.pack_into(config.HEADER_FORMAT_CHAR, bucket, offset, config.DUMMY_ID, 0)
+    return bytes(bucket)
+
+
+def deserialize_bucket(bucket):
+    """
+    Deserializes a bucket into the real data blocks it contains, dropping the dummy data blocks
+    :param bucket: a serialized bucket
+    :return: tuples (data_id, leaf_id, data), where data is a view of the bucket if the bucket is
+    a view
+    """
+    data_blocks = list()
+    for offset in range(0, len(bucket) - SLOT_SIZE + 1, SLOT_SIZE):
+        data_id, leaf_id = struct.unpack_from(config.HEADER_FORMAT_CHAR, bucket, offset)
+        if data_id != config.DUMMY_ID:
+            data_blocks.append((data_id, leaf_id,
+                                bucket[offset + SLOT_HEADER_SIZE:offset + SLOT_SIZE]))
+    return data_blocks
@@ -0,0 +1,134 @@
+import bz2
+import io
+import lzma
+import math
+import zlib
+
+import client.log as log
+import client.config as config
+import client.storage.utils as utils
+from client.storage.exceptions import FileSizeError
+
+logger = log.get_logger(__name__)
+
+# codec -> tuple (a function returning a compressor, a function returning a decompressor)
+CODECS = {utils.ZLIB_COMPRESSION: (zlib.compressobj, zlib.decompressobj),
+          utils.LZMA_COMPRESSION: (lzma.LZMACompressor, lzma.LZMADecompressor),
+          utils.BZ2_COMPRESSION: (bz2.BZ2Compressor, bz2.BZ2Decompressor)}
+
+
+def get_codec(compression):
+    """
+    Returns the codec a file is compressed with, given its name
+    :param compression: the name of the codec - 'zlib', 'lzma', 'bz2' or 'none'
+    :return: the codec, None for no compression
+    """
+    if compression is None or compression == utils.NO_COMPRESSION:
+        return None
+    if compression not in CODECS:
+        raise ValueError(f"Unknown compression {compression}.")
+    return compression
+
+
+def is_worth_compressing(compression, sample, file_size):
+    """
+    Tells whether compressing a file pays off, by compressing a sample of its beginning. A file
+    is not compressed if the sample compresses to more than config.COMPRESSION_MAX_RATIO of its
+    size, or if the whole file was sampled and compressing it saves no data block
+    :param compression: the codec
+    :param sample: the first config.COMPRESSION_SAMPLE_SIZE bytes of the file
+    :param file_size: the size of the file
+    :return: True/False
+    """
+    compressor = CODECS[compression][0]()
+    compressed_size = len(compressor.compress(sample)) + len(compressor.flush())
+    if compressed_size > len(sample) * config.COMPRESSION_MAX_RATIO:
+        logger.info(f"{compression} COMPRESSES THE FILE TO {compressed_size} OF {len(sample)} "
+                    f"SAMPLED BYTES - NOT COMPRESSING")
+        return False
+    if len(sample) == file_size and math.ceil(compressed_size / config.BLOCK_SIZE) >= \
+            math.ceil(file_size / config.BLOCK_SIZE):
+        logger.info("COMPRESSION SAVES NO DATA BLOCK - NOT COMPRESSING")
+        return False
+    return True
+
+
+def choose_compression(compression, file, file_size):
+    """
+    Chooses whether a file is compressed, by compressing a sample of its beginning
+    :param compression: the codec the file should be compressed with, None for no compression
+    :param file: the opened file, which is read from its beginning and left at its beginning
+    :param file_size: the size of the file
+    :return: the codec the file is compressed with, None for no compression
+    """
+    if compression is None:
+        return None
+    sample = file.read(config.COMPRESSION_SAMPLE_SIZE)
+    file.seek(0)
+    if not is_worth_compressing(compression, sample, file_size):
+        return None
+    return compression
+
+
+def compress(compression, data):
+    """
+    Compresses data at once
+    :param compression: the codec
+    :param data: the data
+    :return: the compressed data
+    """
+    compressor = CODECS[compression][0]()
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_chunks(compression, chunks):
+    """
+    Decompresses compressed data as it comes, a chunk at a time
+    :param compression: the codec
+    :param chunks: the chunks of the compressed data, in order
+    :return: the decompressed data, piece by piece
+    """
+    decompressor = CODECS[compression][1]()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if compression == utils.ZLIB_COMPRESSION:
+        data = decompressor.flush()
+        if data:
+            yield data
+    if not decompressor.eof:
+        raise FileSizeError("File size of the downloaded file is not correct.")
+
+
+class CompressedReader(io.RawIOBase):
+    """
+    A file whose content is compressed as it is read, so a file is compressed without being
+    read into memory at once
+    """
+    def __init__(self, file, compression):
+        super(CompressedReader, self).__init__()
+        self.file = file
+        self.compressor = CODECS[compression][0]()
+        # The compressed data which was not read yet
+        self.buffer = bytearray()
+        # The amount of bytes of the file compressed so far
+        self.size = 0
+        self.flushed = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.buffer) < len(buffer) and not self.flushed:
+            data = self.file.read(config.BLOCK_SIZE)
+            if data:
+                self.size += len(data)
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.flushed = True
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
@@ -2,12 +2,15 @@ import os
 import math
 
 import client.config as config
+import client.deployment as deployment
 import client.log as log
+import client.storage.utils as utils
 from client.storage.file_processor import FileProcessor
 from client.storage.data_file_map import DataFileMap
-from client.storage.tree_map import TreeMap
-from client.storage.oram import PathORAM
+from client.storage.recursive_tree_map import get_tree_map
+from client.storage.engine import get_oram, get_oram_class
 from client.storage.stash import Stash
+from client.cloud.cloud import Cloud
 from client.crypto.aes_crypto import AESCryptography
 from client.crypto.key_map import KeyMap
 from client.storage.exceptions import DownloadFileError, FileNotInStorage
@@ -41,7 +44,32 @@ def setup_cloud(aes_crypto):
     :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
     :return:
     """
-    PathORAM(aes_crypto).setup_cloud()
+    # The position map fixes how it is stored once it is loaded
+    tree_map = get_tree_map(aes_crypto)
+    # The geometry the cloud is set up with is fixed from now on
+    if not deployment.deployment_exists():
+        deployment.save_deployment(config.get_deployment())
+    get_oram(aes_crypto, tree_map=tree_map).setup_cloud()
+
+
+def grow_tree(aes_crypto):
+    """
+    Grows the tree by a level, doubling its capacity, without re-uploading its data blocks. The new
+    height is recorded in the per-deployment configuration once the tree grew
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :return:
+    """
+    logger.info(f"START GROWTH OF THE TREE FROM HEIGHT {config.ORAM_HEIGHT}")
+    tree_map = get_tree_map(aes_crypto)
+    oram = get_oram(aes_crypto, tree_map=tree_map)
+    # The buckets written so far are kept by the server as the tree grows
+    Cloud.flush()
+    oram.grow()
+    config.ORAM_HEIGHT = oram.height
+    # The position map addresses twice the capacity of the tree, as it did once set up
+    tree_map.grow_address_space(2 * get_oram_class().get_max_oram_block_size())
+    deployment.save_deployment(config.get_deployment())
+    logger.info(f"END GROWTH OF THE TREE TO HEIGHT {config.ORAM_HEIGHT}")
 
 
 def setup_stash():
@@ -52,16 +80,52 @@ def setup_stash():
     Stash()
 
 
-def save_file_input(filename, file_input, aes_crypto):
+def save_file_input(filename, file_input, aes_crypto, compression=None):
     """
     Converting a file into data files
     :param filename:a file name
     :param file_input: the file's data
     :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :param compression: the codec to compress the file with, None for no compression
+    :return:
+    """
+    logger.info(f"START UPLOAD OF FILE {filename}")
+    FileProcessor(aes_crypto, get_tree_map(aes_crypto)).split(filename, file_input, compression)
+
+
+def save_file_path(filename, file_path, aes_crypto, compression=None):
+    """
+    Converting a file on the disk into data files, in parallel if the file is large
+    :param filename: a file name
+    :param file_path: the path of the file
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :param compression: the codec to compress the file with, None for no compression
     :return:
     """
     logger.info(f"START UPLOAD OF FILE {filename}")
-    FileProcessor(aes_crypto).split(filename, file_input)
+    FileProcessor(aes_crypto, get_tree_map(aes_crypto)).split_file(filename, file_path,
+                                                                   compression)
+
+
+def upload_file_stream(filename, file_path, aes_crypto, compression=None):
+    """
+    Uploads a file on the disk as it is read, keeping the memory and the stash bounded
+    :param filename: a file name
+    :param file_path: the path of the file
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :param compression: the codec to compress the file with, None for no compression
+    :return:
+    """
+    logger.info(f"START UPLOAD OF FILE {filename}")
+    tree_map = get_tree_map(aes_crypto)
+    oram = get_oram(aes_crypto, tree_map=tree_map)
+    with open(file_path, 'rb') as file:
+        FileProcessor(aes_crypto, tree_map).split_stream(filename, file, oram.upload,
+                                                         compression)
+    Cloud.flush()
+    Cloud.flush_treetop()
+    Stash.save_all()
+    logger.info("END UPLOAD OF FILE")
 
 
 def upload_data(file_name, aes_crypto):
@@ -71,22 +135,34 @@ def upload_data(file_name, aes_crypto):
     :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
     :return:
     """
+    tree_map = get_tree_map(aes_crypto)
     data_ids = DataFileMap().get_data_ids_of_file(file_name)
-    data_entries = TreeMap().get_data_entries(data_ids)
-    PathORAM(aes_crypto).upload(data_entries)
+    # Only the data blocks in the stash are new, as the file may share data blocks with other files
+    data_entries = [data_entry for data_entry in
+                    tree_map.get_data_entries(list(dict.fromkeys(data_ids)))
+                    if data_entry[1] < 0]
+    get_oram(aes_crypto, tree_map=tree_map).upload(data_entries)
+    Cloud.flush()
+    Cloud.flush_treetop()
+    Stash.save_all()
     logger.info("END UPLOAD OF FILE")
 
 
-def delete_file(file_name):
+def delete_file(file_name, aes_crypto):
     """
     Deletes a file from the program's eco-system
     :param file_name: a file name
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
     :return:
     """
-    data_ids = DataFileMap().get_data_ids_of_file(file_name)
-    TreeMap().delete_data_ids(data_ids)
-    Stash().delete_data_blocks(data_ids)
-    DataFileMap().delete_data_file(file_name)
+    if DataFileMap().get_data_ids_of_file(file_name) is None:
+        raise FileNotInStorage("File is not in storage.")
+    # The data blocks the file shares with other files are kept
+    data_ids = DataFileMap().delete_data_file(file_name)
+    get_oram(aes_crypto, tree_map=get_tree_map(aes_crypto)).delete(data_ids)
+    Cloud.flush()
+    Cloud.flush_treetop()
+    Stash.save_all()
     logger.info("DELETE HAS BEEN SUCCESSFUL")
 
 
@@ -115,14 +191,76 @@ def download_file(file_name, path, desired_file_name, aes_crypto):
     data_ids = DataFileMap().get_data_ids_of_file(file_name)
     if data_ids is None:
         raise FileNotInStorage("File is not in storage.")
-    downloaded_data_blocks = PathORAM(aes_crypto).download(data_ids)
+    downloaded_data_blocks = get_oram(aes_crypto,
+                                      tree_map=get_tree_map(aes_crypto)).download(data_ids)
 
     if len(data_ids) != len(downloaded_data_blocks):
         raise DownloadFileError("An error occurred during file download.")
 
     joined_file = FileProcessor().join(downloaded_data_blocks,
-                                       DataFileMap().get_data_file_length(file_name))
+                                       DataFileMap().get_data_file_length(file_name),
+                                       DataFileMap().get_data_file_compression(file_name))
+    if len(joined_file) != DataFileMap().get_original_file_length(file_name):
+        raise DownloadFileError("An error occurred during file download.")
     save_file(joined_file, path, desired_file_name)
+    Cloud.flush()
+    Cloud.flush_treetop()
+    Stash.save_all()
+    logger.info(f"END DOWNLOAD OF FILE {file_name}")
+
+
+def download_file_stream(file_name, path, desired_file_name, aes_crypto):
+    """
+    Downloads a file from the server straight into the file on the disk. Every data block is
+    written to its offset in a preallocated temporary file as soon as it is downloaded (or, for a
+    compressed file, decompressed and appended to it), and the temporary file replaces the file
+    once it is complete
+    :param file_name: a file name
+    :param path: a path for a file
+    :param desired_file_name: the desired file label we want to save with
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :return:
+    """
+    logger.info(f"START DOWNLOAD OF {file_name} as {desired_file_name}")
+    data_ids = DataFileMap().get_data_ids_of_file(file_name)
+    if data_ids is None:
+        raise FileNotInStorage("File is not in storage.")
+    file_len = DataFileMap().get_data_file_length(file_name)
+    if math.ceil(file_len / config.BLOCK_SIZE) != len(data_ids):
+        raise DownloadFileError("An error occurred during file download.")
+
+    compression = DataFileMap().get_data_file_compression(file_name)
+    original_file_len = DataFileMap().get_original_file_length(file_name)
+
+    file_path = os.path.join(path, desired_file_name)
+    tmp_file_path = file_path + utils.TMP_SUFFIX
+    fd = os.open(tmp_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, original_file_len)
+        oram = get_oram(aes_crypto, tree_map=get_tree_map(aes_crypto))
+        if compression is None:
+            for position, data_block in enumerate(oram.iter_download(data_ids)):
+                FileProcessor.write_data_block(fd, position, data_block, file_len)
+        else:
+            offset = 0
+            for data in FileProcessor.decompress_data_blocks(oram.iter_download(data_ids),
+                                                             file_len, compression):
+                if offset + len(data) > original_file_len:
+                    raise DownloadFileError("An error occurred during file download.")
+                FileProcessor.write_data(fd, data, offset)
+                offset += len(data)
+            if offset != original_file_len:
+                raise DownloadFileError("An error occurred during file download.")
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_file_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_file_path, file_path)
+    Cloud.flush()
+    Cloud.flush_treetop()
+    Stash.save_all()
     logger.info(f"END DOWNLOAD OF FILE {file_name}")
 
 
@@ -131,15 +269,16 @@ def get_max_storage_size():
     Returns the max capacity of the stash
     :return: the max capacity of the stash
     """
-    return PathORAM.get_max_oram_storage_size()
+    return get_oram_class().get_max_oram_storage_size()
 
 
-def get_used_storage_size():
+def get_used_storage_size(aes_crypto):
     """
     Returns the used storage size
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
     :return: the used storage size
     """
-    number_data_ids = TreeMap().count_data_ids()
+    number_data_ids = get_tree_map(aes_crypto).count_data_ids()
     return number_data_ids * config.BLOCK_SIZE
 
 
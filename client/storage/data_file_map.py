@@ -8,6 +8,14 @@ JSON_ID_COUNTER = 'counter'
 JSON_FILE_NAME = 'data_file_name'
 JSON_FILE_SIZE = 'file_size'
 JSON_DATA_BLOCKS = 'data_blocks'
+# The codec a compressed file is compressed with, and the size of the file before it was compressed
+JSON_COMPRESSION = 'compression'
+JSON_ORIGINAL_SIZE = 'original_size'
+# fingerprint -> data ID, of the data blocks which may be shared by files
+JSON_FINGERPRINTS = 'fingerprints'
+# data ID -> the amount of references of files to the data block, of the data blocks which have a
+# fingerprint
+JSON_REFERENCES = 'references'
 
 
 class DataFileMap:
@@ -20,20 +28,38 @@ class DataFileMap:
                 json.dump({JSON_FILES: (), JSON_ID_COUNTER: 0}, data_file_map,
                           indent=utils.JSON_INDENT)
 
-    def add_data_file(self, data_file_name, file_size, data_blocks, data_id_counter):
+    def add_data_file(self, data_file_name, file_size, data_blocks, data_id_counter,
+                      fingerprints=None, compression=None, original_size=None):
         """
         Adds file to the map
         :param data_file_name: a data file name
-        :param file_size: the data file's size
-        :param data_blocks: the data ids for the data blocks for the given file
+        :param file_size: the data file's size, as stored - after it was compressed
+        :param data_blocks: the data ids for the data blocks for the given file, where a data block
+        shared with other files (or within the file) is referenced by its data ID
         :param data_id_counter: the counter counting the amount of data blocks used
+        :param fingerprints: fingerprint -> data ID, of the new data blocks other files may share
+        :param compression: the codec the file is compressed with, None if it is not compressed
+        :param original_size: the size of the file before it was compressed
         :return:
         """
         with data.open_data_file(utils.FILE_MAP_FILE_NAME, utils.READ_WRITE_MODE) as data_file_map:
             file_data = json.load(data_file_map)
-            file_data[JSON_FILES].append({JSON_FILE_NAME: data_file_name, JSON_FILE_SIZE: file_size,
-                                          JSON_DATA_BLOCKS: data_blocks})
+            entry = {JSON_FILE_NAME: data_file_name, JSON_FILE_SIZE: file_size,
+                     JSON_DATA_BLOCKS: data_blocks}
+            if compression is not None:
+                entry[JSON_COMPRESSION] = compression
+                entry[JSON_ORIGINAL_SIZE] = original_size
+            file_data[JSON_FILES].append(entry)
             file_data[JSON_ID_COUNTER] = data_id_counter
+            file_fingerprints = file_data.setdefault(JSON_FINGERPRINTS, dict())
+            references = file_data.setdefault(JSON_REFERENCES, dict())
+            if fingerprints:
+                file_fingerprints.update(fingerprints)
+                for data_id in fingerprints.values():
+                    references.setdefault(str(data_id), 0)
+            for data_id in data_blocks:
+                if str(data_id) in references:
+                    references[str(data_id)] += 1
             data_file_map.seek(utils.FILE_BEGIN)
             json.dump(file_data, data_file_map, indent=utils.JSON_INDENT, sort_keys=True)
             data_file_map.truncate()
@@ -50,6 +76,14 @@ class DataFileMap:
                 file_names.append(file[JSON_FILE_NAME])
             return file_names
 
+    def get_fingerprints(self):
+        """
+        Returns the fingerprints of the data blocks which may be shared by files
+        :return: fingerprint -> data ID
+        """
+        with data.open_data_file(utils.FILE_MAP_FILE_NAME, utils.READ_MODE) as data_file_map:
+            return json.load(data_file_map).get(JSON_FINGERPRINTS, dict())
+
     def get_id_counter(self):
         """
         Returns the counter of the data blocks
@@ -59,6 +93,17 @@ class DataFileMap:
             file_data = json.load(data_file_map)
             return file_data[JSON_ID_COUNTER]
 
+    def count_data_ids(self):
+        """
+        Counts the amount of data blocks of all the known files, where a data block shared by
+        files is counted once
+        :return: the amount of data blocks of all the known files
+        """
+        with data.open_data_file(utils.FILE_MAP_FILE_NAME, utils.READ_MODE) as data_file_map:
+            file_data = json.load(data_file_map)
+            return len({data_id for file in file_data[JSON_FILES]
+                        for data_id in file[JSON_DATA_BLOCKS]})
+
     def get_data_ids_of_file(self,data_file_name):
         """
         Returns a list of all the data blocks containing the given file
@@ -83,20 +128,60 @@ class DataFileMap:
                 if file[JSON_FILE_NAME] == data_file_name:
                     return file[JSON_FILE_SIZE]
 
+    def get_data_file_compression(self, data_file_name):
+        """
+        Returns the codec a data file is compressed with
+        :param data_file_name: a data file name
+        :return: the codec, None if the data file is not compressed
+        """
+        with data.open_data_file(utils.FILE_MAP_FILE_NAME, utils.READ_MODE) as data_file_map:
+            file_data = json.load(data_file_map)
+            for file in file_data[JSON_FILES]:
+                if file[JSON_FILE_NAME] == data_file_name:
+                    return file.get(JSON_COMPRESSION)
+
+    def get_original_file_length(self, data_file_name):
+        """
+        Returns the size of the data file before it was compressed
+        :param data_file_name: a data file name
+        :return: the size of the data file before it was compressed
+        """
+        with data.open_data_file(utils.FILE_MAP_FILE_NAME, utils.READ_MODE) as data_file_map:
+            file_data = json.load(data_file_map)
+            for file in file_data[JSON_FILES]:
+                if file[JSON_FILE_NAME] == data_file_name:
+                    return file.get(JSON_ORIGINAL_SIZE, file[JSON_FILE_SIZE])
+
     def delete_data_file(self, data_file_name):
         """
-        Deletes a data file by deleting all its data blocks
+        Deletes a data file, releasing its references to its data blocks
         :param data_file_name: a data file name
-        :return:
+        :return: the data IDs of the data blocks of the file which no file references anymore
         """
         with data.open_data_file(utils.FILE_MAP_FILE_NAME, utils.READ_WRITE_MODE) as data_file_map:
             file_data = json.load(data_file_map)
             files = file_data[JSON_FILES]
+            references = file_data.get(JSON_REFERENCES, dict())
+            unreferenced_data_ids = list()
             for entry in list(files):
                 if entry[JSON_FILE_NAME] == data_file_name:
                     files.remove(entry)
+                    for data_id in entry[JSON_DATA_BLOCKS]:
+                        if str(data_id) not in references:
+                            unreferenced_data_ids.append(data_id)
+                            continue
+                        references[str(data_id)] -= 1
+                        if not references[str(data_id)]:
+                            del references[str(data_id)]
+                            unreferenced_data_ids.append(data_id)
                     break
+            if unreferenced_data_ids and JSON_FINGERPRINTS in file_data:
+                released = set(unreferenced_data_ids)
+                file_data[JSON_FINGERPRINTS] = {
+                    fingerprint: data_id
+                    for fingerprint, data_id in file_data[JSON_FINGERPRINTS].items()
+                    if data_id not in released}
             data_file_map.seek(utils.FILE_BEGIN)
             json.dump(file_data, data_file_map, indent=utils.JSON_INDENT, sort_keys=True)
             data_file_map.truncate()
-
+        return unreferenced_data_ids
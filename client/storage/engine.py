@@ -0,0 +1,30 @@
+import client.config as config
+import client.storage.utils as utils
+from client.storage.oram import PathORAM
+from client.storage.ring_oram import RingORAM
+
+
+def get_oram_class():
+    """
+    Returns the class of the ORAM engine selected by config.ORAM_ENGINE
+    :return: PathORAM or RingORAM
+    """
+    if config.ORAM_ENGINE == utils.PATH_ORAM_ENGINE:
+        return PathORAM
+    if config.ORAM_ENGINE == utils.RING_ORAM_ENGINE:
+        return RingORAM
+    raise ValueError(f"Unknown ORAM engine {config.ORAM_ENGINE}.")
+
+
+def get_oram(aes_crypto, tree_name=None, height=None, tree_map=None, stash=None):
+    """
+    Returns a tree of the ORAM engine selected by config.ORAM_ENGINE. The engines share the same
+    interface - upload, download, iter_download, download_batch and access_data_block
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :param tree_name: the name of the tree, None for the main tree
+    :param height: the height of the tree, the height of the main tree by default
+    :param tree_map: the map of the tree
+    :param stash: the stash of the tree
+    :return: the tree
+    """
+    return get_oram_class()(aes_crypto, tree_name, height, tree_map, stash)
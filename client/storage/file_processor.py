@@ -1,5 +1,15 @@
+import math
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
 import client.log as log
 import client.config as config
+import client.storage.compression as compression_codecs
 from client.storage.data_file_map import DataFileMap
 from client.storage.tree_map import TreeMap
 from client.storage.stash import Stash
@@ -9,61 +19,457 @@ logger = log.get_logger(__name__)
 
 PADDING = b'0'
 
+# The state of a process splitting a file in parallel - (the cryptographic object, the mapped file,
+# whether the chunks are fingerprinted)
+_split_state = None
+
+
+def _init_split_process(aes_crypto, file_path, deduplication):
+    """
+    Initializes a process splitting a file in parallel, which maps the file into its memory
+    instead of receiving the chunks
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :param file_path: the path of the file
+    :param deduplication: whether the chunks are fingerprinted
+    :return:
+    """
+    global _split_state
+    with open(file_path, 'rb') as file:
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    _split_state = aes_crypto, memoryview(file_map), deduplication
+
+
+def _encrypt_chunks(data_entries):
+    """
+    Pads and encrypts chunks of the file mapped by the process
+    :param data_entries: tuples (data_id, leaf_id, offset) of the chunks
+    :return: tuples (token, fingerprint) of the chunks in the same order, where the fingerprint
+    is None unless the chunks are fingerprinted
+    """
+    aes_crypto, file_view, deduplication = _split_state
+    encrypted_chunks = list()
+    for data_id, leaf_id, offset in data_entries:
+        chunk = file_view[offset:offset + config.BLOCK_SIZE]
+        if len(chunk) != config.BLOCK_SIZE:
+            chunk = bytes(chunk).rjust(config.BLOCK_SIZE, PADDING)
+        encrypted_chunks.append((aes_crypto.encrypt(data_id, chunk, leaf_id),
+                                 aes_crypto.fingerprint(chunk) if deduplication else None))
+    return encrypted_chunks
+
 
 class FileProcessor:
     """
     Responsible for processing file inputs
     """
-    def __init__(self, aes_crypto=None):
+    def __init__(self, aes_crypto=None, tree_map=None):
         self.aes_crypto = aes_crypto
+        self.tree_map = tree_map if tree_map is not None else TreeMap()
         self.data_id_counter = DataFileMap().get_id_counter()
+        # fingerprint -> data ID, of the stored data blocks, or None if chunks are not deduplicated
+        self.fingerprints = None
+        # fingerprint -> data ID, of the data blocks of the file being split
+        self.new_fingerprints = dict()
+        if config.DEDUPLICATION and aes_crypto is not None:
+            self.fingerprints = DataFileMap().get_fingerprints()
+        # The codec the file being split is compressed with, and its size before it was compressed
+        self.compression = None
+        self.original_size = None
+
+    def _add_data_file(self, file_name, file_size, data_ids):
+        """
+        Adds the file which was split to the map of the data files
+        :param file_name: a file name
+        :param file_size: the size of the file, as stored
+        :param data_ids: the data IDs of the data files of the file
+        :return:
+        """
+        DataFileMap().add_data_file(file_name, file_size, data_ids, self.data_id_counter,
+                                    self.new_fingerprints, self.compression, self.original_size)
+
+    def _find_data_block(self, fingerprint):
+        """
+        Finds a stored data block, or a data block of the file being split, of the content of a
+        chunk
+        :param fingerprint: the fingerprint of the chunk, None if chunks are not deduplicated
+        :return: the data ID of the data block, None if there is none
+        """
+        if fingerprint is None:
+            return None
+        if fingerprint in self.new_fingerprints:
+            return self.new_fingerprints[fingerprint]
+        return self.fingerprints.get(fingerprint)
+
+    def _fingerprint(self, chunk):
+        """
+        Returns the fingerprint of a chunk
+        :param chunk: a padded chunk
+        :return: the fingerprint, None if chunks are not deduplicated
+        """
+        if self.fingerprints is None:
+            return None
+        return self.aes_crypto.fingerprint(chunk)
+
+    def _add_fingerprint(self, fingerprint, data_id):
+        """
+        Records the fingerprint of a new data block, which later chunks of the same content reuse
+        :param fingerprint: the fingerprint of the data block, None if chunks are not deduplicated
+        :param data_id: the data ID of the data block
+        :return:
+        """
+        if fingerprint is not None:
+            self.new_fingerprints[fingerprint] = data_id
+
+    def _assign_data_ids(self, count):
+        """
+        Assigns data IDs to the data files of a file, skipping the data ID of dummies
+        :param count: the amount of data files
+        :return: the data IDs
+        """
+        data_ids = list()
+        for _ in range(count):
+            if self.data_id_counter == config.DUMMY_ID:
+                self.data_id_counter += 1
+            data_ids.append(self.data_id_counter)
+            self.data_id_counter += 1
+        return data_ids
+
+    def split_file(self, file_name, file_path, compression=None):
+        """
+        Splits a file on the disk to data files. A file of at least config.PARALLEL_SPLIT_MIN_SIZE
+        bytes is split in parallel. A file which is worth compressing is compressed into a
+        temporary file first, which is split instead
+        :param file_name: a file name
+        :param file_path: the path of the file
+        :param compression: the codec to compress the file with, None for no compression
+        :return:
+        """
+        file_size = os.path.getsize(file_path)
+        if compression is not None:
+            with open(file_path, 'rb') as file:
+                compression = compression_codecs.choose_compression(compression, file, file_size)
+                if compression is not None:
+                    self._split_compressed(file_name, file, file_size, compression)
+                    return
+        if config.SPLIT_WORKERS <= 1 or file_size < config.PARALLEL_SPLIT_MIN_SIZE:
+            with open(file_path, 'rb') as file:
+                self.split(file_name, file.read())
+            return
+        self.split_parallel(file_name, file_path, file_size)
 
-    def split(self, file_name, file_input):
+    def _split_compressed(self, file_name, file, file_size, compression):
+        """
+        Compresses a file into a temporary file, and splits the temporary file to data files
+        :param file_name: a file name
+        :param file: the opened file
+        :param file_size: the size of the file
+        :param compression: the codec to compress the file with
+        :return:
+        """
+        tmp_fd, tmp_file_path = tempfile.mkstemp()
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                shutil.copyfileobj(compression_codecs.CompressedReader(file, compression), tmp_file)
+            logger.info(f"COMPRESSED THE SELECTED FILE WITH {compression} FROM {file_size} TO "
+                        f"{os.path.getsize(tmp_file_path)} BYTES")
+            self.compression = compression
+            self.original_size = file_size
+            self.split_file(file_name, tmp_file_path)
+        finally:
+            os.remove(tmp_file_path)
+
+    def split_parallel(self, file_name, file_path, file_size):
+        """
+        Splits a file to data files on config.SPLIT_WORKERS processes. The data IDs and their leaves
+        are assigned up front, every process maps the file into its memory and pads and encrypts
+        batches of chunks, and the data files are committed to the maps at once
+        :param file_name: a file name
+        :param file_path: the path of the file
+        :param file_size: the size of the file
+        :return:
+        """
+        logger.info(f"LENGTH OF THE SELECTED FILE {file_size} - SPLITTING IN PARALLEL")
+        data_ids = self._assign_data_ids(math.ceil(file_size / config.BLOCK_SIZE))
+        leaf_ids = self.tree_map.add_data_ids(data_ids)
+        data_entries = [(data_id, abs(leaf_id), position * config.BLOCK_SIZE)
+                        for position, (data_id, leaf_id) in enumerate(zip(data_ids, leaf_ids))]
+        batches = [data_entries[position:position + config.SPLIT_BATCH_SIZE]
+                   for position in range(0, len(data_entries), config.SPLIT_BATCH_SIZE)]
+
+        stash = Stash()
+        # The data IDs of the file, where a chunk whose content is already stored references the
+        # stored data block in place of the data ID assigned to it
+        file_data_ids = list()
+        # The client has threads of its own, which forked processes would not safely inherit
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(config.SPLIT_WORKERS, mp_context=context,
+                                     initializer=_init_split_process,
+                                     initargs=(self.aes_crypto, file_path,
+                                               self.fingerprints is not None)) as executor:
+                for batch, encrypted_chunks in zip(batches,
+                                                   executor.map(_encrypt_chunks, batches)):
+                    for (data_id, leaf_id, _), (token, fingerprint) in zip(batch,
+                                                                           encrypted_chunks):
+                        stored_data_id = self._find_data_block(fingerprint)
+                        if stored_data_id is not None:
+                            file_data_ids.append(stored_data_id)
+                            continue
+                        self._add_fingerprint(fingerprint, data_id)
+                        file_data_ids.append(data_id)
+                        stash.add_file(data_id, token, leaf_id)
+                    logger.info(f"ENCRYPTED DATA FILES UP TO ID {batch[-1][0]}")
+        except BaseException:
+            # The data files of a file which was not split entirely are dropped
+            self.tree_map.delete_data_ids(data_ids)
+            stash.delete_data_blocks(data_ids)
+            raise
+        # The data IDs assigned to chunks which reference stored data blocks are not used
+        self.tree_map.delete_data_ids(sorted(set(data_ids) - set(file_data_ids)))
+        self._add_data_file(file_name, file_size, file_data_ids)
+
+    @classmethod
+    def _read_chunks(cls, file):
+        """
+        Reads a file chunk by chunk into a single buffer, padding the last chunk
+        :param file: an opened file
+        :return: the chunks, each valid until the next one is read
+        """
+        buffer = bytearray(config.BLOCK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            size = 0
+            while size < config.BLOCK_SIZE:
+                read = file.readinto(view[size:])
+                if not read:
+                    break
+                size += read
+            if not size:
+                return
+            if size != config.BLOCK_SIZE:
+                logger.info("CHUNK IS SMALLER THAN THE BLOCK SIZE - ADDING PADDING")
+                yield bytes(view[:size]).rjust(config.BLOCK_SIZE, PADDING), size
+                return
+            yield view, size
+
+    def _stash_chunks(self, chunks, data_ids, new_data_ids):
+        """
+        Encrypts chunks into data files in the stash, one at a time. A chunk whose content is
+        already stored references the stored data block instead
+        :param chunks: tuples (chunk, the size of the chunk before padding)
+        :param data_ids: a list the data IDs of the data files are appended to
+        :param new_data_ids: a list the data IDs of the data files added to the stash are appended
+        to
+        :return: tuples (data_id, leaf_id, the size of the chunk before padding) of the data files,
+        where the leaf is None for a stored data block
+        """
+        stash = Stash()
+        for chunk, size in chunks:
+            fingerprint = self._fingerprint(chunk)
+            data_id = self._find_data_block(fingerprint)
+            if data_id is not None:
+                data_ids.append(data_id)
+                yield data_id, None, size
+                continue
+            data_id, = self._assign_data_ids(1)
+            self._add_fingerprint(fingerprint, data_id)
+            data_ids.append(data_id)
+            new_data_ids.append(data_id)
+            leaf_id = self.tree_map.add_data(data_id)
+            stash.add_file(data_id, self.aes_crypto.encrypt(data_id, chunk, abs(leaf_id)),
+                           abs(leaf_id))
+            yield data_id, leaf_id, size
+
+    def split_stream(self, file_name, file, upload, compression=None):
+        """
+        Splits a file into data files and uploads them as they are made, through a pipeline of
+        generators: the file is read (and compressed, if it is worth compressing) a chunk at a
+        time, every chunk is encrypted into the stash, and every config.UPLOAD_WINDOW data files
+        their paths are accessed, which evicts them. Hence the memory and the stash do not grow
+        with the size of the file
+        :param file_name: a file name
+        :param file: the opened file
+        :param upload: a function uploading data entries - tuples of data ids and the leaves they
+        are mapped unto
+        :param compression: the codec to compress the file with, None for no compression
+        :return:
+        """
+        data_ids = list()
+        new_data_ids = list()
+        file_size = 0
+        compression = compression_codecs.choose_compression(compression, file,
+                                                            os.fstat(file.fileno()).st_size)
+        if compression is not None:
+            file = compression_codecs.CompressedReader(file, compression)
+            self.compression = compression
+        data_files = self._stash_chunks(self._read_chunks(file), data_ids, new_data_ids)
+        try:
+            while True:
+                window = list(islice(data_files, config.UPLOAD_WINDOW))
+                if not window:
+                    break
+                data_entries = [(data_id, leaf_id) for data_id, leaf_id, _ in window
+                                if leaf_id is not None]
+                if data_entries:
+                    upload(data_entries)
+                file_size += sum(size for _, _, size in window)
+                logger.info(f"UPLOADED {len(data_ids)} DATA FILES ({file_size} BYTES)")
+        except BaseException:
+            # The data files of a file which was not uploaded entirely are dropped, and the ones
+            # already in the tree are dropped once they are read from it
+            self.tree_map.delete_data_ids(new_data_ids)
+            Stash().delete_data_blocks(new_data_ids)
+            raise
+        if compression is not None:
+            self.original_size = file.size
+            logger.info(f"COMPRESSED THE SELECTED FILE WITH {compression} FROM "
+                        f"{self.original_size} TO {file_size} BYTES")
+        self._add_data_file(file_name, file_size, data_ids)
+
+    def split(self, file_name, file_input, compression=None):
         """
         Given a file, this method splits it to "chunks" which are called data files, each in a
-        fixed size
+        fixed size. A file which is worth compressing is compressed first
         :param file_name: a file name
         :param file_input: the file's data
+        :param compression: the codec to compress the file with, None for no compression
         :return:
         """
         logger.info(f"LENGTH OF THE SELECTED FILE {len(file_input)}")
+        if compression is not None and compression_codecs.is_worth_compressing(
+                compression, file_input[:config.COMPRESSION_SAMPLE_SIZE], len(file_input)):
+            self.compression = compression
+            self.original_size = len(file_input)
+            file_input = compression_codecs.compress(compression, file_input)
+            logger.info(f"LENGTH OF THE SELECTED FILE {len(file_input)} AFTER COMPRESSION")
         data_ids = []
+        # The chunks are views of the file, which are encrypted without being copied first
+        file_view = memoryview(file_input)
         for buffer in range(0, len(file_input), config.BLOCK_SIZE):
+            chunk = file_view[buffer:buffer + config.BLOCK_SIZE]
+            logger.info(f"CHUNK SIZE IS {len(chunk)} AFTER SPLITTING")
+            if len(chunk) != config.BLOCK_SIZE:
+                logger.info("CHUNK IS SMALLER THAN THE BLOCK SIZE - ADDING PADDING")
+                chunk = bytes(chunk).rjust(config.BLOCK_SIZE, PADDING)
+                logger.info(f"CHUNK SIZE {len(chunk)} AFTER PADDING")
+            fingerprint = self._fingerprint(chunk)
+            data_id = self._find_data_block(fingerprint)
+            if data_id is not None:
+                logger.info(f"CHUNK IS ALREADY STORED AS DATA BLOCK WITH ID {data_id}")
+                data_ids.append(data_id)
+                continue
             if self.data_id_counter == config.DUMMY_ID:
                 self.data_id_counter += 1
             data_id = self.data_id_counter
             self.data_id_counter += 1
+            self._add_fingerprint(fingerprint, data_id)
             data_ids.append(data_id)
-            chunk = file_input[buffer:buffer + config.BLOCK_SIZE]
-            logger.info(f"CHUNK SIZE IS {len(chunk)} AFTER SPLITTING")
-            if len(chunk) != config.BLOCK_SIZE:
-                logger.info("CHUNK IS SMALLER THAN THE BLOCK SIZE - ADDING PADDING")
-                chunk = chunk.rjust(config.BLOCK_SIZE, PADDING)
-                logger.info(f"CHUNK SIZE {len(chunk)} AFTER PADDING")
-            token = self.aes_crypto.encrypt(data_id, chunk)
+            leaf_id = self.tree_map.add_data(data_id)
+            token = self.aes_crypto.encrypt(data_id, chunk, abs(leaf_id))
             logger.info(f"CHUNK SIZE IS {len(token)} AFTER ENCRYPTION")
-            Stash().add_file(data_id, token)
-            TreeMap().add_data(data_id)
-        DataFileMap().add_data_file(file_name, len(file_input), data_ids, self.data_id_counter)
+            Stash().add_file(data_id, token, abs(leaf_id))
+        self._add_data_file(file_name, len(file_input), data_ids)
+
+    @classmethod
+    def write_data_block(cls, fd, position, data_block, expected_file_len):
+        """
+        Writes a data block straight to its offset in a file, so data blocks may be written in any
+        order. The padding of the last data block is dropped by its offset
+        :param fd: the file descriptor of the file, preallocated to expected_file_len bytes
+        :param position: the position of the data block in the file
+        :param data_block: the data block - a tuple (data_id, plaintext)
+        :param expected_file_len: the expected size of the file
+        :return:
+        """
+        offset = position * config.BLOCK_SIZE
+        plaintext_chunk = memoryview(data_block[1])
+        remaining_len = expected_file_len - offset
+        if remaining_len <= 0 or len(plaintext_chunk) != config.BLOCK_SIZE:
+            raise FileSizeError("File size of the downloaded file is not correct.")
+        if remaining_len < config.BLOCK_SIZE:
+            logger.info(f"UNPADDING THE CHUNK WITH ID {data_block[0]}")
+            plaintext_chunk = plaintext_chunk[-remaining_len:]
+        cls.write_data(fd, plaintext_chunk, offset)
+
+    @classmethod
+    def write_data(cls, fd, data, offset):
+        """
+        Writes data straight to its offset in a file
+        :param fd: the file descriptor of the file
+        :param data: the data
+        :param offset: the offset of the data in the file
+        :return:
+        """
+        data = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
 
-    def join(self, data_blocks, expected_file_len):
+    @classmethod
+    def _unpad_data_blocks(cls, data_blocks, expected_file_len):
         """
-        Joins data blocks (equivalent to data files) into a file, restoring it
+        Drops the padding of the last of the data blocks of a file, as they come
+        :param data_blocks: the data blocks of the file, in order - tuples (data_id, plaintext)
+        :param expected_file_len: the expected size of the file, as stored
+        :return: the chunks of the file, in order
+        """
+        offset = 0
+        for data_block in data_blocks:
+            plaintext_chunk = memoryview(data_block[1])
+            remaining_len = expected_file_len - offset
+            if remaining_len <= 0 or len(plaintext_chunk) != config.BLOCK_SIZE:
+                raise FileSizeError("File size of the downloaded file is not correct.")
+            if remaining_len < config.BLOCK_SIZE:
+                logger.info(f"UNPADDING THE CHUNK WITH ID {data_block[0]}")
+                plaintext_chunk = plaintext_chunk[-remaining_len:]
+            offset += len(plaintext_chunk)
+            yield plaintext_chunk
+        if expected_file_len != offset:
+            raise FileSizeError("File size of the downloaded file is not correct.")
+
+    @classmethod
+    def decompress_data_blocks(cls, data_blocks, expected_file_len, compression):
+        """
+        Decompresses the data blocks of a compressed file as they come, so the file is restored
+        without its compressed form being joined first
+        :param data_blocks: the data blocks of the file, in order - tuples (data_id, plaintext)
+        :param expected_file_len: the expected size of the file, as stored
+        :param compression: the codec the file is compressed with
+        :return: the decompressed file, piece by piece
+        """
+        return compression_codecs.decompress_chunks(
+            compression, cls._unpad_data_blocks(data_blocks, expected_file_len))
+
+    def join(self, data_blocks, expected_file_len, compression=None):
+        """
+        Joins data blocks (equivalent to data files) into a file, restoring it. The data blocks of
+        a compressed file are decompressed as they are joined
         :param data_blocks: data blocks
-        :param expected_file_len: the expected size of the data
+        :param expected_file_len: the expected size of the data, as stored
+        :param compression: the codec the file is compressed with, None if it is not compressed
         :return:
         """
-        plaintext = bytearray()
+        if compression is not None:
+            plaintext = bytearray()
+            for data in self.decompress_data_blocks(data_blocks, expected_file_len, compression):
+                plaintext += data
+            return plaintext
+
+        # The data blocks are copied straight into their place in the file
+        plaintext = bytearray(expected_file_len)
+        offset = 0
         for pos, data_block in enumerate(data_blocks):
             logger.info(f"JOINING DATA BLOCK WITH ID {data_block[0]}")
-            plaintext_chunk = data_block[1]
+            plaintext_chunk = memoryview(data_block[1])
             if pos == len(data_blocks) - 1:
-                remaining_len = expected_file_len - len(plaintext)
+                remaining_len = expected_file_len - offset
                 plaintext_chunk = plaintext_chunk[-remaining_len:]
                 logger.info(f"UNPADDING THE CHUNK WITH ID {data_block[0]}")
-            plaintext.extend(plaintext_chunk)
+            if offset + len(plaintext_chunk) > expected_file_len:
+                raise FileSizeError("File size of the downloaded file is not correct.")
+            plaintext[offset:offset + len(plaintext_chunk)] = plaintext_chunk
+            offset += len(plaintext_chunk)
 
-        if expected_file_len != len(plaintext):
+        if expected_file_len != offset:
             raise FileSizeError("File size of the downloaded file is not correct.")
 
         return plaintext
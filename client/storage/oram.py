@@ -1,8 +1,13 @@
 import math
+import random
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
 import client.log as log
-from client.storage.exceptions import DummyFileFound
 import client.config as config
+import client.storage.utils as utils
+from client.storage.bucket import BUCKET_SIZE, DUMMY_SLOT, SLOT_HEADER_SIZE, SLOT_SIZE, \
+    deserialize_bucket
 from client.cloud.cloud import Cloud
 from client.storage.stash import Stash
 from client.storage.tree_map import TreeMap
@@ -14,15 +19,63 @@ class PathORAM:
     """
     The PathORAM Tree which facilitates the protocol for which the user uploads file to the server
     """
-    # The maximal size amounts of block in the PathORAM Tree
-    MAX_ORAM_BLOCK_SIZE = int(math.pow(2, config.ORAM_HEIGHT + 1) - 1)
+    # Whether the accesses of uploading and downloading many data blocks may be pipelined
+    PIPELINED = True
 
-    # The maximal storage the PathORAM Tree can contain
-    MAX_ORAM_STORAGE_SIZE = MAX_ORAM_BLOCK_SIZE * config.BLOCK_SIZE
+    # The threads encrypting and decrypting the buckets of paths, shared by every PathORAM Tree
+    _crypto_executor = None
 
-    def __init__(self, aes_crypto):
-        self.cloud = Cloud(aes_crypto)
+    def __init__(self, aes_crypto, tree_name=None, height=None, tree_map=None, stash=None):
         self.aes_crypto = aes_crypto
+        self._open_cloud(tree_name)
+        self.height = height if height is not None else config.ORAM_HEIGHT
+        self.tree_map = tree_map if tree_map is not None else TreeMap()
+        self.stash = stash if stash is not None else Stash()
+        # The data IDs being deleted, whose data blocks are dropped once they are read from the tree
+        self.deleted_data_ids = set()
+        self.cache_treetop()
+
+    def _open_cloud(self, tree_name):
+        """
+        Opens the server's cloud the tree is kept in
+        :param tree_name: the name of the tree, None for the main PathORAM Tree
+        :return:
+        """
+        self.cloud = Cloud(self.aes_crypto, tree_name)
+
+    def cache_treetop(self):
+        """
+        Keeps the buckets of the top levels of the tree in the client's memory, so an access
+        transfers only the buckets below them
+        :return:
+        """
+        bucket_size = self.aes_crypto.token_size(BUCKET_SIZE, self.cloud.cipher_suite)
+        levels = self.get_treetop_levels(bucket_size)
+        self.cloud.cache_treetop(self.get_max_oram_node_size(levels - 1))
+
+    def get_treetop_levels(self, node_size):
+        """
+        Returns the amount of top levels of the tree whose buckets are cached by the client - up to
+        config.TREETOP_CACHE_LEVELS levels, as many as fit in config.TREETOP_CACHE_MEMORY_LIMIT
+        :param node_size: the memory the encrypted bucket of a node takes in terms of bytes
+        :return: the amount of levels, 0 for none
+        """
+        levels = min(config.TREETOP_CACHE_LEVELS, self.height + 1)
+        while levels and self.get_max_oram_node_size(levels - 1) * node_size > \
+                config.TREETOP_CACHE_MEMORY_LIMIT:
+            levels -= 1
+        return levels
+
+    @classmethod
+    def get_max_oram_node_size(cls, height=None):
+        """
+        Returns the amount of nodes (buckets) in the PathORAM Tree
+        :param height: the height of the tree, the height of the main tree by default
+        :return: the amount of nodes (buckets) in the PathORAM Tree
+        """
+        if height is None:
+            height = config.ORAM_HEIGHT
+        return int(math.pow(2, height + 1) - 1)
 
     @classmethod
     def get_max_oram_block_size(cls):
@@ -30,7 +83,7 @@ class PathORAM:
         Returns the maximal size amounts of block in the PathORAM Tree
         :return: maximal size amounts of block in the PathORAM Tree
         """
-        return cls.MAX_ORAM_BLOCK_SIZE
+        return cls.get_max_oram_node_size() * config.BUCKET_CAPACITY
 
     @classmethod
     def get_max_oram_storage_size(cls):
@@ -38,14 +91,56 @@ class PathORAM:
         Returns the maximal storage the PathORAM can contain
         :return: the maximal storage the PathORAM can contain
         """
-        return cls.MAX_ORAM_STORAGE_SIZE
+        return cls.get_max_oram_block_size() * config.BLOCK_SIZE
+
+    @classmethod
+    def _crypto_map(cls, function, *iterables):
+        """
+        Applies a function to the items of iterables on the threads of config.CRYPTO_WORKERS. The
+        cryptography package releases the GIL while encrypting, so the items are processed in
+        parallel
+        :param function: the function
+        :param iterables: the iterables of the arguments of the function
+        :return: the results, in the order of the items
+        """
+        if config.CRYPTO_WORKERS <= 1:
+            return list(map(function, *iterables))
+        if cls._crypto_executor is None:
+            cls._crypto_executor = ThreadPoolExecutor(config.CRYPTO_WORKERS)
+        return list(cls._crypto_executor.map(function, *iterables))
 
     def setup_cloud(self):
         """
         Sets up the server's cloud
         :return:
         """
-        self.cloud.setup_cloud(self.get_max_oram_block_size())
+        self.cloud.setup_cloud(self.get_max_oram_node_size(self.height))
+
+    def grow(self):
+        """
+        Grows the tree by a level, doubling its leaves, while its data blocks stay in place. The
+        leaves of the tree before it grew become inner nodes, so every data block is still on the
+        path of the leaf it is mapped unto, and it is remapped unto a leaf of the grown tree once it
+        is read. An interrupted growth resumes by growing again
+        :return:
+        """
+        height = self.height + 1
+        self.cloud.grow_cloud(self.get_max_oram_node_size(self.height),
+                              self.get_max_oram_node_size(height))
+        self.height = height
+        self.tree_map.set_height(height)
+        self.cache_treetop()
+
+    def _extend_leaf(self, leaf):
+        """
+        Extends a leaf of the tree before it grew to a random leaf under it, so the path accessed
+        for a data block which was not remapped yet is as long as any other path
+        :param leaf: a leaf, of the current tree or of the tree before it grew
+        :return: a leaf of the current tree
+        """
+        while leaf < (1 << self.height) - 1:
+            leaf = 2 * leaf + 1 + random.randrange(2)
+        return leaf
 
     def path_to_leaf(self, leaf):
         """
@@ -55,19 +150,7 @@ class PathORAM:
         :return: the path to a leaf, that is the nodes needed to be traversed in order to reach
         the given leaf
         """
-        path = [0] * (config.ORAM_HEIGHT + 1)
-        min_leaf = config.MIN_LEAF
-        max_leaf = config.MAX_LEAF
-        for cur_level in range(config.ORAM_HEIGHT):
-            # binary search
-            mid = ((max_leaf - min_leaf) // 2) + min_leaf
-            if leaf <= mid:
-                path[cur_level + 1] = (path[cur_level] * 2) + 1
-                max_leaf = mid
-            else:
-                path[cur_level + 1] = (path[cur_level] * 2) + 2
-                min_leaf = mid + 1
-        return path
+        return utils.path_to_leaf(leaf, self.height)
 
     def path_to_root(self, leaf):
         """
@@ -75,15 +158,18 @@ class PathORAM:
         :param leaf: a leaf in the PathORAM tree
         :return: the path to the root from a given leaf
         """
-        return self.path_to_leaf(leaf)[::-1]
+        return utils.path_to_root(self._extend_leaf(leaf))
 
-    def get_potential_data_entries(self):
+    def paths_to_root(self, leaves):
         """
-        Returns the potential data entries
-        :return: potential data entries
+        Returns the paths to the root from many leaves at once
+        :param leaves: leaves in the PathORAM tree
+        :return: the paths to the root from the given leaves
         """
-        potential_data_ids = Stash().get_potential_data_ids()
-        return TreeMap().get_data_entries(potential_data_ids)
+        if not leaves:
+            return list()
+        leaves = [self._extend_leaf(leaf) for leaf in leaves]
+        return utils.paths_to_leaves(leaves, self.height)[:, ::-1].tolist()
 
     def decrypt_data_block(self, token):
         """
@@ -96,14 +182,49 @@ class PathORAM:
 
     def upload(self, data_entries):
         """
-        Upload data blocks, represented by data entries
+        Upload data blocks, represented by data entries. The paths of config.ACCESS_BATCH_SIZE
+        data blocks are accessed at a time
         :param data_entries: data entries - tuples of data ids and the leaves they mapped unto
         :return:
         """
-        for data_entry in data_entries:
-            leaf_id = abs(data_entry[1])
-            path_to_root = self.path_to_root(leaf_id)
-            self._access(path_to_root)
+        leaf_ids = [abs(data_entry[1]) for data_entry in data_entries]
+        batches = [leaf_ids[position:position + config.ACCESS_BATCH_SIZE]
+                   for position in range(0, len(leaf_ids), config.ACCESS_BATCH_SIZE)]
+        if config.PIPELINED_ACCESS and self.PIPELINED:
+            for _ in self._access_pipelined(batches, self._plan_upload):
+                pass
+            return
+        for batch in batches:
+            self._access_batch(batch)
+
+    def delete(self, data_ids):
+        """
+        Deletes data blocks. Unless the tree map drops the data blocks of deleted data IDs once
+        they are read, the data IDs are removed from the tree map one by one, and the paths of the
+        leaves the data blocks were mapped unto are accessed, config.ACCESS_BATCH_SIZE at a time,
+        and the data blocks are dropped as they are read. A data block which is in the stash is
+        dropped from it, and a random path is accessed in its place
+        :param data_ids: data ids
+        :return:
+        """
+        if self.tree_map.LAZY_DELETION:
+            self.tree_map.delete_data_ids(data_ids)
+            self.stash.delete_data_blocks(data_ids)
+            return
+        leaf_ids = list()
+        for data_id in data_ids:
+            leaf_id = self.tree_map.remove_leaf_id(data_id)
+            # in stash
+            if leaf_id <= 0:
+                leaf_id = config.get_random_leaf_id(self.height)
+            leaf_ids.append(leaf_id)
+        # The data blocks of the stash are dropped first, so they are not evicted in the meantime
+        self.stash.delete_data_blocks(data_ids)
+        self.deleted_data_ids = set(data_ids)
+        for position in range(0, len(data_ids), config.ACCESS_BATCH_SIZE):
+            self._access_batch(leaf_ids[position:position + config.ACCESS_BATCH_SIZE],
+                               data_ids[position:position + config.ACCESS_BATCH_SIZE])
+        self.deleted_data_ids = set()
 
     def download(self, data_ids):
         """
@@ -111,123 +232,444 @@ class PathORAM:
         :param data_ids: data ids
         :return: data blocks
         """
-        data_blocks = list()
+        return list(self.iter_download(data_ids))
+
+    def iter_download(self, data_ids):
+        """
+        Downloads data blocks config.ACCESS_BATCH_SIZE at a time, given data ids, so the data
+        blocks of a batch may be consumed before the next batch is downloaded
+        :param data_ids: data ids
+        :return: data blocks, in the same order
+        """
+        batches = [data_ids[position:position + config.ACCESS_BATCH_SIZE]
+                   for position in range(0, len(data_ids), config.ACCESS_BATCH_SIZE)]
+        if config.PIPELINED_ACCESS and self.PIPELINED:
+            for batch, wanted_data_blocks in zip(
+                    batches, self._access_pipelined(batches, self._plan_download)):
+                for data_block in self._get_data_blocks(batch, wanted_data_blocks):
+                    yield data_block
+            return
+        for batch in batches:
+            for data_block in self.download_batch(batch):
+                yield data_block
+
+    def download_batch(self, data_ids):
+        """
+        Downloads data blocks in a single access of the union of their paths. A data block which
+        is in the stash is read from it, and a random path is accessed in its place
+        :param data_ids: data ids
+        :return: data blocks, in the same order
+        """
+        nodes, wanted_data_ids, stash_data_blocks = self._plan_download(data_ids)
+        # in server
+        wanted_data_blocks = self._access_nodes(nodes, wanted_data_ids)
+        wanted_data_blocks.update(stash_data_blocks)
+        return self._get_data_blocks(data_ids, wanted_data_blocks)
+
+    @classmethod
+    def _get_data_blocks(cls, data_ids, wanted_data_blocks):
+        """
+        Returns the data blocks of data IDs out of the wanted data blocks which were found
+        :param data_ids: data ids
+        :param wanted_data_blocks: the wanted data blocks which were found - data ID -> plaintext
+        :return: data blocks - tuples (data_id, plaintext), or None for a data block which was not
+        found, in the same order
+        """
+        return [(data_id, wanted_data_blocks[data_id]) if data_id in wanted_data_blocks else None
+                for data_id in data_ids]
+
+    def _plan_upload(self, leaf_ids):
+        """
+        Plans the access of a batch of uploaded data blocks
+        :param leaf_ids: the leaves the data blocks are mapped unto
+        :return: tuple (the nodes to access from the deepest to the root, the data IDs of the
+        wanted data blocks, the wanted data blocks of the stash - data ID -> plaintext)
+        """
+        return self._get_union_nodes(leaf_ids), (), dict()
+
+    def _plan_download(self, data_ids):
+        """
+        Plans the access of a batch of downloaded data blocks. A data block which is in the stash
+        is read from it, and a random path is accessed in its place. A data block which occurs
+        again in the batch is accessed once, and a random path is accessed in place of the rest
+        :param data_ids: data ids
+        :return: tuple (the nodes to access from the deepest to the root, the data IDs of the
+        wanted data blocks, the wanted data blocks of the stash - data ID -> plaintext)
+        """
+        leaf_ids = list()
+        # data ID -> plaintext, of the data blocks in the stash
+        stash_data_blocks = dict()
+        accessed_data_ids = set()
         for data_id in data_ids:
-            leaf_id = TreeMap().get_leaf_id(data_id)
+            if data_id in accessed_data_ids:
+                self.tree_map.access_dummy_entry()
+                leaf_ids.append(config.get_random_leaf_id(self.height))
+                continue
+            accessed_data_ids.add(data_id)
+            leaf_id = self.tree_map.access_leaf_id(data_id)
             # in stash
             if leaf_id < 0:
                 logger.info("PATH ORAM - ACCESS STASH")
-                tagged_data_block = Stash().get_data_block(data_id)
-                ciphertext = tagged_data_block[1]
-                data_block = self.decrypt_data_block(ciphertext)
-            # in server
-            else:
-                path_to_root = self.path_to_root(leaf_id)
-                data_block = self._access(path_to_root, data_id)
-            data_blocks.append(data_block)
-        return data_blocks
+                stash_data_blocks[data_id] = self._read_stash(data_id)
+                leaf_id = config.get_random_leaf_id(self.height)
+            leaf_ids.append(leaf_id)
+        return (self._get_union_nodes(leaf_ids),
+                [data_id for data_id in data_ids if data_id not in stash_data_blocks],
+                stash_data_blocks)
 
-    def _access(self, path_to_root, wanted_data_id=None):
+    def _get_union_nodes(self, leaf_ids):
+        """
+        Returns the union of the paths of many leaves
+        :param leaf_ids: leaves
+        :return: the nodes of the union, from the deepest to the root
+        """
+        # Deeper nodes have larger IDs, so the eviction fills the union from the leaves up
+        return sorted({node for path_to_root in self.paths_to_root(leaf_ids)
+                       for node in path_to_root}, reverse=True)
+
+    def access_data_block(self, data_id, update=None):
+        """
+        Reads a single data block and potentially replaces its content. A data block which was
+        never written is created with zeroed content. Unlike download, a path of the tree is
+        accessed even if the data block is in the stash, so every call costs exactly one access of
+        the tree, and one of its map. For a data block in the stash, or a new one, a random path is
+        accessed, as the leaf it is mapped unto is revealed only once it is read from the tree
+        :param data_id: a data ID
+        :param update: a function from the current plaintext of the data block to its new
+        plaintext, or None for only reading the data block
+        :return: the plaintext of the data block before the update
+        """
+        leaf_id = self.tree_map.access_leaf_id(data_id)
+        if leaf_id == 0:
+            leaf_id = self.tree_map.add_data(data_id)
+            plaintext = bytes(config.BLOCK_SIZE)
+            self.stash.add_file(data_id, self.aes_crypto.encrypt(data_id, plaintext, abs(leaf_id)),
+                                abs(leaf_id), plaintext)
+        # in stash
+        if leaf_id < 0:
+            plaintext = self._read_stash(data_id)
+            if update is not None:
+                updated_plaintext = update(plaintext)
+                self.stash.add_file(data_id, self.aes_crypto.encrypt(data_id, updated_plaintext,
+                                                                     abs(leaf_id)),
+                                    abs(leaf_id), updated_plaintext)
+            self._access(self.path_to_root(config.get_random_leaf_id(self.height)))
+            return plaintext
+        # in server
+        data_block = self._access(self.path_to_root(leaf_id), data_id, update)
+        return data_block[1] if data_block is not None else None
+
+    def access_dummy(self):
+        """
+        Accesses a random path of the tree, and the map of the tree by a dummy access, costing the
+        same as access_data_block
+        :return:
+        """
+        self.tree_map.access_dummy_entry()
+        self._access(self.path_to_root(config.get_random_leaf_id(self.height)))
+
+    def _read_stash(self, data_id):
+        """
+        Reads the plaintext of a data block in the stash, decrypting its token unless the stash
+        keeps its plaintext
+        :param data_id: a data ID
+        :return: the plaintext of the data block
+        """
+        plaintext = self.stash.get_plaintext(data_id)
+        if plaintext is None:
+            _, plaintext = self.decrypt_data_block(self.stash.get_data_block(data_id)[1])
+        return plaintext
+
+    def _access(self, path_to_root, wanted_data_id=None, update=None):
         """
         Accesses the PathORAM tree, given a path to the root and potentially a data block of a
-        wanted data file
+        wanted data file. The path is read and written back within a single exchange with the
+        server's cloud
         :param path_to_root: a list of notes which consists a path to the root
         :param wanted_data_id: a data block labeled with an ID that potentially we want to get
+        :param update: a function from the plaintext of the wanted data block to its new
+        plaintext, if it should be replaced
         :return: a data block - could be "garbage" data block or a data block we actually want to
         join into a file
         """
-        read_path_data_blocks = self._read_path(path_to_root)
-        data_block = self._write_stash(read_path_data_blocks, wanted_data_id)
-        self._write_path(path_to_root)
-        logger.info(f"STASH SIZE - {Stash().size}")
-        return data_block
+        wanted_data_ids = (wanted_data_id,) if wanted_data_id is not None else ()
+        wanted_data_blocks = self._access_nodes(path_to_root, wanted_data_ids, update)
+        if wanted_data_id in wanted_data_blocks:
+            return wanted_data_id, wanted_data_blocks[wanted_data_id]
+        return None
+
+    def _access_batch(self, leaf_ids, wanted_data_ids=()):
+        """
+        Accesses the paths of many leaves at once. The buckets the paths share near the root are
+        read and written back once, and the stash is evicted along the union of the paths
+        :param leaf_ids: leaves
+        :param wanted_data_ids: the data IDs of data blocks we want to get
+        :return: the wanted data blocks which were found - data ID -> plaintext
+        """
+        if not leaf_ids:
+            return dict()
+        return self._access_nodes(self._get_union_nodes(leaf_ids), wanted_data_ids)
+
+    def _access_nodes(self, nodes, wanted_data_ids=(), update=None):
+        """
+        Accesses nodes of the PathORAM tree, given from the deepest to the root. The nodes are read
+        and written back within a single exchange with the server's cloud
+        :param nodes: the nodes, from the deepest to the root
+        :param wanted_data_ids: the data IDs of data blocks we want to get
+        :param update: a function from the plaintext of a wanted data block to its new
+        plaintext, if it should be replaced
+        :return: the wanted data blocks which were found - data ID -> plaintext
+        """
+        wanted_data_blocks = None
+        node_data_ids = None
+
+        def write_back(buckets):
+            nonlocal wanted_data_blocks, node_data_ids
+            logger.info(f"READ PATH - DOWNLOADED NODES {nodes}")
+            wanted_data_blocks = self._write_stash(self._open_buckets(buckets), wanted_data_ids,
+                                                   update)
+            node_data_ids = self._evict(nodes)
+            return self._seal_buckets(nodes, node_data_ids)
+
+        self.cloud.access_path(nodes, write_back)
+        self._remove_evicted(node_data_ids)
+        logger.info(f"STASH SIZE - {self.stash.size}")
+        return wanted_data_blocks
+
+    def _access_pipelined(self, batches, plan):
+        """
+        Accesses the nodes of batches one after another, where the nodes of an access which the
+        previous access does not write are downloaded while the previous access evicts the stash
+        and writes its nodes back. The nodes the accesses share are not downloaded, but taken from
+        the buckets the previous access wrote. An access is planned only once the previous access
+        read its nodes into the stash, so the tree map it is planned by is up to date
+        :param batches: the batches to access
+        :param plan: a function from a batch to tuple (the nodes to access from the deepest to the
+        root, the data IDs of the wanted data blocks, the wanted data blocks of the stash - data
+        ID -> plaintext)
+        :return: the wanted data blocks which were found by every access, in the order of the
+        batches - data ID -> plaintext
+        """
+        batches = iter(batches)
+        batch = next(batches, None)
+        if batch is None:
+            return
+        pending = self._begin_access(plan(batch), ())
+        # node -> the encrypted bucket the previous access wrote to the node
+        written_buckets = dict()
+        while pending is not None:
+            (nodes, wanted_data_ids, wanted_data_blocks), server_nodes, read = pending
+            downloaded_buckets = dict(zip(server_nodes, read.result()))
+            logger.info(f"READ PATH - DOWNLOADED NODES {server_nodes}")
+            buckets = [downloaded_buckets[node] if node in downloaded_buckets else
+                       written_buckets[node] for node in nodes]
+            wanted_data_blocks.update(self._write_stash(self._open_buckets(buckets),
+                                                        wanted_data_ids))
+            batch = next(batches, None)
+            pending = self._begin_access(plan(batch), nodes) if batch is not None else None
+            node_data_ids = self._evict(nodes)
+            sealed_buckets = self._seal_buckets(nodes, node_data_ids)
+            self.cloud.write_path_async(nodes, sealed_buckets)
+            self._remove_evicted(node_data_ids)
+            logger.info(f"STASH SIZE - {self.stash.size}")
+            written_buckets = dict(zip(nodes, sealed_buckets))
+            yield wanted_data_blocks
+
+    def _begin_access(self, access_plan, previous_nodes):
+        """
+        Begins downloading the nodes of a planned access which the previous access does not write
+        :param access_plan: tuple (the nodes to access from the deepest to the root, the data IDs
+        of the wanted data blocks, the wanted data blocks of the stash - data ID -> plaintext)
+        :param previous_nodes: the nodes of the previous access
+        :return: tuple (the plan, the downloaded nodes, a future of their encrypted buckets)
+        """
+        previous_nodes = set(previous_nodes)
+        server_nodes = [node for node in access_plan[0] if node not in previous_nodes]
+        logger.info(f"READ PATH - DOWNLOADING FROM NODES {server_nodes}")
+        return access_plan, server_nodes, self.cloud.read_path_async(server_nodes)
 
     def _read_path(self, path_to_root):
         """
         The Read Path in the algorithm of maintaining the tree as described in the paper of
-        Stefanov et al.
+        Stefanov et al. The whole path is downloaded in a single round trip
         :param path_to_root: a list of notes which consists a path to the root
-        :return: data blocks
+        :return: data blocks - tuples (data_id, leaf_id, plaintext)
         """
-        data_blocks = list()
-        for node in path_to_root:
-            logger.info(f"READ PATH - DOWNLOADING FROM NODE {node}")
-            data_block = self._read_node(node)
-            data_blocks.append(data_block)
-        return data_blocks
+        logger.info(f"READ PATH - DOWNLOADING FROM NODES {path_to_root}")
+        return self._open_buckets(self.cloud.read_path(path_to_root))
 
-    def _read_node(self, node):
+    def _open_buckets(self, buckets):
         """
-        Reads a node from the server's cloud, that is, a data block, as each node in the PathORAM
-        tree is in fact a data block
-        :param node: a node in the PathORAM tree which is in fact a data block
-        :return: the data block (as data)
+        Decrypts the buckets of nodes, each containing config.BUCKET_CAPACITY data blocks which
+        are encrypted as a whole
+        :param buckets: encrypted buckets
+        :return: the real data blocks of the buckets - tuples (data_id, leaf_id, plaintext)
         """
-        return self.cloud.node_download(node)
+        # Every bucket is decrypted straight into its own part of a single buffer, and the data
+        # blocks are views of it. The buckets are decrypted in parallel
+        buffer = memoryview(bytearray(sum(len(bucket) for bucket in buckets)))
+        views = list()
+        offset = 0
+        for bucket in buckets:
+            views.append(buffer[offset:offset + len(bucket)])
+            offset += len(bucket)
+        sizes = self._crypto_map(self.aes_crypto.decrypt_bucket_into, buckets, views)
 
-    def _write_stash(self, downloaded_data_blocks, wanted_data_file_id=None):
+        data_blocks = list()
+        for view, size in zip(views, sizes):
+            data_blocks.extend(deserialize_bucket(view[:size]))
+        return data_blocks
+
+    def _write_stash(self, downloaded_data_blocks, wanted_data_file_ids=(), update=None):
         """
         The Write Stash in the algorithm of maintaining the tree as described in the paper of
-        :param downloaded_data_blocks: downloaded data blocks from the server's cloud
-        :param wanted_data_file_id: a data file labeled with ID we potentially would want to draw
+        :param downloaded_data_blocks: the real data blocks of the buckets downloaded from the
+        server's cloud - tuples (data_id, leaf_id, plaintext)
+        :param wanted_data_file_ids: data files labeled with IDs we potentially would want to draw
         from the tree
-        :return: None if not data block is desired, else an actual data block
-        """
-        wanted_data_block = None
-        for data_block in downloaded_data_blocks:
-            try:
-                data_id, plaintext = self.decrypt_data_block(data_block)
-                if TreeMap().data_id_exist(data_id):
-                    logger.info(f"WRITE STASH - DOWNLOADED DATA FILE WITH ID {data_id}")
-                    token = self.aes_crypto.encrypt(data_id, plaintext)
-                    Stash().add_file(data_id, token)
-                    if wanted_data_file_id is not None and wanted_data_file_id == data_id:
-                        TreeMap().choose_fresh_leaf_id(data_id)
-                        wanted_data_block = data_id, plaintext
-                    else:
-                        TreeMap().update_leaf_id(data_id, False)
-            except DummyFileFound:
-                logger.info("WRITE STASH - DOWNLOADED DUMMY FILE")
-                pass
-        return wanted_data_block
+        :param update: a function from the plaintext of a wanted data block to its new
+        plaintext, if it should be replaced
+        :return: the wanted data blocks which were found - data ID -> plaintext
+        """
+        wanted_data_blocks = dict()
+        # tuples (data_id, leaf_id, plaintext) of the data blocks to add to the stash
+        stash_data_blocks = list()
+        for data_id, leaf_id, plaintext in downloaded_data_blocks:
+            if self.tree_map.data_id_exist(data_id) and data_id not in self.deleted_data_ids:
+                logger.info(f"WRITE STASH - DOWNLOADED DATA FILE WITH ID {data_id}")
+                if data_id in wanted_data_file_ids:
+                    # The wanted data block outlives the buffer of the path
+                    plaintext = bytes(plaintext)
+                    wanted_data_blocks[data_id] = plaintext
+                    if update is not None:
+                        plaintext = update(plaintext)
+                    leaf_id = self.tree_map.choose_fresh_leaf_id(data_id)
+                elif self.tree_map.REMAP_GROWN_LEAVES and abs(leaf_id) < (1 << self.height) - 1:
+                    # The data block is mapped unto a leaf of the tree before it grew
+                    leaf_id = self.tree_map.choose_fresh_leaf_id(data_id)
+                else:
+                    self.tree_map.update_leaf_id(data_id, False, leaf_id)
+                    leaf_id = self.tree_map.get_leaf_id(data_id)
+                # The stash keeps the plaintext, which outlives the buffer of the path
+                stash_data_blocks.append((data_id, abs(leaf_id), bytes(plaintext)))
+
+        # The data blocks are encrypted in parallel, and added to the stash together
+        tokens = self._crypto_map(
+            lambda data_block: self.aes_crypto.encrypt(data_block[0], data_block[2], data_block[1]),
+            stash_data_blocks)
+        self.stash.add_files([(data_id, token, leaf_id, plaintext)
+                              for (data_id, leaf_id, plaintext), token in zip(stash_data_blocks,
+                                                                              tokens)])
+        return wanted_data_blocks
 
     def _write_path(self, path_to_root):
         """
         The Write Path in the algorithm of maintaining the tree as described in the paper of
+        Stefanov et al. The whole path is uploaded in a single round trip
         :param path_to_root: a list of notes which consists a path to the root
         :return:
         """
         # Note that the algorithm implemented here is as described in the paper of Stefanov et al.
-        # As such, there is no eviction per say, but there is indeed a way of handling overflows.
-        for node in path_to_root:
-            potential_data_entries = self.get_potential_data_entries()
-            is_potential_data_block = False
-            for potential_data_entry in potential_data_entries:
-                potential_leaf_id = abs(potential_data_entry[1])
-                potential_path = self.path_to_root(potential_leaf_id)
-                if node in potential_path:
-                    is_potential_data_block = True
-                    # Recall that data entry = (data_id, leaf_id)
-                    data_id = potential_data_entry[0]
-                    data_block = Stash().get_data_block(data_id)
-                    # Write to the server
-                    self._write_node(node, data_block[1])
-                    logger.info(f"WRITE PATH - UPLOAD TO NODE {node} DATA BLOCK WITH ID {data_id}")
-                    # Update leaf ID means the leaf ID will be updated to positive to denote that
-                    # the data block uploaded to server (as it was negative before)
-                    TreeMap().update_leaf_id(data_id, True)
-                    Stash().delete_data_block(data_id)
-                    break
-                if not is_potential_data_block:
-                    # Write dummy data block to that node instead
-                    self._write_node(node)
-                    logger.info(f"WRITE PATH - UPLOAD TO NODE {node} DUMMY DATA BLOCK")
+        node_data_ids = self._evict(path_to_root)
+        self.cloud.write_path(path_to_root, self._seal_buckets(path_to_root, node_data_ids))
+        self._remove_evicted(node_data_ids)
 
-    def _write_node(self, node, data_file=None):
+    def _seal_buckets(self, path_to_root, node_data_ids):
         """
-        Uploads a PathORAM node to the server's cloud, that is, a data block
-        :param node: a node in the PathORAM tree
-        :param data_file: a data file if exists, else None
+        Encrypts the buckets of a path, given the data blocks of the stash evicted to each node
+        :param path_to_root: a list of notes which consists a path to the root
+        :param node_data_ids: the data IDs to write to each node of the path, in the same order
+        :return: the encrypted buckets, in the same order
+        """
+        cipher_suite = self.cloud.cipher_suite
+        token_size = self.aes_crypto.token_size(BUCKET_SIZE, cipher_suite)
+        tokens = memoryview(bytearray(len(path_to_root) * token_size))
+        # The data blocks of the stash are copied, or decrypted unless the stash keeps their
+        # plaintext, straight into the slots of the buckets. The decryption of a slot may run past
+        # its end, hence every bucket has room for a whole token past its last slot
+        stride = BUCKET_SIZE + self.aes_crypto.max_block_token_size()
+        plaintexts = memoryview(bytearray(len(path_to_root) * stride))
+        # The stash is read up front, as it is not safe to read from many threads
+        node_data_blocks = [[(data_id, self.stash.get_data_block(data_id)[1],
+                              self.stash.get_leaf_id(data_id), self.stash.get_plaintext(data_id))
+                             for data_id in data_ids]
+                            for data_ids in node_data_ids]
+
+        def seal(position):
+            bucket = plaintexts[position * stride:(position + 1) * stride]
+            data_blocks = node_data_blocks[position]
+            for slot, data_block in enumerate(data_blocks):
+                self._open_slot(bucket[slot * SLOT_SIZE:], *data_block)
+            # The free slots of the bucket are filled with dummy data blocks
+            for slot in range(len(data_blocks), config.BUCKET_CAPACITY):
+                bucket[slot * SLOT_SIZE:(slot + 1) * SLOT_SIZE] = DUMMY_SLOT
+            token = tokens[position * token_size:(position + 1) * token_size]
+            self.aes_crypto.encrypt_bucket_into(bucket[:BUCKET_SIZE], token, cipher_suite)
+            return token
+
+        buckets = self._crypto_map(seal, range(len(path_to_root)))
+        for node, data_ids in zip(path_to_root, node_data_ids):
+            logger.info(f"WRITE PATH - UPLOAD TO NODE {node} {len(data_ids)} DATA BLOCKS")
+        return buckets
+
+    def _open_slot(self, view, data_id, token, leaf_id, plaintext=None):
+        """
+        Decrypts a data block of the stash straight into a slot of a bucket, or copies its
+        plaintext if the stash keeps it
+        :param view: a view of the bucket from the slot on
+        :param data_id: the data ID of the data block
+        :param token: the token of the data block
+        :param leaf_id: the leaf the data block is mapped unto in the stash
+        :param plaintext: the plaintext of the data block, if the stash keeps it
+        :return:
+        """
+        if plaintext is not None:
+            if len(plaintext) != config.BLOCK_SIZE:
+                raise ValueError(f"Data block must be {config.BLOCK_SIZE} bytes.")
+            struct.pack_into(config.HEADER_FORMAT_CHAR, view, 0, data_id, abs(leaf_id))
+            view[SLOT_HEADER_SIZE:SLOT_SIZE] = plaintext
+            return
+        _, token_leaf_id, data = self.aes_crypto.decrypt_block_into(token, view)
+        if len(data) != config.BLOCK_SIZE:
+            raise ValueError(f"Data block must be {config.BLOCK_SIZE} bytes.")
+        if token_leaf_id is None:
+            # Tokens of the legacy version do not carry the leaf, so the slot is laid out anew
+            view[SLOT_HEADER_SIZE:SLOT_SIZE] = bytes(data)
+            struct.pack_into(config.HEADER_FORMAT_CHAR, view, 0, data_id, abs(leaf_id))
+
+    def _remove_evicted(self, node_data_ids):
+        """
+        Removes the data blocks which were written to the server's cloud from the stash
+        :param node_data_ids: the data IDs written to each node of a path
         :return:
         """
-        self.cloud.node_upload(node, data_file)
+        evicted_data_ids = [data_id for data_ids in node_data_ids for data_id in data_ids]
+        for data_id in evicted_data_ids:
+            # Update leaf ID means the leaf ID will be updated to positive to denote that
+            # the data block uploaded to server (as it was negative before)
+            self.tree_map.update_leaf_id(data_id, True)
+        self.stash.delete_data_blocks(evicted_data_ids)
+
+    def _evict(self, path_to_root):
+        """
+        The greedy eviction of the stash unto a path: a single pass from the leaf up to the root,
+        in which each node takes up to config.BUCKET_CAPACITY data blocks of the stash which may be
+        written to it. Hence, every data block is written as deep as possible. The stash indexes
+        its data blocks by the nodes on their paths, so the data blocks which may be written to a
+        node are found without scanning the stash. The union of many paths is evicted the same way,
+        given its nodes from the deepest up
+        :param path_to_root: a list of notes which consists a path to the root
+        :return: the data IDs to write to each node of the path, in the same order
+        """
+        evicted_data_ids = set()
+        node_data_ids = list()
+        for node in path_to_root:
+            data_ids = list()
+            for potential_data_id in self.stash.get_data_ids_of_node(node):
+                if len(data_ids) == config.BUCKET_CAPACITY:
+                    break
+                if potential_data_id not in evicted_data_ids:
+                    data_ids.append(potential_data_id)
+                    evicted_data_ids.add(potential_data_id)
+            node_data_ids.append(data_ids)
+        return node_data_ids
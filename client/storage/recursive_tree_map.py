@@ -0,0 +1,398 @@
+import math
+from array import array
+
+import client.log as log
+import client.config as config
+import client.deployment as deployment
+import client.storage.utils as utils
+import client.storage.engine as engine
+from client.cloud.cloud import Cloud
+from client.storage.data_file_map import DataFileMap
+from client.storage.tree_map import TreeMap, EMPTY_LEAF, LEAF_TYPE_CODE
+from client.storage.stash import Stash
+
+logger = log.get_logger(__name__)
+
+# The amount of position map entries packed into a single block
+ENTRIES_PER_BLOCK = config.BLOCK_SIZE // array(LEAF_TYPE_CODE).itemsize
+
+
+def get_address_space(level):
+    """
+    Returns the amount of data IDs addressed by the position map of a tree. The tree of level 0 is
+    the main PathORAM Tree, and the tree of level i > 0 stores the position map of the tree of
+    level i - 1
+    :param level: the level of the tree
+    :return: the amount of data IDs addressed by the position map of the tree
+    """
+    address_space = config.POSITION_MAP_ADDRESS_SPACE
+    for _ in range(level):
+        address_space = math.ceil(address_space / ENTRIES_PER_BLOCK)
+    return address_space
+
+
+def get_height(level):
+    """
+    Returns the height of the tree of the given level
+    :param level: the level of the tree
+    :return: the height of the tree
+    """
+    if level == 0:
+        return config.ORAM_HEIGHT
+    return max(1, (get_address_space(level) - 1).bit_length())
+
+
+def get_tree_name(level):
+    """
+    Returns the name of the tree of the given level
+    :param level: the level of the tree
+    :return: the name of the tree, None for the main PathORAM Tree
+    """
+    if level == 0:
+        return None
+    return utils.POSITION_MAP_TREE_NAME % level
+
+
+def get_stash_folder_name(level):
+    """
+    Returns the folder name of the stash of the tree of the given level
+    :param level: the level of the tree
+    :return: the folder name of the stash
+    """
+    if level == 0:
+        return utils.STASH_FOLDER_NAME
+    return utils.POSITION_MAP_STASH_FOLDER_NAME % level
+
+
+def get_tree_map_file_name(level):
+    """
+    Returns the file name of the position map of the tree of the given level which is kept on the
+    client
+    :param level: the level of the tree
+    :return: the file name of the position map
+    """
+    if level == 0:
+        return utils.TREE_MAP_FILE_NAME
+    return utils.POSITION_MAP_FILE_NAME % level
+
+
+def get_recursion_levels():
+    """
+    Returns the amount of levels of trees whose position map is stored recursively. It is computed
+    from the address space the deployment is set up with, and kept as the address space grows, so
+    a position map stays stored the way it was set up
+    :return: the amount of levels
+    """
+    if config.POSITION_MAP_LEVELS is None:
+        levels = 0
+        while (config.POSITION_MAP_RECURSION and
+               get_address_space(levels) > config.POSITION_MAP_RECURSION_CUTOFF):
+            levels += 1
+        config.POSITION_MAP_LEVELS = levels
+    return config.POSITION_MAP_LEVELS
+
+
+def is_recursive(level):
+    """
+    Checks if the position map of the tree of the given level is stored recursively
+    :param level: the level of the tree
+    :return: True/False
+    """
+    return level < get_recursion_levels()
+
+
+def get_tree_map(aes_crypto, level=0):
+    """
+    Returns the position map of the tree of the given level, according to the configuration
+    :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+    :param level: the level of the tree
+    :return: a TreeMap or a RecursiveTreeMap object
+    """
+    if is_recursive(level):
+        return RecursiveTreeMap(aes_crypto, level)
+    return TreeMap(get_tree_map_file_name(level), get_height(level))
+
+
+class RecursiveTreeMap:
+    """
+    A map of a PathORAM Tree which is packed into blocks and stored in a smaller PathORAM Tree on
+    the server, whose map may be recursive as well. Only the mapping of data blocks which are in
+    the stash is kept on the client, which is what the eviction needs. The mapping of every other
+    data block costs one access of the smaller tree, and reading the data block from the tree
+    costs none, as its leaf is packed with the data block itself. As in recursive PathORAM, an
+    access of a data block reads its leaf and maps it unto a fresh leaf in a single access of the
+    smaller tree, and a data block in the stash costs a dummy access in its place, so the smaller
+    tree is accessed the same whether the data block is in the stash or not
+    """
+    # Deleted data IDs are not kept on the client, so the data blocks of a data ID are dropped from
+    # the tree as it is deleted
+    LAZY_DELETION = False
+
+    # Remapping a data ID costs an access of the tree of the map, so a data block mapped unto a leaf
+    # of the tree before it grew keeps it until the data block itself is accessed
+    REMAP_GROWN_LEAVES = False
+
+    _instances = dict()
+
+    def __new__(cls, aes_crypto, level=0):
+        if level not in cls._instances:
+            tree_map = super(RecursiveTreeMap, cls).__new__(cls)
+            tree_map._load(aes_crypto, level)
+            cls._instances[level] = tree_map
+        return cls._instances[level]
+
+    def _load(self, aes_crypto, level):
+        """
+        Loads the map and sets up the tree which stores it
+        :param aes_crypto: a cryptographic object for encrypting and decrypting data blocks
+        :param level: the level of the tree the map maps unto
+        :return:
+        """
+        self.level = level
+        self.height = get_height(level)
+        self.address_space = get_address_space(level)
+        # data ID -> signed leaf, of the data blocks in the stash only. The stash keeps the leaf of
+        # every data block in it, so this part of the map is restored from the stash
+        self.stash_leaves = {data_id: -leaf_id for data_id, leaf_id in
+                             Stash(get_stash_folder_name(level)).leaves.items()}
+        # data ID -> leaf, of the data blocks being accessed, which were mapped unto the leaf as
+        # their leaf was read, and are mapped so in the stash once they are read into it
+        self.fresh_leaves = dict()
+
+        map_level = level + 1
+        self.oram = engine.get_oram(aes_crypto, get_tree_name(map_level), get_height(map_level),
+                                    get_tree_map(aes_crypto, map_level),
+                                    Stash(get_stash_folder_name(map_level)))
+        self.oram.setup_cloud()
+
+    def _access_entry(self, data_id, leaf_id=None):
+        """
+        Reads the leaf of a data ID from the tree of the map, potentially replacing it
+        :param data_id: a data ID
+        :param leaf_id: a new leaf, or None for only reading the leaf
+        :return: the leaf before the update, EMPTY_LEAF if the data ID is not mapped
+        """
+        block_id, offset = divmod(data_id, ENTRIES_PER_BLOCK)
+
+        def update(plaintext):
+            leaves = array(LEAF_TYPE_CODE, plaintext)
+            leaves[offset] = leaf_id
+            return leaves.tobytes()
+
+        plaintext = self.oram.access_data_block(block_id, update if leaf_id is not None else None)
+        return array(LEAF_TYPE_CODE, plaintext)[offset]
+
+    def _write_entries(self, entries):
+        """
+        Writes the leaves of many data IDs to the tree of the map. The entries packed into the same
+        block of the map are written together, in a single access of the tree of the map
+        :param entries: tuples (data_id, leaf_id), where leaf_id is a leaf, or EMPTY_LEAF for
+        removing the data ID
+        :return:
+        """
+        # block ID -> tuples (offset, leaf) of the entries packed into the block
+        block_entries = dict()
+        for data_id, leaf_id in entries:
+            block_id, offset = divmod(data_id, ENTRIES_PER_BLOCK)
+            block_entries.setdefault(block_id, list()).append((offset, leaf_id))
+
+        for block_id, entries in block_entries.items():
+            def update(plaintext, entries=entries):
+                leaves = array(LEAF_TYPE_CODE, plaintext)
+                for offset, leaf_id in entries:
+                    leaves[offset] = leaf_id
+                return leaves.tobytes()
+            self.oram.access_data_block(block_id, update)
+
+    def add_data(self, data_id):
+        """
+        Adds a new mapping of a data block to a leaf
+        :param data_id: a data ID of a data file
+        :return: the signed leaf of the data block
+        """
+        return self.add_data_ids([data_id])[0]
+
+    def add_data_ids(self, data_ids):
+        """
+        Adds new mappings of many data blocks to leaves
+        :param data_ids: data IDs of data files
+        :return: the signed leaves of the data blocks, in the same order
+        """
+        if data_ids and max(data_ids) >= self.address_space:
+            self.grow_address_space(max(data_ids) + 1)
+        leaf_ids = list()
+        entries = list()
+        for data_id in data_ids:
+            # The fresh leaf of a data ID which was accessed is already in the tree of the map
+            if data_id in self.fresh_leaves:
+                leaf_id = self.fresh_leaves.pop(data_id)
+            else:
+                leaf_id = config.get_random_leaf_id(self.height)
+                entries.append((data_id, leaf_id))
+            leaf_ids.append(-leaf_id)
+        self.stash_leaves.update(zip(data_ids, leaf_ids))
+        self._write_entries(entries)
+        return leaf_ids
+
+    def delete_data_ids(self, data_ids):
+        """
+        Deletes the data IDs from the map, leaving EMPTY_LEAF in their entries in the tree of the
+        map. Their data blocks must have been dropped from the tree, as a data block read from it
+        is not looked up in the map
+        :param data_ids: data IDs
+        :return:
+        """
+        for data_id in data_ids:
+            self.stash_leaves.pop(data_id, None)
+        self._write_entries((data_id, EMPTY_LEAF) for data_id in data_ids)
+
+    def remove_leaf_id(self, data_id):
+        """
+        Deletes a data ID from the map, reading its leaf and leaving EMPTY_LEAF in its entry in a
+        single access of the tree of the map, whether its data block is in the stash or not. Its
+        data block must be dropped from the tree once it is read from it
+        :param data_id: a data ID
+        :return: the signed leaf before, EMPTY_LEAF if the data ID was not mapped
+        """
+        leaf_id = self._access_entry(data_id, EMPTY_LEAF)
+        return self.stash_leaves.pop(data_id, leaf_id)
+
+    def get_data_entries(self, data_ids):
+        """
+        Returns the mapping of data IDs unto leaves
+        :param data_ids: data IDs
+        :return: tuples of (data_ID, leaf_ID)
+        """
+        data_entries = list()
+        for data_id in data_ids:
+            leaf_id = self.get_leaf_id(data_id)
+            if leaf_id != EMPTY_LEAF:
+                data_entries.append((data_id, leaf_id))
+        return data_entries
+
+    def set_height(self, height):
+        """
+        Sets the height of the tree the map maps unto, once the tree grew. The tree of the map
+        grows only with the address space of the map
+        :param height: the height of the tree
+        :return:
+        """
+        self.height = height
+
+    def grow_address_space(self, address_space):
+        """
+        Grows the address space of the map to at least a given amount of data IDs, doubling it as
+        many times as needed, and records it in the per-deployment configuration. The tree of the
+        map grows to hold the blocks the new data IDs are packed into, and so do the trees of the
+        maps below it
+        :param address_space: the amount of data IDs
+        :return:
+        """
+        if address_space <= self.address_space:
+            return
+        while get_address_space(self.level) < address_space:
+            config.POSITION_MAP_ADDRESS_SPACE *= 2
+        logger.info(f"GROWING THE ADDRESS SPACE OF THE POSITION MAP TO "
+                    f"{config.POSITION_MAP_ADDRESS_SPACE} DATA IDS")
+        # The buckets written so far are kept by the server as the trees grow
+        Cloud.flush()
+        self._grow()
+        deployment.save_deployment(config.get_deployment())
+
+    def _grow(self):
+        """
+        Grows the tree of the map, and the trees of the maps below it, to the address space of
+        their levels
+        :return:
+        """
+        self.address_space = get_address_space(self.level)
+        map_level = self.level + 1
+        while self.oram.height < get_height(map_level):
+            self.oram.grow()
+        if is_recursive(map_level):
+            self.oram.tree_map._grow()
+
+    def get_leaf_id(self, data_id):
+        """
+        Gets the mapping of a given data ID
+        :param data_id: data ID
+        :return: the mapping of a given data ID
+        """
+        if data_id in self.stash_leaves:
+            return self.stash_leaves[data_id]
+        return self._access_entry(data_id)
+
+    def access_leaf_id(self, data_id):
+        """
+        Gets the mapping of a data ID whose data block is accessed, and maps it unto a fresh leaf
+        in the same access of the tree of the map. The fresh leaf is taken by choose_fresh_leaf_id
+        once the data block is read into the stash. A data block in the stash keeps its leaf, and
+        the tree of the map is accessed by a dummy access instead
+        :param data_id: a data ID
+        :return: the signed leaf before, EMPTY_LEAF if the data ID was not mapped
+        """
+        if data_id in self.stash_leaves:
+            self.oram.access_dummy()
+            return self.stash_leaves[data_id]
+        leaf_id = config.get_random_leaf_id(self.height)
+        self.fresh_leaves[data_id] = leaf_id
+        return self._access_entry(data_id, leaf_id)
+
+    def access_dummy_entry(self):
+        """
+        Accesses the tree of the map by a dummy access, costing the same as the access of the
+        mapping of a data ID
+        :return:
+        """
+        self.oram.access_dummy()
+
+    def update_leaf_id(self, data_id, is_uploaded, leaf_id=None):
+        """
+        Updates the mapping of data ID
+        :param data_id: a data ID
+        :param is_uploaded: a boolean value describing if the data block labeled by the given
+        data ID is uploaded to the server's cloud
+        :param leaf_id: the leaf the data block was read from, if known
+        :return:
+        """
+        if is_uploaded:
+            self.stash_leaves.pop(data_id, None)
+            return
+        if leaf_id is None:
+            leaf_id = self.get_leaf_id(data_id)
+        self.stash_leaves[data_id] = -abs(leaf_id)
+
+    def choose_fresh_leaf_id(self, data_id):
+        """
+        Chooses randomly new mapping for a given data block labeled by the given data ID. The
+        fresh leaf chosen as the data ID was accessed is taken, without accessing the tree of the
+        map again
+        :param data_id: a data ID
+        :return: the new signed leaf
+        """
+        if data_id in self.fresh_leaves:
+            leaf_id = -self.fresh_leaves.pop(data_id)
+        else:
+            leaf_id = -config.get_random_leaf_id(self.height)
+            self._access_entry(data_id, abs(leaf_id))
+        self.stash_leaves[data_id] = leaf_id
+        return leaf_id
+
+    def data_id_exist(self, data_id):
+        """
+        Checks if a data block labeled by the given data ID is in the PathORAM Tree or not,
+        virtually checks if data ID is of an actual data block or of a dummy file. The data blocks
+        of deleted data IDs are dropped from the tree as they are deleted, so every data block
+        read from the tree exists
+        :param data_id: a data ID
+        :return:
+        """
+        return data_id != config.DUMMY_ID
+
+    def count_data_ids(self):
+        """
+        Counts the amount of data blocks uploaded to the PathORAM Tree
+        :return:
+        """
+        # The map itself does not hold every data ID, but the data file map does
+        return DataFileMap().count_data_ids()
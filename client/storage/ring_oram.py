@@ -0,0 +1,382 @@
+import random
+import struct
+
+import client.log as log
+import client.config as config
+import client.storage.utils as utils
+from client.storage.bucket import DUMMY_SLOT, SLOT_SIZE
+from client.storage.oram import PathORAM
+from client.cloud.cloud import Cloud
+
+logger = log.get_logger(__name__)
+
+# The amount of slots of a bucket - config.BUCKET_CAPACITY for data blocks, and the rest for dummies
+RING_BUCKET_SLOTS = config.BUCKET_CAPACITY + config.RING_ORAM_DUMMY_SLOTS
+
+# The metadata of a bucket is the amount of times it was read since it was written, followed by
+# (data ID, whether the slot was not read yet) of every slot
+METADATA_HEADER_FORMAT = '>I'
+METADATA_SLOT_FORMAT = '>Q?'
+METADATA_HEADER_SIZE = struct.calcsize(METADATA_HEADER_FORMAT)
+METADATA_SLOT_SIZE = struct.calcsize(METADATA_SLOT_FORMAT)
+
+JSON_EVICTIONS = 'evictions'
+JSON_ACCESSES = 'accesses'
+
+
+def serialize_metadata(read_count, slots):
+    """
+    Serializes the metadata of a bucket
+    :param read_count: the amount of times the bucket was read since it was written
+    :param slots: lists [data_id, valid] of the slots of the bucket
+    :return: the serialized metadata
+    """
+    metadata = bytearray(METADATA_HEADER_SIZE + len(slots) * METADATA_SLOT_SIZE)
+    struct.pack_into(METADATA_HEADER_FORMAT, metadata, 0, read_count)
+    for position, (data_id, valid) in enumerate(slots):
+        struct.pack_into(METADATA_SLOT_FORMAT, metadata,
+                         METADATA_HEADER_SIZE + position * METADATA_SLOT_SIZE, data_id, valid)
+    return metadata
+
+
+def deserialize_metadata(metadata):
+    """
+    Deserializes the metadata of a bucket
+    :param metadata: the serialized metadata
+    :return: tuple (read_count, slots), where slots are lists [data_id, valid]
+    """
+    read_count, = struct.unpack_from(METADATA_HEADER_FORMAT, metadata, 0)
+    slots = [list(struct.unpack_from(METADATA_SLOT_FORMAT, metadata, offset))
+             for offset in range(METADATA_HEADER_SIZE, len(metadata), METADATA_SLOT_SIZE)]
+    return read_count, slots
+
+
+def get_dummy_metadata():
+    """
+    Returns the metadata of a bucket of dummies which was not read yet
+    :return: tuple (read_count, slots)
+    """
+    return 0, [[config.DUMMY_ID, True] for _ in range(RING_BUCKET_SLOTS)]
+
+
+class RingORAM(PathORAM):
+    """
+    The Ring ORAM Tree of Ren et al., behind the same interface as the PathORAM Tree. Every bucket
+    has config.RING_ORAM_DUMMY_SLOTS dummy slots on top of config.BUCKET_CAPACITY slots, in a random
+    permutation recorded in the encrypted metadata of the bucket. An access reads the metadata of
+    the path and then a single slot of every bucket - the wanted data block where it is, and an
+    unread dummy elsewhere. Every config.RING_ORAM_EVICTION_RATE accesses, the stash is evicted
+    along paths in reverse-lexicographic order, and a bucket which ran out of unread dummies is
+    reshuffled early. The slots and the metadata are kept by the server as two flat trees
+    """
+    # The slots an access reads are chosen by the metadata it reads first, and evictions write
+    # paths in between accesses, hence the accesses are not pipelined
+    PIPELINED = False
+
+    def __init__(self, aes_crypto, tree_name=None, height=None, tree_map=None, stash=None):
+        super().__init__(aes_crypto, tree_name, height, tree_map, stash)
+        # The schedule of the evictions carries over between runs of the client
+        engine_state = self.cloud.load_engine_state() or dict()
+        # The amount of evictions so far, which selects the path of the next eviction
+        self.eviction_count = engine_state.get(JSON_EVICTIONS, 0)
+        # The amount of accesses since the last eviction
+        self.access_count = engine_state.get(JSON_ACCESSES, 0)
+
+    def _open_cloud(self, tree_name):
+        """
+        Opens the server's clouds the tree is kept in - one of the slots, so every slot is a node of
+        its own on the server, and one of the metadata of the buckets
+        :param tree_name: the name of the tree, None for the main Ring ORAM Tree
+        :return:
+        """
+        if tree_name is None:
+            slots_tree_name = utils.RING_ORAM_TREE_NAME
+        else:
+            slots_tree_name = utils.RING_ORAM_SUBTREE_NAME % tree_name
+        self.cloud = Cloud(self.aes_crypto, slots_tree_name)
+        self.metadata_cloud = Cloud(self.aes_crypto, utils.RING_ORAM_METADATA_TREE_NAME %
+                                    slots_tree_name)
+
+    def cache_treetop(self):
+        """
+        Keeps the slots and the metadata of the buckets of the top levels of the tree in the
+        client's memory, so an access transfers only those of the buckets below them
+        :return:
+        """
+        slot_size = self.aes_crypto.token_size(SLOT_SIZE, self.cloud.cipher_suite)
+        metadata_size = self.aes_crypto.token_size(
+            METADATA_HEADER_SIZE + RING_BUCKET_SLOTS * METADATA_SLOT_SIZE,
+            self.metadata_cloud.cipher_suite)
+        levels = self.get_treetop_levels(RING_BUCKET_SLOTS * slot_size + metadata_size)
+        node_count = self.get_max_oram_node_size(levels - 1)
+        self.cloud.cache_treetop(node_count * RING_BUCKET_SLOTS)
+        self.metadata_cloud.cache_treetop(node_count)
+
+    def setup_cloud(self):
+        """
+        Sets up the server's cloud - the slots with dummy data blocks, and the metadata of buckets
+        of dummies
+        :return:
+        """
+        node_count = self.get_max_oram_node_size(self.height)
+        self.cloud.setup_cloud(node_count * RING_BUCKET_SLOTS, DUMMY_SLOT)
+        self.metadata_cloud.setup_cloud(node_count, serialize_metadata(*get_dummy_metadata()))
+
+    def grow(self):
+        """
+        Grows the tree by a level the same way the PathORAM Tree grows - the slots and the metadata
+        of the new buckets are set up as buckets of dummies which were not read yet
+        :return:
+        """
+        height = self.height + 1
+        node_count = self.get_max_oram_node_size(self.height)
+        grown_node_count = self.get_max_oram_node_size(height)
+        self.cloud.grow_cloud(node_count * RING_BUCKET_SLOTS, grown_node_count * RING_BUCKET_SLOTS,
+                              DUMMY_SLOT)
+        self.metadata_cloud.grow_cloud(node_count, grown_node_count,
+                                       serialize_metadata(*get_dummy_metadata()))
+        self.height = height
+        self.tree_map.set_height(height)
+        self.cache_treetop()
+
+    def download_batch(self, data_ids):
+        """
+        Downloads data blocks one access at a time, each on the path of its own leaf, as an access
+        reads a single slot of every bucket and wanted data blocks may share a bucket. A data block
+        which is in the stash is read from it, and a random path is accessed in its place
+        :param data_ids: data ids
+        :return: data blocks, in the same order
+        """
+        data_blocks = list()
+        for data_id in data_ids:
+            leaf_id = self.tree_map.access_leaf_id(data_id)
+            # in stash
+            if leaf_id < 0:
+                logger.info("RING ORAM - ACCESS STASH")
+                data_blocks.append((data_id, self._read_stash(data_id)))
+                self._access(self.path_to_root(config.get_random_leaf_id(self.height)))
+                continue
+            # in server
+            data_blocks.append(self._access(self.path_to_root(leaf_id), data_id))
+        return data_blocks
+
+    def _access_batch(self, leaf_ids, wanted_data_ids=()):
+        """
+        Accesses the paths of many leaves, one at a time, as every access reads a single slot of
+        a bucket. Hence, of the wanted data blocks which share a bucket only one is found
+        :param leaf_ids: leaves
+        :param wanted_data_ids: the data IDs of data blocks we want to get
+        :return: the wanted data blocks which were found - data ID -> plaintext
+        """
+        wanted_data_blocks = dict()
+        remaining_data_ids = set(wanted_data_ids)
+        for leaf_id in leaf_ids:
+            found_data_blocks = self._access_nodes(self.path_to_root(leaf_id), remaining_data_ids)
+            wanted_data_blocks.update(found_data_blocks)
+            remaining_data_ids.difference_update(found_data_blocks)
+        return wanted_data_blocks
+
+    def _access_nodes(self, nodes, wanted_data_ids=(), update=None):
+        """
+        Accesses a path of the Ring ORAM tree. The metadata of the path is read and written back
+        within a single exchange with the server's cloud, and in between a single slot of every
+        bucket is read. The access is followed by the early reshuffles and the eviction it is due
+        :param nodes: the nodes of the path, from the leaf to the root
+        :param wanted_data_ids: the data IDs of data blocks we want to get
+        :param update: a function from the plaintext of a wanted data block to its new
+        plaintext, if it should be replaced
+        :return: the wanted data blocks which were found - data ID -> plaintext
+        """
+        wanted_data_blocks = None
+        metadata = None
+
+        def write_back(metadata_tokens):
+            nonlocal wanted_data_blocks, metadata
+            metadata = self._open_metadata(metadata_tokens)
+            wanted_data_blocks = self._write_stash(
+                self._read_slots(nodes, metadata, wanted_data_ids), wanted_data_ids, update)
+            return [self._seal_metadata(*bucket_metadata) for bucket_metadata in metadata]
+
+        self.metadata_cloud.access_path(nodes, write_back)
+        # The metadata read on the access is current until the buckets are written again, hence
+        # the early reshuffles precede the eviction
+        self._early_reshuffle(nodes, metadata)
+        self.access_count += 1
+        if self.access_count >= config.RING_ORAM_EVICTION_RATE:
+            self.access_count = 0
+            self._evict_path()
+        self.cloud.update_engine_state({JSON_EVICTIONS: self.eviction_count,
+                                        JSON_ACCESSES: self.access_count})
+        logger.info(f"STASH SIZE - {self.stash.size}")
+        return wanted_data_blocks
+
+    def _open_metadata(self, metadata_tokens):
+        """
+        Decrypts the metadata of buckets
+        :param metadata_tokens: the encrypted metadata
+        :return: lists [read_count, slots] of the buckets, in the same order
+        """
+        return [list(deserialize_metadata(self.aes_crypto.decrypt_bucket(metadata_token)))
+                for metadata_token in metadata_tokens]
+
+    def _seal_metadata(self, read_count, slots):
+        """
+        Encrypts the metadata of a bucket
+        :param read_count: the amount of times the bucket was read since it was written
+        :param slots: lists [data_id, valid] of the slots of the bucket
+        :return: the encrypted metadata
+        """
+        return self.aes_crypto.encrypt_bucket(serialize_metadata(read_count, slots),
+                                              self.metadata_cloud.cipher_suite)
+
+    def _read_slots(self, nodes, metadata, wanted_data_ids):
+        """
+        Reads a single slot of every bucket of a path: a wanted data block which is in the bucket,
+        and otherwise an unread dummy. The slots read are marked as read in the metadata, which is
+        updated in place
+        :param nodes: the nodes of the path
+        :param metadata: lists [read_count, slots] of the buckets of the path, in the same order
+        :param wanted_data_ids: the data IDs of data blocks we want to get
+        :return: the real data blocks read - tuples (data_id, leaf_id, plaintext)
+        """
+        slot_ids = list()
+        # The positions (in slot_ids) of the slots which hold real data blocks
+        real_positions = list()
+        for node, bucket_metadata in zip(nodes, metadata):
+            slots = bucket_metadata[1]
+            valid_slots = [slot for slot in range(len(slots)) if slots[slot][1]]
+            wanted_slots = [slot for slot in valid_slots if slots[slot][0] in wanted_data_ids]
+            if wanted_slots:
+                slot = wanted_slots[0]
+            else:
+                # An early reshuffle leaves every bucket an unread dummy, which holds unless the
+                # configuration changed in between
+                dummy_slots = [slot for slot in valid_slots if slots[slot][0] == config.DUMMY_ID]
+                slot = random.choice(dummy_slots or valid_slots or range(len(slots)))
+            if slots[slot][1] and slots[slot][0] != config.DUMMY_ID:
+                real_positions.append(len(slot_ids))
+            slots[slot][1] = False
+            bucket_metadata[0] += 1
+            slot_ids.append(node * RING_BUCKET_SLOTS + slot)
+
+        logger.info(f"READ PATH - DOWNLOADING SLOTS {slot_ids}")
+        slot_tokens = self.cloud.read_path(slot_ids)
+        return self._open_buckets([slot_tokens[position] for position in real_positions])
+
+    def _read_buckets(self, nodes, metadata):
+        """
+        Reads the unread data blocks of buckets into the stash, together with unread dummies up to
+        config.BUCKET_CAPACITY slots of every bucket
+        :param nodes: the nodes of the buckets
+        :param metadata: lists [read_count, slots] of the buckets, in the same order
+        :return:
+        """
+        slot_ids = list()
+        real_positions = list()
+        for node, (_, slots) in zip(nodes, metadata):
+            real_slots = [slot for slot in range(len(slots))
+                          if slots[slot][1] and slots[slot][0] != config.DUMMY_ID]
+            dummy_slots = [slot for slot in range(len(slots))
+                           if slots[slot][1] and slots[slot][0] == config.DUMMY_ID]
+            dummy_slots = random.sample(
+                dummy_slots, max(0, min(len(dummy_slots), config.BUCKET_CAPACITY - len(real_slots))))
+            real_positions.extend(range(len(slot_ids), len(slot_ids) + len(real_slots)))
+            slot_ids.extend(node * RING_BUCKET_SLOTS + slot for slot in real_slots + dummy_slots)
+
+        if not slot_ids:
+            return
+        logger.info(f"READ BUCKETS - DOWNLOADING SLOTS {slot_ids}")
+        slot_tokens = self.cloud.read_path(slot_ids)
+        self._write_stash(self._open_buckets([slot_tokens[position]
+                                              for position in real_positions]))
+
+    def _write_buckets(self, nodes):
+        """
+        Evicts the stash unto buckets and writes them anew - every bucket in a fresh random
+        permutation of its slots, with metadata of a bucket which was not read yet
+        :param nodes: the nodes of the buckets, from the deepest up
+        :return:
+        """
+        node_data_ids = self._evict(nodes)
+        cipher_suite = self.cloud.cipher_suite
+        token_size = self.aes_crypto.token_size(SLOT_SIZE, cipher_suite)
+        slot_ids = list()
+        # tuples (data_id, token, leaf_id, plaintext) of the data blocks of the slots, None for
+        # dummies
+        slot_data_blocks = list()
+        metadata_tokens = list()
+        for node, data_ids in zip(nodes, node_data_ids):
+            read_count, slots = get_dummy_metadata()
+            for slot, data_id in zip(random.sample(range(RING_BUCKET_SLOTS), len(data_ids)),
+                                     data_ids):
+                slots[slot][0] = data_id
+            metadata_tokens.append(self._seal_metadata(read_count, slots))
+            for slot, (data_id, _) in enumerate(slots):
+                slot_ids.append(node * RING_BUCKET_SLOTS + slot)
+                if data_id == config.DUMMY_ID:
+                    slot_data_blocks.append(None)
+                else:
+                    slot_data_blocks.append((data_id, self.stash.get_data_block(data_id)[1],
+                                             self.stash.get_leaf_id(data_id),
+                                             self.stash.get_plaintext(data_id)))
+            logger.info(f"WRITE BUCKET - UPLOAD TO NODE {node} {len(data_ids)} DATA BLOCKS")
+
+        tokens = memoryview(bytearray(len(slot_ids) * token_size))
+
+        def seal(position):
+            token = tokens[position * token_size:(position + 1) * token_size]
+            data_block = slot_data_blocks[position]
+            if data_block is None:
+                self.aes_crypto.encrypt_bucket_into(DUMMY_SLOT, token, cipher_suite)
+                return token
+            # The decryption of a data block may run past the end of its slot
+            slot = memoryview(bytearray(self.aes_crypto.max_block_token_size()))
+            self._open_slot(slot, *data_block)
+            self.aes_crypto.encrypt_bucket_into(slot[:SLOT_SIZE], token, cipher_suite)
+            return token
+
+        self.cloud.write_path_async(slot_ids, self._crypto_map(seal, range(len(slot_ids))))
+        self.metadata_cloud.write_path_async(nodes, metadata_tokens)
+        self._remove_evicted(node_data_ids)
+
+    def _early_reshuffle(self, nodes, metadata):
+        """
+        Reshuffles the buckets of an accessed path which were read config.RING_ORAM_DUMMY_SLOTS
+        times, as they may have no unread dummies left
+        :param nodes: the nodes of the path, from the leaf to the root
+        :param metadata: lists [read_count, slots] of the buckets of the path, in the same order
+        :return:
+        """
+        reshuffled = [(node, bucket_metadata) for node, bucket_metadata in zip(nodes, metadata)
+                      if bucket_metadata[0] >= config.RING_ORAM_DUMMY_SLOTS]
+        if not reshuffled:
+            return
+        reshuffled_nodes = [node for node, _ in reshuffled]
+        logger.info(f"EARLY RESHUFFLE OF NODES {reshuffled_nodes}")
+        self._read_buckets(reshuffled_nodes, [bucket_metadata for _, bucket_metadata in reshuffled])
+        self._write_buckets(reshuffled_nodes)
+
+    def _get_eviction_leaf(self):
+        """
+        Returns the leaf of the next eviction. The leaves are taken in reverse-lexicographic order,
+        that is, by the bits of the eviction count in reverse, so consecutive evictions share as
+        few buckets as possible
+        :return: the leaf
+        """
+        if self.height == 0:
+            return 0
+        leaf_index = self.eviction_count % (1 << self.height)
+        reversed_index = int(format(leaf_index, '0%db' % self.height)[::-1], 2)
+        return (1 << self.height) - 1 + reversed_index
+
+    def _evict_path(self):
+        """
+        Evicts the stash along the next path in reverse-lexicographic order - the unread data
+        blocks of the path are read into the stash, and the buckets of the path are written anew
+        :return:
+        """
+        nodes = self.path_to_root(self._get_eviction_leaf())
+        logger.info(f"EVICT PATH - NODES {nodes}")
+        self._read_buckets(nodes, self._open_metadata(self.metadata_cloud.read_path(nodes)))
+        self._write_buckets(nodes)
+        self.eviction_count += 1
@@ -1,26 +1,176 @@
+import atexit
+import os
+import struct
+
 import client.data as data
+import client.config as config
 import client.storage.utils as utils
 
-import re
+# A record of the snapshot and the journal - (data ID, leaf, token length), followed by the token
+RECORD_HEADER_FORMAT = '<QiI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+# The leaf of a record of the journal which deletes a data block
+DELETED_LEAF = -1
 
-FILE_NAME = 'data%d.oram'
+# The size of the journal in terms of bytes after which the snapshot is rewritten, unless the
+# stash itself is larger
+JOURNAL_COMPACTION_THRESHOLD = 64 * 1024 * 1024
 
 
 class Stash:
     """
-    The Stash of the client
+    The Stash of the client. The data blocks are kept in memory, and indexed by the nodes on the
+    path of the leaf they are mapped unto, such that the data blocks which may be written to a node
+    are found without scanning the stash. Once the data blocks in memory exceed
+    config.STASH_MEMORY_LIMIT, the oldest are spilled to a single append-only file. The plaintext
+    of a data block in memory is kept next to its token when it is known, so the data block is
+    written to a bucket without being decrypted again. Every data block added or deleted is
+    appended to a journal, which is replayed on top of the snapshot of the stash once it is loaded,
+    so the stash is current even if the client did not exit cleanly. The journal is folded into
+    the snapshot whenever the stash is saved. Every Stash of the same folder shares the same data
+    blocks
     """
-    def __init__(self):
-        if not data.is_folder(utils.STASH_FOLDER_NAME):
-            data.create_folder(utils.STASH_FOLDER_NAME)
+    _instances = dict()
+
+    def __new__(cls, folder_name=utils.STASH_FOLDER_NAME):
+        if folder_name not in cls._instances:
+            stash = super(Stash, cls).__new__(cls)
+            stash._load(folder_name)
+            cls._instances[folder_name] = stash
+            atexit.register(stash.save)
+        return cls._instances[folder_name]
+
+    def _load(self, folder_name):
+        """
+        Loads the stash from its snapshot and replays the journal on top of it
+        :param folder_name: the folder name of the stash
+        :return:
+        """
+        if not data.is_folder(folder_name):
+            data.create_folder(folder_name)
+        self.stash_dir = data.get_stash_dir(folder_name)
+        self.snapshot_path = os.path.join(self.stash_dir, utils.STASH_SNAPSHOT_FILE_NAME)
+        self.spill_path = os.path.join(self.stash_dir, utils.STASH_SPILL_FILE_NAME)
+        self.journal_path = os.path.join(self.stash_dir, utils.STASH_JOURNAL_FILE_NAME)
+        # data ID -> leaf
+        self.leaves = dict()
+        # data ID -> token, for the data blocks in memory
+        self.tokens = dict()
+        # data ID -> plaintext, for the data blocks in memory whose plaintext is known
+        self.plaintexts = dict()
+        # data ID -> (offset, length), for the data blocks in the spill file
+        self.spilled = dict()
+        # node -> data IDs which may be written to the node
+        self.node_index = dict()
+        self.memory_size = 0
+        self.spilled_size = 0
+        self.spill_file = None
+        self.journal_file = None
+        self.journal_size = 0
 
-    def get_data_file_name(self, data_id):
+        # The data blocks of the spill file are in the snapshot or in the journal as well
+        if os.path.isfile(self.spill_path):
+            os.remove(self.spill_path)
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, utils.READ_BINARY_MODE) as snapshot:
+                for data_id, leaf_id, token in self._read_records(snapshot):
+                    self._add(data_id, token, leaf_id)
+        if os.path.isfile(self.journal_path) and os.path.getsize(self.journal_path):
+            with open(self.journal_path, utils.READ_BINARY_MODE) as journal:
+                for data_id, leaf_id, token in self._read_records(journal):
+                    if leaf_id == DELETED_LEAF:
+                        self._remove(data_id)
+                    else:
+                        self._add(data_id, token, leaf_id)
+            self.save()
+
+    @classmethod
+    def _read_records(cls, file):
+        """
+        Reads the records of a snapshot or of a journal. A partially written record at the end is
+        ignored
+        :param file: an opened snapshot or journal
+        :return: tuples of (data_id, leaf_id, token)
+        """
+        while True:
+            header = file.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                return
+            data_id, leaf_id, length = struct.unpack(RECORD_HEADER_FORMAT, header)
+            token = file.read(length)
+            if len(token) < length:
+                return
+            yield data_id, leaf_id, token
+
+    def save(self):
+        """
+        Saves the whole stash as a compact snapshot and truncates the journal
+        :return:
         """
-        Returns data file name given an ID
-        :param data_id: an ID labeled to a data file
-        :return: data file name
+        tmp_path = self.snapshot_path + utils.TMP_SUFFIX
+        with open(tmp_path, utils.WRITE_BINARY_MODE) as snapshot:
+            for data_id, leaf_id in self.leaves.items():
+                token = self.open_file(data_id)
+                snapshot.write(struct.pack(RECORD_HEADER_FORMAT, data_id, leaf_id, len(token)))
+                snapshot.write(token)
+        os.replace(tmp_path, self.snapshot_path)
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        with open(self.journal_path, utils.WRITE_BINARY_MODE):
+            pass
+        self.journal_size = 0
+
+        # The spill file only grows while data blocks are spilled
+        if self.spill_file is not None and not self.spilled:
+            self.spill_file.close()
+            self.spill_file = None
+            os.remove(self.spill_path)
+
+    @classmethod
+    def save_all(cls):
+        """
+        Saves every stash
+        :return:
+        """
+        for stash in cls._instances.values():
+            stash.save()
+
+    def _spill(self):
+        """
+        Moves the oldest data blocks in memory to the spill file, until the data blocks in memory
+        fit the memory limit
+        :return:
+        """
+        while self.memory_size > config.STASH_MEMORY_LIMIT and self.tokens:
+            data_id = next(iter(self.tokens))
+            token = self.tokens.pop(data_id)
+            self.memory_size -= len(token) + len(self.plaintexts.pop(data_id, b''))
+            if self.spill_file is None:
+                self.spill_file = open(self.spill_path, utils.APPEND_READ_BINARY_MODE)
+            self.spill_file.seek(0, os.SEEK_END)
+            self.spilled[data_id] = self.spill_file.tell(), len(token)
+            self.spilled_size += len(token)
+            self.spill_file.write(token)
+        if self.spill_file is not None:
+            self.spill_file.flush()
+
+    def _append_journal(self, records):
+        """
+        Appends records to the journal in a single write, and folds the journal into the snapshot
+        once it outgrows both JOURNAL_COMPACTION_THRESHOLD and the stash
+        :param records: the records
+        :return:
         """
-        return FILE_NAME % data_id
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, utils.APPEND_BINARY_MODE)
+        self.journal_file.write(records)
+        self.journal_file.flush()
+        self.journal_size += len(records)
+        if self.journal_size > max(JOURNAL_COMPACTION_THRESHOLD,
+                                   self.memory_size + self.spilled_size):
+            self.save()
 
     def get_data_block(self, data_id):
         """
@@ -28,20 +178,40 @@ class Stash:
         :param data_id: an ID labeled to a data block
         :return: data block
         """
-        if data.is_data_file_in_stash(self.get_data_file_name(data_id)):
-            with data.open_data_file_in_stash(self.get_data_file_name(data_id), 'rb') as data_block:
-                return data_id, data_block.read()
+        if data_id in self.leaves:
+            return data_id, self.open_file(data_id)
+
+    def get_leaf_id(self, data_id):
+        """
+        Returns the leaf a data block in the stash is mapped unto
+        :param data_id: an ID labeled to a data block
+        :return: the leaf, or None if the data block is not in the stash
+        """
+        return self.leaves.get(data_id)
+
+    def get_plaintext(self, data_id):
+        """
+        Returns the plaintext of a data block in the stash, if it is kept in memory
+        :param data_id: an ID labeled to a data block
+        :return: the plaintext, or None if it is not kept
+        """
+        return self.plaintexts.get(data_id)
 
     def get_potential_data_ids(self):
         """
         Returns potential data IDs which mean all the ids of real data files (not dummies)
         :return: potential data IDs which mean all the ids of real data files (not dummies)
         """
-        data_ids = []
-        stash_file_names = data.get_stash_data_file_names()
-        for file_name in stash_file_names:
-            data_ids.append(int(re.findall(r'\d+', file_name)[0]))
-        return data_ids
+        return list(self.leaves)
+
+    def get_data_ids_of_node(self, node):
+        """
+        Returns the data IDs of the data blocks which may be written to a node, that is, the node
+        is on the path of the leaf they are mapped unto
+        :param node: a node in the PathORAM tree
+        :return: the data IDs of the data blocks which may be written to the node
+        """
+        return self.node_index.get(node, set())
 
     @property
     def size(self):
@@ -49,18 +219,53 @@ class Stash:
         Property of the Stash - its size
         :return:
         """
-        return data.get_stash_size()
+        return len(self.leaves)
 
-    def add_file(self, data_id, token):
+    def add_file(self, data_id, token, leaf_id, plaintext=None):
         """
         Adds file to the Stash
         :param data_id: data ID of a data file
         :param token: the data itself
+        :param leaf_id: the leaf the data block is mapped unto
+        :param plaintext: the plaintext of the token, if it is known
         :return:
         """
-        with data.open_data_file_in_stash(self.get_data_file_name(data_id), 'wb') as \
-                data_file:
-            data_file.write(token)
+        self.add_files([(data_id, token, leaf_id, plaintext)])
+
+    def add_files(self, data_blocks):
+        """
+        Adds files to the Stash, appending them to the journal in a single write
+        :param data_blocks: tuples (data_id, token, leaf_id, plaintext), where plaintext is the
+        plaintext of the token if it is known, otherwise None
+        :return:
+        """
+        records = bytearray()
+        for data_id, token, leaf_id, plaintext in data_blocks:
+            self._add(data_id, token, leaf_id, plaintext)
+            records += struct.pack(RECORD_HEADER_FORMAT, data_id, leaf_id, len(token))
+            records += token
+        if records:
+            self._append_journal(records)
+
+    def _add(self, data_id, token, leaf_id, plaintext=None):
+        """
+        Adds file to the Stash without appending it to the journal
+        :param data_id: data ID of a data file
+        :param token: the data itself
+        :param leaf_id: the leaf the data block is mapped unto
+        :param plaintext: the plaintext of the token, if it is known
+        :return:
+        """
+        self._remove(data_id)
+        self.leaves[data_id] = leaf_id
+        for node in utils.path_to_root(leaf_id):
+            self.node_index.setdefault(node, set()).add(data_id)
+        self.tokens[data_id] = token
+        self.memory_size += len(token)
+        if plaintext is not None:
+            self.plaintexts[data_id] = plaintext
+            self.memory_size += len(plaintext)
+        self._spill()
 
     def open_file(self, data_id):
         """
@@ -68,10 +273,11 @@ class Stash:
         :param data_id: data ID of a data file
         :return: the data file (called interchangeably a data block)
         """
-        with data.open_data_file_in_stash(self.get_data_file_name(data_id), 'rb') as \
-                data_file:
-            data_block = data_file.read()
-            return data_block
+        if data_id in self.tokens:
+            return self.tokens[data_id]
+        offset, length = self.spilled[data_id]
+        self.spill_file.seek(offset)
+        return self.spill_file.read(length)
 
     def delete_data_block(self, data_id):
         """
@@ -79,7 +285,28 @@ class Stash:
         :param data_id: data ID of a data block
         :return:
         """
-        data.delete_data_file_in_stash(self.get_data_file_name(data_id))
+        self.delete_data_blocks([data_id])
+
+    def _remove(self, data_id):
+        """
+        Deletes a data block without appending it to the journal
+        :param data_id: data ID of a data block
+        :return: True if the data block was in the stash, otherwise False
+        """
+        leaf_id = self.leaves.pop(data_id, None)
+        if leaf_id is None:
+            return False
+        for node in utils.path_to_root(leaf_id):
+            node_data_ids = self.node_index[node]
+            node_data_ids.discard(data_id)
+            if not node_data_ids:
+                del self.node_index[node]
+        if data_id in self.tokens:
+            self.memory_size -= (len(self.tokens.pop(data_id)) +
+                                 len(self.plaintexts.pop(data_id, b'')))
+        else:
+            self.spilled_size -= self.spilled.pop(data_id)[1]
+        return True
 
     def delete_data_blocks(self, data_ids):
         """
@@ -87,5 +314,9 @@ class Stash:
         :param data_ids: data IDs of data blocks
         :return:
         """
+        records = bytearray()
         for data_id in data_ids:
-            self.delete_data_block(data_id)
+            if self._remove(data_id):
+                records += struct.pack(RECORD_HEADER_FORMAT, data_id, DELETED_LEAF, 0)
+        if records:
+            self._append_journal(records)
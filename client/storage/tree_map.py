@@ -3,52 +3,227 @@ import client.data as data
 import client.config as config
 
 import json
+import struct
+import sys
+from array import array
 
 JSON_LEAF_ID = 'leaf_id'
 JSON_DATA_ID = 'data_id'
 
+# The snapshot file begins with this magic, followed by a fixed-width array of signed leaves
+# indexed by data ID
+MAGIC = b'TMAP'
+
+# Array type code of a signed leaf (4 bytes)
+LEAF_TYPE_CODE = 'i'
+
+# A record of the delta log - (data ID, signed leaf)
+LOG_RECORD_FORMAT = '<Qi'
+LOG_RECORD_SIZE = struct.calcsize(LOG_RECORD_FORMAT)
+
+# The leaf of data IDs which are not mapped at all
+EMPTY_LEAF = 0
+
+# The amount of delta log records after which the snapshot is rewritten
+LOG_COMPACTION_THRESHOLD = 65536
+
 
 class TreeMap:
     """
-    The map of the PathORAM Tree
+    The map of the PathORAM Tree. The map is held in memory as a compact array of signed leaves
+    indexed by data ID, and it is persisted as a binary snapshot and an append-only delta log.
+    Every TreeMap of the same file shares one in-memory map, hence creating TreeMap objects is
+    cheap
     """
-    def __init__(self):
-        if not data.data_file_exists(utils.TREE_MAP_FILE_NAME):
-            with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.WRITE_MODE) as loc_map:
-                json.dump((), loc_map, indent=utils.JSON_INDENT)
+    # The map tells a deleted data ID apart, so its data blocks are dropped once they are read
+    # from the tree
+    LAZY_DELETION = True
+
+    # Remapping a data ID costs nothing, so a data block mapped unto a leaf of the tree before it
+    # grew is remapped unto a leaf of the grown tree once it is read
+    REMAP_GROWN_LEAVES = True
+
+    _instances = dict()
+
+    def __new__(cls, file_name=utils.TREE_MAP_FILE_NAME, height=None):
+        if height is None:
+            height = config.ORAM_HEIGHT
+        if file_name not in cls._instances:
+            tree_map = super(TreeMap, cls).__new__(cls)
+            tree_map._load(file_name, height)
+            cls._instances[file_name] = tree_map
+        return cls._instances[file_name]
+
+    def _load(self, file_name, height):
+        """
+        Loads the map from its snapshot and replays the delta log on top of it
+        :param file_name: the file name of the snapshot
+        :param height: the height of the tree the map maps unto
+        :return:
+        """
+        self.file_name = file_name
+        self.height = height
+        self.log_file_name = file_name + utils.TREE_MAP_LOG_SUFFIX
+        self.leaves = array(LEAF_TYPE_CODE)
+        self.count = 0
+        self.log_records = 0
+        self.log_file = None
+        is_snapshot = False
+
+        if data.data_file_exists(file_name):
+            with data.open_data_file(file_name, utils.READ_BINARY_MODE) as loc_map:
+                content = loc_map.read()
+            if content.startswith(MAGIC):
+                self.leaves.frombytes(content[len(MAGIC):])
+                if sys.byteorder == 'big':
+                    self.leaves.byteswap()
+                is_snapshot = True
+            else:
+                self._load_json(content)
+        if data.data_file_exists(self.log_file_name):
+            self._replay_log()
+        self.count = sum(1 for leaf_id in self.leaves if leaf_id != EMPTY_LEAF)
+
+        if not is_snapshot or self.log_records > LOG_COMPACTION_THRESHOLD:
+            self.compact()
+
+    def _load_json(self, content):
+        """
+        Loads a map which was saved in the old JSON format
+        :param content: the content of the JSON map
+        :return:
+        """
+        for data_entry in json.loads(content.decode()):
+            self._set(data_entry[JSON_DATA_ID], data_entry[JSON_LEAF_ID])
+
+    def _replay_log(self):
+        """
+        Applies the records of the delta log unto the map
+        :return:
+        """
+        with data.open_data_file(self.log_file_name, utils.READ_BINARY_MODE) as log_file:
+            content = log_file.read()
+        # A partially written record at the end of the log is ignored
+        end = len(content) - len(content) % LOG_RECORD_SIZE
+        for data_id, leaf_id in struct.iter_unpack(LOG_RECORD_FORMAT, content[:end]):
+            self._set(data_id, leaf_id)
+        self.log_records = end // LOG_RECORD_SIZE
+
+    def compact(self):
+        """
+        Rewrites the snapshot of the map and truncates the delta log
+        :return:
+        """
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        leaves = array(LEAF_TYPE_CODE, self.leaves)
+        if sys.byteorder == 'big':
+            leaves.byteswap()
+        tmp_file_name = self.file_name + utils.TMP_SUFFIX
+        with data.open_data_file(tmp_file_name, utils.WRITE_BINARY_MODE) as loc_map:
+            loc_map.write(MAGIC)
+            loc_map.write(leaves.tobytes())
+        data.replace_data_file(tmp_file_name, self.file_name)
+        with data.open_data_file(self.log_file_name, utils.WRITE_BINARY_MODE):
+            pass
+        self.log_records = 0
+
+    def _set(self, data_id, leaf_id):
+        """
+        Sets the leaf of a data ID in memory only
+        :param data_id: a data ID
+        :param leaf_id: a signed leaf, or EMPTY_LEAF for removing the data ID
+        :return:
+        """
+        if data_id >= len(self.leaves):
+            if leaf_id == EMPTY_LEAF:
+                return
+            self.leaves.extend([EMPTY_LEAF] * (data_id + 1 - len(self.leaves)))
+        self.leaves[data_id] = leaf_id
+
+    def _write(self, data_id, leaf_id):
+        """
+        Sets the leaf of a data ID and appends the change to the delta log
+        :param data_id: a data ID
+        :param leaf_id: a signed leaf, or EMPTY_LEAF for removing the data ID
+        :return:
+        """
+        self._write_all([(data_id, leaf_id)])
+
+    def _write_all(self, entries):
+        """
+        Sets the leaves of many data IDs and appends the changes to the delta log in a single write
+        :param entries: tuples (data_id, leaf_id), where leaf_id is a signed leaf, or EMPTY_LEAF
+        for removing the data ID
+        :return:
+        """
+        records = bytearray()
+        for data_id, leaf_id in entries:
+            was_mapped = self._get(data_id) != EMPTY_LEAF
+            self._set(data_id, leaf_id)
+            self.count += (leaf_id != EMPTY_LEAF) - was_mapped
+            records += struct.pack(LOG_RECORD_FORMAT, data_id, leaf_id)
+        if not records:
+            return
+
+        if self.log_file is None:
+            self.log_file = data.open_data_file(self.log_file_name, utils.APPEND_BINARY_MODE)
+        self.log_file.write(records)
+        self.log_file.flush()
+        self.log_records += len(records) // LOG_RECORD_SIZE
+        if self.log_records > max(LOG_COMPACTION_THRESHOLD, len(self.leaves)):
+            self.compact()
+
+    def _get(self, data_id):
+        """
+        Returns the signed leaf of a data ID
+        :param data_id: a data ID
+        :return: the signed leaf, or EMPTY_LEAF if the data ID is not mapped
+        """
+        if 0 <= data_id < len(self.leaves):
+            return self.leaves[data_id]
+        return EMPTY_LEAF
 
     def add_data(self, data_id):
         """
         Adds a new mapping of a data block to a leaf
         :param data_id: a data ID of a data file
+        :return: the signed leaf of the data block
+        """
+        # minus config means not in server, without a minus - is in server
+        leaf_id = -config.get_random_leaf_id(self.height)
+        self._write(data_id, leaf_id)
+        return leaf_id
+
+    def add_data_ids(self, data_ids):
+        """
+        Adds new mappings of many data blocks to leaves, committed together
+        :param data_ids: data IDs of data files
+        :return: the signed leaves of the data blocks, in the same order
+        """
+        leaf_ids = [-config.get_random_leaf_id(self.height) for _ in data_ids]
+        self._write_all(zip(data_ids, leaf_ids))
+        return leaf_ids
+
+    def set_leaf_id(self, data_id, leaf_id):
+        """
+        Sets the mapping of a data ID to a given signed leaf
+        :param data_id: a data ID
+        :param leaf_id: a signed leaf
         :return:
         """
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_WRITE_MODE) as loc_map:
-            loc_data = json.load(loc_map)
-            # minus config means not in server, without a minus - is in server
-            loc_data.append({JSON_LEAF_ID: -config.get_random_leaf_id(), JSON_DATA_ID: data_id})
-            loc_map.seek(0)
-            json.dump(loc_data, loc_map, indent=utils.JSON_INDENT, sort_keys=True)
-            loc_map.truncate()
+        if self._get(data_id) != leaf_id:
+            self._write(data_id, leaf_id)
 
     def delete_data_ids(self, data_ids):
         """
-        Deletes the data IDs from the map
+        Deletes the data IDs from the map, committed together
         :param data_ids: data IDs
         :return:
         """
-        data_ids_copy = list(data_ids)
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_WRITE_MODE) as loc_map:
-            loc_data = json.load(loc_map)
-            for data_entry in list(loc_data):
-                if data_entry[JSON_DATA_ID] in data_ids:
-                    loc_data.remove(data_entry)
-                    data_ids_copy.remove(data_entry[JSON_DATA_ID])
-                if not data_ids_copy:
-                    break
-            loc_map.seek(0)
-            json.dump(loc_data, loc_map, indent=utils.JSON_INDENT, sort_keys=True)
-            loc_map.truncate()
+        self._write_all([(data_id, EMPTY_LEAF) for data_id in data_ids
+                         if self._get(data_id) != EMPTY_LEAF])
 
     def get_data_entries(self, data_ids):
         """
@@ -56,18 +231,26 @@ class TreeMap:
         :param data_ids: data IDs
         :return: tuples of (data_ID, leaf_ID)
         """
-        data_ids_copy = list(data_ids)
-        data_entries = list()
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_MODE) as loc_map:
-            loc_data = json.load(loc_map)
-            for data_entry in list(loc_data):
-                if data_entry[JSON_DATA_ID] in data_ids:
-                    data_entries.append((data_entry[JSON_DATA_ID], data_entry[JSON_LEAF_ID]))
-                    data_ids_copy.remove(data_entry[JSON_DATA_ID])
-                if not data_ids_copy:
-                    break
         # Note that we return list of tuples!
-        return data_entries
+        return [(data_id, self._get(data_id)) for data_id in data_ids
+                if self._get(data_id) != EMPTY_LEAF]
+
+    def set_height(self, height):
+        """
+        Sets the height of the tree the map maps unto, once the tree grew
+        :param height: the height of the tree
+        :return:
+        """
+        self.height = height
+
+    def grow_address_space(self, address_space):
+        """
+        Grows the amount of data IDs the map addresses. The map grows as data IDs are added to it,
+        so nothing is left to do
+        :param address_space: the amount of data IDs
+        :return:
+        """
+        pass
 
     def get_leaf_id(self, data_id):
         """
@@ -75,44 +258,50 @@ class TreeMap:
         :param data_id: data ID
         :return: the mapping of a given data ID
         """
-        return self.get_data_entries([data_id])[0][1]
+        return self._get(data_id)
 
-    def update_leaf_id(self, data_id, is_uploaded):
+    def access_leaf_id(self, data_id):
+        """
+        Gets the mapping of a data ID whose data block is accessed. The data ID is remapped by
+        choose_fresh_leaf_id once its data block is read into the stash
+        :param data_id: data ID
+        :return: the mapping of a given data ID
+        """
+        return self._get(data_id)
+
+    def access_dummy_entry(self):
+        """
+        Costs the same as the access of the mapping of a data ID. The map is kept on the client, so
+        nothing is left to do
+        :return:
+        """
+        pass
+
+    def update_leaf_id(self, data_id, is_uploaded, leaf_id=None):
         """
         Updates the mapping of data ID
         :param data_id: a data ID
         :param is_uploaded: a boolean value describing if the data block labeled by the given
         data ID is uploaded to the server's cloud
+        :param leaf_id: the leaf the data block was read from, if known, otherwise the leaf it is
+        mapped unto
         :return:
         """
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_WRITE_MODE) as loc_map:
-            loc_data = json.load(loc_map)
-            for data_entry in loc_data:
-                if data_entry[JSON_DATA_ID] == data_id:
-                    if is_uploaded:
-                        data_entry[JSON_LEAF_ID] = abs(data_entry[JSON_LEAF_ID])
-                    else:
-                        data_entry[JSON_LEAF_ID] = -data_entry[JSON_LEAF_ID]
-                    break
-            loc_map.seek(0)
-            json.dump(loc_data, loc_map, indent=utils.JSON_INDENT, sort_keys=True)
-            loc_map.truncate()
+        if self._get(data_id) == EMPTY_LEAF:
+            return
+        if leaf_id is None:
+            leaf_id = self._get(data_id)
+        self.set_leaf_id(data_id, abs(leaf_id) if is_uploaded else -abs(leaf_id))
 
     def choose_fresh_leaf_id(self, data_id):
         """
         Chooses randomly new mapping for a given data block labeled by the given data ID
         :param data_id: a data ID
-        :return:
+        :return: the new signed leaf
         """
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_WRITE_MODE) as loc_map:
-            loc_data = json.load(loc_map)
-            for data_entry in loc_data:
-                if data_entry[JSON_DATA_ID] == data_id:
-                    data_entry[JSON_LEAF_ID] = -config.get_random_leaf_id()
-                    break
-            loc_map.seek(0)
-            json.dump(loc_data, loc_map, indent=utils.JSON_INDENT, sort_keys=True)
-            loc_map.truncate()
+        if self._get(data_id) != EMPTY_LEAF:
+            self._write(data_id, -config.get_random_leaf_id(self.height))
+        return self._get(data_id)
 
     def data_id_exist(self, data_id):
         """
@@ -121,17 +310,11 @@ class TreeMap:
         :param data_id: a data ID
         :return:
         """
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_MODE) as loc_map:
-            loc_data = json.load(loc_map)
-            for data_entry in loc_data:
-                if data_entry[JSON_DATA_ID] == data_id:
-                    return True
-            return False
+        return self._get(data_id) != EMPTY_LEAF
 
     def count_data_ids(self):
         """
         Counts the amount of data blocks uploaded to the PathORAM Tree
         :return:
         """
-        with data.open_data_file(utils.TREE_MAP_FILE_NAME, utils.READ_MODE) as loc_map:
-            return len(json.load(loc_map))
+        return self.count
@@ -1,12 +1,77 @@
+import numpy as np
+
 WRITE_MODE = 'w'
 READ_MODE = 'r'
 READ_WRITE_MODE = 'r+'
+READ_BINARY_MODE = 'rb'
+WRITE_BINARY_MODE = 'wb'
+APPEND_BINARY_MODE = 'ab'
+APPEND_READ_BINARY_MODE = 'a+b'
 
 FILE_BEGIN = 0
 
 TREE_MAP_FILE_NAME = 'tree.map'
+TREE_MAP_LOG_SUFFIX = '.log'
+TMP_SUFFIX = '.tmp'
 FILE_MAP_FILE_NAME = 'file.map'
 STASH_FOLDER_NAME = 'stash'
+STASH_SNAPSHOT_FILE_NAME = 'stash.snapshot'
+STASH_SPILL_FILE_NAME = 'stash.spill'
+STASH_JOURNAL_FILE_NAME = 'stash.journal'
 LOG_FILE_NAME = 'oram.log'
 
+POSITION_MAP_PREFIX = 'posmap'
+POSITION_MAP_TREE_NAME = POSITION_MAP_PREFIX + '%d'
+POSITION_MAP_FILE_NAME = POSITION_MAP_PREFIX + '%d.map'
+POSITION_MAP_STASH_FOLDER_NAME = POSITION_MAP_PREFIX + '%d_stash'
+
 JSON_INDENT = 4
+
+PATH_ORAM_ENGINE = 'path'
+RING_ORAM_ENGINE = 'ring'
+# The slots of the buckets of a Ring ORAM Tree, and the metadata of the buckets, are kept by the
+# server as trees of their own
+RING_ORAM_TREE_NAME = 'ring'
+RING_ORAM_SUBTREE_NAME = '%s_ring'
+RING_ORAM_METADATA_TREE_NAME = '%s_metadata'
+
+NO_COMPRESSION = 'none'
+ZLIB_COMPRESSION = 'zlib'
+LZMA_COMPRESSION = 'lzma'
+BZ2_COMPRESSION = 'bz2'
+
+
+def path_to_leaf(leaf_id, height):
+    """
+    Computes the path from the root to a leaf. The tree is numbered like a binary heap, so the
+    node of depth d on the path is the leaf (plus one) without its last (height - d) bits, minus one
+    :param leaf_id: a leaf in the PathORAM tree
+    :param height: the height of the tree
+    :return: the nodes from the root to the leaf
+    """
+    return [((leaf_id + 1) >> (height - depth)) - 1 for depth in range(height + 1)]
+
+
+def path_to_root(leaf_id):
+    """
+    Computes the path from a leaf up to the root
+    :param leaf_id: a leaf in the PathORAM tree
+    :return: the nodes from the leaf up to the root
+    """
+    path = [leaf_id]
+    while leaf_id > 0:
+        leaf_id = (leaf_id - 1) >> 1
+        path.append(leaf_id)
+    return path
+
+
+def paths_to_leaves(leaf_ids, height):
+    """
+    Computes the paths from the root to many leaves at once
+    :param leaf_ids: leaves in the PathORAM tree
+    :param height: the height of the tree
+    :return: a matrix whose rows are the nodes from the root to each leaf
+    """
+    shifts = height - np.arange(height + 1, dtype=np.int64)
+    return ((np.asarray(leaf_ids, dtype=np.int64)[:, np.newaxis] + 1) >> shifts) - 1
+
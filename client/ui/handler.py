@@ -1,10 +1,12 @@
 import os
 
 import client.data as data
+import client.config as config
 import client.storage.controller as controller
 
 from client.crypto import utils
 from client.crypto.key_map import KeyMap
+from client.storage.compression import get_codec
 
 from client.crypto.exceptions import WrongPassword
 from client.storage.exceptions import FullStorage
@@ -52,25 +54,36 @@ def setup():
     controller.setup_cloud(AES_CRYPTO)
 
 
-def upload_file(path, filename):
+def upload_file(path, filename, compression=None):
     """
     Giuen a file path, uploads a file to the server's cloud
     :param path: a path to file name, a string
     :param filename: a file name, a string
+    :param compression: the codec to compress the file with - 'zlib', 'lzma', 'bz2' or 'none',
+    config.COMPRESSION by default
     :return:
     """
+    compression = get_codec(compression if compression is not None else config.COMPRESSION)
     # file name should be only filename! no path
+    # The file is split straight from the disk, so large files are not read into memory at once
+    file_path = os.path.join(path, filename)
     try:
-        with open(os.path.join(path, filename), 'rb') as file:
-            file_input = file.read()
+        file_size = os.path.getsize(file_path)
     except (FileExistsError, FileNotFoundError) as err:
         raise err
 
-    free_storage_size = controller.get_max_storage_size() - controller.get_used_storage_size()
-    if not controller.is_storage_available(len(file_input), free_storage_size):
+    used_storage_size = controller.get_used_storage_size(AES_CRYPTO)
+    while config.AUTO_GROW and not controller.is_storage_available(
+            file_size, controller.get_max_storage_size() * config.LOAD_FACTOR - used_storage_size):
+        controller.grow_tree(AES_CRYPTO)
+    free_storage_size = controller.get_max_storage_size() - used_storage_size
+    if not controller.is_storage_available(file_size, free_storage_size):
         raise FullStorage("Storage is full")
-    controller.save_file_input(filename, file_input, AES_CRYPTO)
-    controller.upload_data(filename, AES_CRYPTO)
+    if config.STREAMING_UPLOAD:
+        controller.upload_file_stream(filename, file_path, AES_CRYPTO, compression)
+    else:
+        controller.save_file_path(filename, file_path, AES_CRYPTO, compression)
+        controller.upload_data(filename, AES_CRYPTO)
 
 
 def download_file(path, filename):
@@ -80,7 +93,18 @@ def download_file(path, filename):
     :param filename: a file name
     :return:
     """
-    controller.download_file(filename, path, filename, AES_CRYPTO)
+    if config.STREAMING_DOWNLOAD:
+        controller.download_file_stream(filename, path, filename, AES_CRYPTO)
+    else:
+        controller.download_file(filename, path, filename, AES_CRYPTO)
+
+
+def grow():
+    """
+    Grows the server's storage, doubling its capacity while it is in use
+    :return:
+    """
+    controller.grow_tree(AES_CRYPTO)
 
 
 def delete_file(filename):
@@ -89,4 +113,4 @@ def delete_file(filename):
     :param filename: a file name
     :return:
     """
-    controller.delete_file(filename)
+    controller.delete_file(filename, AES_CRYPTO)
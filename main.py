@@ -18,8 +18,10 @@ MANUAL_MSG = "You should upload files, one-by-one, which located in this folder,
              "located in this folder. You can't upload files from anywhere else and you can't " \
              "download file to anywhere else. You can also delete files. \n" \
              "Commands:\nUpload: upload <filename>\n" \
+             "Upload compressed: upload <filename> <zlib|lzma|bz2|none>\n" \
              "Download: download <filename>\n" \
              "Delete: delete <filename>\n" \
+             "Grow the storage: grow\n" \
              "Quit: quit"
 INVALID_LENGTH_MSG = "Invalid command line length. Please re-enter your command."
 
@@ -27,6 +29,9 @@ COMMANDS = {"upload", "download", "delete"}
 
 COMMAND_LINE_LENGTH = 2
 
+# An upload may name the codec to compress the file with
+COMPRESSED_UPLOAD_LINE_LENGTH = 3
+
 
 def run():
     if not handler.has_signed_up():
@@ -59,17 +64,23 @@ def run():
     while True:
         line = input("COMMAND: ").split()
         command = line[0]
-        if command in COMMANDS and len(line) != COMMAND_LINE_LENGTH:
+        if command in COMMANDS and len(line) != COMMAND_LINE_LENGTH and not (
+                command == "upload" and len(line) == COMPRESSED_UPLOAD_LINE_LENGTH):
             logger.warning(INVALID_LENGTH_MSG)
         elif command == "quit":
             break
+        elif command == "grow":
+            try:
+                handler.grow()
+            except Exception as e:
+                logger.warning(e)
         elif command not in COMMANDS:
             logger.warning("Unrecognized command. Try again.")
         else:
             filename = line[1]
             try:
                 if command == "upload":
-                    handler.upload_file(WORK_DIR, filename)
+                    handler.upload_file(WORK_DIR, filename, *line[2:])
                 elif command == "download":
                     handler.download_file(WORK_DIR, filename)
                 elif command == "delete":
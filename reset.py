@@ -1,3 +1,4 @@
+import glob
 import os
 import shutil
 
@@ -5,6 +6,7 @@ from client.storage import utils as storage_utils
 from client.cloud import utils as cloud_utils
 from client.crypto import utils as crypto_utils
 from client.data import BASE_DIR, STASH_DIR
+from client.deployment import DEPLOYMENT_FILE_PATH
 
 from server.utils import DATA_DIR
 
@@ -14,7 +16,9 @@ KEY_MAP_PATH = os.path.join(BASE_DIR, crypto_utils.KEY_MAP_FILE_NAME)
 LOG_FILE_PATH = os.path.join(BASE_DIR, storage_utils.LOG_FILE_NAME)
 TMP_FILE_PATH = os.path.join(BASE_DIR, 'tmp')
 TREE_MAP_PATH = os.path.join(BASE_DIR, storage_utils.TREE_MAP_FILE_NAME)
-FILES = [CLOUD_MAP_PATH, FILE_MAP_PATH, KEY_MAP_PATH, LOG_FILE_PATH, TMP_FILE_PATH, TREE_MAP_PATH]
+TREE_MAP_LOG_PATH = TREE_MAP_PATH + storage_utils.TREE_MAP_LOG_SUFFIX
+FILES = [CLOUD_MAP_PATH, FILE_MAP_PATH, KEY_MAP_PATH, LOG_FILE_PATH, TMP_FILE_PATH, TREE_MAP_PATH,
+         TREE_MAP_LOG_PATH, DEPLOYMENT_FILE_PATH]
 
 if __name__ == '__main__':
     # --------------- server ---------------------
@@ -23,6 +27,11 @@ if __name__ == '__main__':
 
     # --------------- client ---------------------
     shutil.rmtree(STASH_DIR, ignore_errors=True)
+    # The position map trees of the recursive mode
+    for path in glob.glob(os.path.join(BASE_DIR, storage_utils.POSITION_MAP_PREFIX + '*')):
+        shutil.rmtree(path, ignore_errors=True)
+        if os.path.isfile(path):
+            os.remove(path)
     for filename in FILES:
         try:
             os.remove(filename)
@@ -1,59 +1,334 @@
-import socket
+import asyncio
+import logging
 import os
-import tqdm
+import signal
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
 import utils
+from store import BucketStore, get_store_filename
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER_SIZE = struct.calcsize(utils.FRAME_HEADER_FORMAT)
+NODE_ID_SIZE = struct.calcsize(utils.NODE_ID_FORMAT)
+BUCKET_LENGTH_SIZE = struct.calcsize(utils.BUCKET_LENGTH_FORMAT)
+
+
+class ProtocolError(Exception):
+    pass
+
 
+class ORAMServer:
+    """
+    The server of the PathORAM Trees, serving many clients at once. Every client holds a persistent
+    connection over which many requests may be in flight, and they are answered out of order. The
+    requests on the same node are handled in the order they were received, across all connections,
+    and so are the requests creating or growing a tree and every request on that tree. The disk is
+    accessed by a pool of worker threads
+    """
+    def __init__(self, address=(utils.SERVER_IP, utils.SERVER_PORT), workers=utils.WORKERS,
+                 window=utils.WINDOW):
+        self.address = address
+        self.window = window
+        self.executor = ThreadPoolExecutor(workers)
+        # (tree name, node ID) -> the task of the last request on the node, where the node ID of
+        # the requests creating or growing the tree is None
+        self.node_tasks = dict()
+        self.connections = set()
+        # tree name -> the store of the buckets of the tree
+        self.stores = dict()
+
+    async def run(self):
+        """
+        Serves the clients until the server is interrupted, then finishes the requests in flight
+        and closes every connection
+        :return:
+        """
+        os.makedirs(utils.DATA_DIR, exist_ok=True)
+        loop = asyncio.get_event_loop()
+        stopped = asyncio.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, stopped.set)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers are not supported on this platform
+                pass
+
+        server = await asyncio.start_server(self.handle_connection, *self.address)
+        print("Server waiting...")
+        try:
+            await stopped.wait()
+        finally:
+            logger.info("Shutting down")
+            server.close()
+            for connection in list(self.connections):
+                connection.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await server.wait_closed()
+            self.executor.shutdown(wait=True)
+            for bucket_store in self.stores.values():
+                bucket_store.close()
+
+    async def read_frame(self, reader):
+        """
+        Reads a request from a client. The buckets of the payload are read one by one
+        :param reader: the stream of the client
+        :return: tuple (opcode, request_id, tree_name, nodes, buckets), or None once the client
+        closed the connection
+        """
+        try:
+            header = await reader.readexactly(FRAME_HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        version, opcode, request_id, tree_name_length, node_count, payload_length = \
+            struct.unpack(utils.FRAME_HEADER_FORMAT, header)
+        if version != utils.PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}.")
+        tree_name = (await reader.readexactly(tree_name_length)).decode("utf-8")
+        node_ids = await reader.readexactly(node_count * NODE_ID_SIZE)
+        nodes = [node for node, in struct.iter_unpack(utils.NODE_ID_FORMAT, node_ids)]
 
-SEPARATOR = "<THIS_TEXT_JUST_DISTINGUISH_TEXTS>"
-s = socket.socket()
-s.bind(("127.0.0.1", 1234))
-s.listen(1)
+        buckets = list()
+        while payload_length > 0:
+            length, = struct.unpack(utils.BUCKET_LENGTH_FORMAT,
+                                    await reader.readexactly(BUCKET_LENGTH_SIZE))
+            if BUCKET_LENGTH_SIZE + length > payload_length:
+                raise ProtocolError("Bucket exceeds the payload.")
+            buckets.append(await reader.readexactly(length))
+            payload_length -= BUCKET_LENGTH_SIZE + length
+        return opcode, request_id, tree_name, nodes, buckets
 
-while True:
-    print("Server waiting...")
-    if not os.path.exists(utils.DATA_DIR):
-        os.makedirs(utils.DATA_DIR)
-    c, _ = s.accept()
-    msg = c.recv(utils.HEADER_SIZE)
-    if str(msg.decode("utf-8")) == "upload":
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the requests of a client over a persistent connection, until the client closes it.
+        Once the window of requests in flight is full, no more requests are read from the client
+        :param reader: the stream of the client
+        :param writer: the stream to the client
+        :return:
+        """
+        self.connections.add(asyncio.current_task())
+        window = asyncio.Semaphore(self.window)
+        send_lock = asyncio.Lock()
+        tasks = set()
         try:
-            data = c.recv(utils.CHUNK_SIZE).decode()
-            filename, size = data.split(SEPARATOR)
-            filename = os.path.basename(filename)
-            filename = os.path.join(utils.DATA_DIR, filename)
-            file = open(filename, 'wb')
-            terminated = False
-            upload_bar = tqdm.tqdm(range(int(size)), f"Receiving {filename}", unit="B",
-                                   unit_scale=True, unit_divisor=1024)
-            while not terminated:
-                data = c.recv(utils.CHUNK_SIZE)
-                if not data:
-                    terminated = True
+            while True:
+                await window.acquire()
+                frame = await self.read_frame(reader)
+                if frame is None:
                     break
-                file.write(data)
-                upload_bar.update(len(data))
-            file.close()
-        except:
+                task = self.schedule(frame, writer, send_lock)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: window.release())
+        except asyncio.CancelledError:
             pass
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError, struct.error,
+                UnicodeDecodeError) as e:
+            logger.warning(f"Connection failed: {e}")
+        finally:
+            # The requests in flight are answered before the connection is closed
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.connections.discard(asyncio.current_task())
 
-    if str(msg.decode("utf-8")) == "download":
+    def schedule(self, frame, writer, send_lock):
+        """
+        Schedules the handling of a request after the previous requests on its nodes. A request
+        without nodes creates or grows its tree, hence it is scheduled after every previous request
+        on the tree, and the following requests on the tree are scheduled after it
+        :param frame: the request
+        :param writer: the stream to the client
+        :param send_lock: a lock guarding the sending of whole frames to the client
+        :return: the task handling the request
+        """
+        _, _, tree_name, nodes, _ = frame
+        tree_key = (tree_name, None)
+        if nodes:
+            keys = [(tree_name, node) for node in nodes]
+            previous_tasks = {self.node_tasks[key] for key in keys + [tree_key]
+                              if key in self.node_tasks}
+        else:
+            keys = [tree_key]
+            previous_tasks = {task for (name, _), task in self.node_tasks.items()
+                              if name == tree_name}
+        task = asyncio.ensure_future(self.handle(frame, writer, send_lock, previous_tasks))
+        for key in keys:
+            self.node_tasks[key] = task
+
+        def forget(_):
+            for key in keys:
+                if self.node_tasks.get(key) is task:
+                    del self.node_tasks[key]
+        task.add_done_callback(forget)
+        return task
+
+    async def handle(self, frame, writer, send_lock, previous_tasks):
+        """
+        Handles a single request once the previous requests on its nodes were handled, and sends
+        its response
+        :param frame: the request
+        :param writer: the stream to the client
+        :param send_lock: a lock guarding the sending of whole frames to the client
+        :param previous_tasks: the tasks of the previous requests on the nodes of the request
+        :return:
+        """
+        if previous_tasks:
+            await asyncio.wait(previous_tasks)
+        opcode, request_id, tree_name, nodes, buckets = frame
+        try:
+            if opcode == utils.READ_PATH_OPCODE:
+                await self.read_path(writer, send_lock, request_id, tree_name, nodes)
+            elif opcode == utils.WRITE_PATH_OPCODE:
+                await self.write_path(tree_name, nodes, buckets)
+                async with send_lock:
+                    await self.send_frame(writer, utils.OK_OPCODE, request_id)
+            elif opcode == utils.CREATE_TREE_OPCODE:
+                await self.create_tree(tree_name, buckets)
+                async with send_lock:
+                    await self.send_frame(writer, utils.OK_OPCODE, request_id)
+            elif opcode == utils.GROW_TREE_OPCODE:
+                await self.grow_tree(tree_name, buckets)
+                async with send_lock:
+                    await self.send_frame(writer, utils.OK_OPCODE, request_id)
+            else:
+                raise ValueError(f"Unknown opcode {opcode}.")
+        except (FileNotFoundError, ValueError) as e:
+            async with send_lock:
+                await self.send_frame(writer, utils.ERROR_OPCODE, request_id,
+                                      str(e).encode("utf-8"))
+        except ConnectionError:
+            # The frame may be partially sent, so the connection is dropped, and the client
+            # reconnects and sends the request again
+            writer.close()
+        except Exception:
+            logger.exception(f"Request {request_id} failed")
+            async with send_lock:
+                await self.send_frame(writer, utils.ERROR_OPCODE, request_id,
+                                      b"Internal server error.")
+
+    @classmethod
+    async def send_frame(cls, writer, opcode, request_id, payload=b''):
+        """
+        Sends a frame to a client
+        :param writer: the stream to the client
+        :param opcode: the opcode of the response
+        :param request_id: the ID of the request answered
+        :param payload: the payload
+        :return:
+        """
+        writer.write(struct.pack(utils.FRAME_HEADER_FORMAT, utils.PROTOCOL_VERSION, opcode,
+                                 request_id, 0, 0, len(payload)) + payload)
+        await writer.drain()
+
+    def get_store(self, tree_name):
+        """
+        Returns the store of the buckets of a tree
+        :param tree_name: the name of the tree
+        :return: the store
+        """
+        if tree_name not in self.stores:
+            filename = get_store_filename(tree_name)
+            if not os.path.isfile(filename):
+                raise FileNotFoundError(f"Tree {tree_name} does not exist.")
+            self.stores[tree_name] = BucketStore(filename)
+        return self.stores[tree_name]
+
+    async def create_tree(self, tree_name, payload):
+        """
+        Creates the store of a tree, unless a store of the same geometry already exists
+        :param tree_name: the name of the tree
+        :param payload: a single item of (node count, bucket size)
+        :return:
+        """
+        if len(payload) != 1:
+            raise ValueError("Creating a tree expects a single item.")
+        node_count, slot_size = struct.unpack(utils.CREATE_TREE_FORMAT, payload[0])
         try:
-            data = str(c.recv(utils.CHUNK_SIZE).decode("utf-8"))
-            filename = str(data)
-            filename = os.path.join(utils.DATA_DIR, filename)
-            size = os.path.getsize(filename)
-            c.send(f"{filename}{SEPARATOR}{size}".encode())
-            upload_bar = tqdm.tqdm(range(int(size)), f"Sending {filename}", unit="B",
-                                   unit_scale=True, unit_divisor=1024)
-            file = open(filename, 'rb')
-            terminated = False
-            while not terminated:
-                data = file.read(utils.CHUNK_SIZE)
-                if not data:
-                    c.close()
-                    terminated = False
-                c.sendall(data)
-                upload_bar.update(len(data))
-            file.close()
-        except:
+            bucket_store = self.get_store(tree_name)
+            if bucket_store.node_count == node_count and bucket_store.slot_size == slot_size:
+                return
+            bucket_store.close()
+            del self.stores[tree_name]
+        except FileNotFoundError:
             pass
+        loop = asyncio.get_event_loop()
+        self.stores[tree_name] = await loop.run_in_executor(
+            self.executor, BucketStore.create, get_store_filename(tree_name), node_count,
+            slot_size)
+
+    async def grow_tree(self, tree_name, payload):
+        """
+        Grows the store of a tree to more nodes, keeping the buckets of its nodes
+        :param tree_name: the name of the tree
+        :param payload: a single item of (node count, bucket size)
+        :return:
+        """
+        if len(payload) != 1:
+            raise ValueError("Growing a tree expects a single item.")
+        node_count, slot_size = struct.unpack(utils.CREATE_TREE_FORMAT, payload[0])
+        bucket_store = self.get_store(tree_name)
+        if bucket_store.slot_size != slot_size:
+            raise ValueError("Bucket size does not match the tree.")
+        if bucket_store.node_count == node_count:
+            return
+        bucket_store.close()
+        del self.stores[tree_name]
+        loop = asyncio.get_event_loop()
+        self.stores[tree_name] = await loop.run_in_executor(
+            self.executor, BucketStore.grow, get_store_filename(tree_name), node_count)
+
+    async def read_path(self, writer, send_lock, request_id, tree_name, nodes):
+        """
+        Sends the buckets of nodes, read straight from the store into a preallocated frame which is
+        sent as a whole
+        :param writer: the stream to the client
+        :param send_lock: a lock guarding the sending of whole frames to the client
+        :param request_id: the ID of the request answered
+        :param tree_name: the name of the tree of the nodes
+        :param nodes: node IDs
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        bucket_store = self.get_store(tree_name)
+        size = bucket_store.slot_size
+        payload_length = len(nodes) * (BUCKET_LENGTH_SIZE + size)
+        frame = bytearray(FRAME_HEADER_SIZE + payload_length)
+        struct.pack_into(utils.FRAME_HEADER_FORMAT, frame, 0, utils.PROTOCOL_VERSION,
+                         utils.OK_OPCODE, request_id, 0, 0, payload_length)
+        views = list()
+        offset = FRAME_HEADER_SIZE
+        for _ in nodes:
+            struct.pack_into(utils.BUCKET_LENGTH_FORMAT, frame, offset, size)
+            offset += BUCKET_LENGTH_SIZE
+            views.append(memoryview(frame)[offset:offset + size])
+            offset += size
+        await loop.run_in_executor(self.executor, bucket_store.read_path_into, nodes, views)
+        async with send_lock:
+            writer.write(frame)
+            await writer.drain()
+
+    async def write_path(self, tree_name, nodes, buckets):
+        """
+        Writes the buckets of nodes, committed together with a single fsync
+        :param tree_name: the name of the tree of the nodes
+        :param nodes: node IDs
+        :param buckets: the buckets of the nodes, in the same order
+        :return:
+        """
+        if len(buckets) != len(nodes):
+            raise ValueError("Amount of buckets does not match the amount of nodes.")
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.get_store(tree_name).write_path, nodes,
+                                   buckets)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    asyncio.run(ORAMServer().run())
@@ -0,0 +1,185 @@
+import os
+import struct
+
+import utils
+
+# The header of a store - (magic, node count, slot size, levels of a subtree), padded to a page
+STORE_HEADER_FORMAT = '>4sQIB'
+STORE_MAGIC = b'OSTR'
+STORE_HEADER_SIZE = 4096
+
+
+def get_store_filename(tree_name):
+    """
+    Returns the path of the store of a tree
+    :param tree_name: the name of the tree, empty for the main PathORAM Tree
+    :return: the path of the store in the data directory
+    """
+    if not tree_name:
+        return os.path.join(utils.DATA_DIR, utils.STORE_FILE_NAME)
+    if os.path.basename(tree_name) != tree_name:
+        raise ValueError(f"Invalid tree name {tree_name}.")
+    return os.path.join(utils.DATA_DIR, utils.TREE_STORE_FILE_NAME % tree_name)
+
+
+def get_slot(node, levels, subtree_levels):
+    """
+    Returns the slot of a node in the subtree-packed layout, in which the tree is cut into
+    subtrees of subtree_levels levels, and every subtree is stored contiguously. Hence, the nodes
+    of a path are packed into a few subtrees. For subtree_levels = 1 the slot is the node itself
+    :param node: the node ID, where the root is 0 and the children of n are 2n + 1 and 2n + 2
+    :param levels: the amount of levels of the tree
+    :param subtree_levels: the amount of levels of a subtree
+    :return: the slot of the node
+    """
+    level = (node + 1).bit_length() - 1
+    first_level = level - level % subtree_levels
+    depth = level - first_level
+    position = node + 1 - (1 << level)
+    subtree_size = (1 << min(subtree_levels, levels - first_level)) - 1
+    subtree = position >> depth
+    local_node = (1 << depth) - 1 + (position & ((1 << depth) - 1))
+    return (1 << first_level) - 1 + subtree * subtree_size + local_node
+
+
+class BucketStore:
+    """
+    The buckets of a PathORAM Tree, kept in a single preallocated file of fixed-size slots which
+    are accessed with preadv and pwrite. The layout of the slots is recorded in the header of the
+    file, so changing utils.SUBTREE_LEVELS applies to new stores only
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR)
+        header = os.pread(self.fd, struct.calcsize(STORE_HEADER_FORMAT), 0)
+        try:
+            magic, self.node_count, self.slot_size, self.subtree_levels = \
+                struct.unpack(STORE_HEADER_FORMAT, header)
+        except struct.error:
+            magic = None
+        if magic != STORE_MAGIC:
+            os.close(self.fd)
+            raise ValueError(f"{filename} is not a bucket store.")
+        self.levels = self.node_count.bit_length()
+
+    @classmethod
+    def create(cls, filename, node_count, slot_size, subtree_levels=utils.SUBTREE_LEVELS):
+        """
+        Creates a store and preallocates its slots. A store whose nodes are not of a full binary
+        tree (e.g. the slots of the buckets of a Ring ORAM Tree) is laid out flat
+        :param filename: the path of the store
+        :param node_count: the amount of nodes of the tree
+        :param slot_size: the size of a bucket
+        :param subtree_levels: the amount of levels of a subtree in the layout
+        :return: the store
+        """
+        if node_count <= 0:
+            raise ValueError("Amount of nodes must be positive.")
+        if node_count & (node_count + 1):
+            subtree_levels = 1
+        tmp_filename = filename + utils.TMP_SUFFIX
+        fd = os.open(tmp_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            header = struct.pack(STORE_HEADER_FORMAT, STORE_MAGIC, node_count, slot_size,
+                                 max(1, subtree_levels))
+            os.pwrite(fd, header.ljust(STORE_HEADER_SIZE, b'\0'), 0)
+            size = STORE_HEADER_SIZE + node_count * slot_size
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_filename, filename)
+        return cls(filename)
+
+    @classmethod
+    def grow(cls, filename, node_count):
+        """
+        Grows a store to more nodes, keeping the buckets of its nodes. The layout of the slots
+        depends on the amount of nodes, so the buckets are copied to a new store, which replaces
+        the store once it is complete. Growing a store to its amount of nodes does nothing
+        :param filename: the path of the store
+        :param node_count: the amount of nodes of the grown tree
+        :return: the grown store
+        """
+        bucket_store = cls(filename)
+        if bucket_store.node_count == node_count:
+            return bucket_store
+        try:
+            if node_count < bucket_store.node_count:
+                raise ValueError("A tree cannot shrink.")
+            grown_store = cls.create(filename + utils.GROW_SUFFIX, node_count,
+                                     bucket_store.slot_size, bucket_store.subtree_levels)
+            try:
+                for node in range(bucket_store.node_count):
+                    bucket = os.pread(bucket_store.fd, bucket_store.slot_size,
+                                      bucket_store.get_offset(node))
+                    os.pwrite(grown_store.fd, bucket, grown_store.get_offset(node))
+                os.fsync(grown_store.fd)
+            finally:
+                grown_store.close()
+        finally:
+            bucket_store.close()
+        os.replace(filename + utils.GROW_SUFFIX, filename)
+        return cls(filename)
+
+    def close(self):
+        """
+        Closes the file of the store
+        :return:
+        """
+        os.close(self.fd)
+
+    def get_offset(self, node):
+        """
+        Returns the offset of the slot of a node in the file
+        :param node: the node ID
+        :return: the offset
+        """
+        if not 0 <= node < self.node_count:
+            raise ValueError(f"Node {node} is not in the tree.")
+        return STORE_HEADER_SIZE + get_slot(node, self.levels, self.subtree_levels) * self.slot_size
+
+    def read_path_into(self, nodes, buffers):
+        """
+        Reads the buckets of nodes straight into preallocated buffers
+        :param nodes: node IDs
+        :param buffers: writable buffers of the size of a bucket, one for each node
+        :return:
+        """
+        for node, buffer in zip(nodes, buffers):
+            offset = self.get_offset(node)
+            view = memoryview(buffer)
+            while view:
+                if hasattr(os, 'preadv'):
+                    read = os.preadv(self.fd, [view], offset)
+                else:
+                    data = os.pread(self.fd, len(view), offset)
+                    read = len(data)
+                    view[:read] = data
+                if not read:
+                    raise ValueError(f"Node {node} is beyond the end of the store.")
+                view = view[read:]
+                offset += read
+
+    def write_path(self, nodes, buckets):
+        """
+        Writes the buckets of nodes, committing them all with a single fsync
+        :param nodes: node IDs
+        :param buckets: the buckets of the nodes, in the same order
+        :return:
+        """
+        offsets = [self.get_offset(node) for node in nodes]
+        for bucket in buckets:
+            if len(bucket) != self.slot_size:
+                raise ValueError(f"Bucket must be {self.slot_size} bytes.")
+        for offset, bucket in zip(offsets, buckets):
+            written = 0
+            while written < len(bucket):
+                written += os.pwrite(self.fd, memoryview(bucket)[written:], offset + written)
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
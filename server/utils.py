@@ -2,5 +2,41 @@ import os
 
 BASE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(BASE_DIR, 'data')
-HEADER_SIZE = 1024
-CHUNK_SIZE = 4096
+
+SERVER_IP = '127.0.0.1'
+SERVER_PORT = 1234
+
+# The amount of worker threads accessing the disk
+WORKERS = 8
+# The maximal amount of requests in flight of a single connection, beyond which no more requests
+# are read from it
+WINDOW = 64
+
+# The stores of the buckets of the main PathORAM Tree, and of the other trees told apart by name
+STORE_FILE_NAME = 'buckets.store'
+TREE_STORE_FILE_NAME = '%s_buckets.store'
+TMP_SUFFIX = '.tmp'
+GROW_SUFFIX = '.grow'
+
+# The amount of levels of the tree stored contiguously in the store, such that reading a path
+# touches a few regions of the file only. 1 stores the nodes in their order
+SUBTREE_LEVELS = 4
+
+# Every message is a frame - a header, followed by the tree name, the node IDs and the payload. The
+# header is (protocol version, opcode, request ID, tree name length, node count, payload length)
+PROTOCOL_VERSION = 1
+FRAME_HEADER_FORMAT = '>BBIBIQ'
+NODE_ID_FORMAT = '>Q'
+# The payload of buckets is the buckets, each prefixed by its length
+BUCKET_LENGTH_FORMAT = '>I'
+
+# Opcodes of requests
+READ_PATH_OPCODE = 1
+WRITE_PATH_OPCODE = 2
+CREATE_TREE_OPCODE = 3
+GROW_TREE_OPCODE = 4
+# The payload of creating or growing a tree - (node count, bucket size)
+CREATE_TREE_FORMAT = '>QI'
+# Opcodes of responses
+OK_OPCODE = 128
+ERROR_OPCODE = 129